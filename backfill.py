@@ -0,0 +1,226 @@
+# Resumable historic scrape: get every post in a subreddit between two timestamps,
+# scanning several time windows in parallel and checkpointing progress in MongoDB
+import logging
+import time
+from multiprocessing.pool import ThreadPool
+
+import requests
+import praw
+
+import config
+from bulk_writer import PostUpsertSink
+from utils import chunked
+from reddit_scraper import convert_praw_post
+
+logger = logging.getLogger(__name__)
+
+class ScrapeCheckpoints(object):
+    """
+    Backfill progress, one document per subreddit in the checkpoints collection:
+
+        {'_id': subreddit, 'windows': [
+            {'start': timestamp, 'end': timestamp, 'lowest_timestamp': timestamp, 'lowest_id': post _id, 'done': bool,
+             'failed_ids': [post _id, ...]},
+            ...]}
+
+    Each window is scraped from end down to start (newest first), so lowest_timestamp is how far down it got:
+    everything in [lowest_timestamp, end] has been stored, except the posts in failed_ids,
+    which couldn't be fetched and are retried by later runs. Timestamps are UTC epoch seconds.
+    """
+    def __init__(self, db):
+        self.collection = db[config.CHECKPOINT_COLLECTION]
+
+    def __repr__(self):
+        return 'ScrapeCheckpoints(collection={self.collection.name})'.format(self=self)
+
+    def get(self, subreddit):
+        return self.collection.find_one({'_id':subreddit})
+
+    def plan(self, subreddit, lowest_timestamp, highest_timestamp, n_windows):
+        """
+        Returns the list of windows to scrape. A subreddit that already has a checkpoint keeps its old windows,
+        so a re-run resumes them. Only the time after the last planned highest_timestamp,
+        and before the first planned lowest timestamp, is added as new windows.
+        """
+        checkpoint = self.get(subreddit)
+        if checkpoint is None:
+            window_len = float(highest_timestamp - lowest_timestamp) / n_windows
+            bounds = [lowest_timestamp + idx * window_len for idx in range(n_windows)] + [highest_timestamp]
+            # newest window first, so recent posts are stored first
+            windows = [self._new_window(start, end) for start, end in reversed(zip(bounds[:-1], bounds[1:]))]
+            self.collection.insert_one({'_id':subreddit, 'windows':windows})
+            return windows
+
+        windows = checkpoint['windows']
+        planned_highest = max(window['end'] for window in windows)
+        planned_lowest = min(window['start'] for window in windows)
+        new_windows = []
+        if highest_timestamp > planned_highest:
+            new_windows.append(self._new_window(planned_highest, highest_timestamp))
+        if lowest_timestamp < planned_lowest:
+            new_windows.append(self._new_window(lowest_timestamp, planned_lowest))
+        if new_windows:
+            # appended, so the old windows keep their indexes
+            self.collection.update_one({'_id':subreddit}, {'$push':{'windows':{'$each':new_windows}}})
+            windows.extend(new_windows)
+        return windows
+
+    def _new_window(self, start, end):
+        return {'start':start, 'end':end, 'lowest_timestamp':end, 'lowest_id':None, 'done':False, 'failed_ids':[]}
+
+    def advance(self, subreddit, window_idx, lowest_timestamp, lowest_id):
+        """Record that everything in the window from lowest_timestamp up is stored"""
+        self.collection.update_one({'_id':subreddit}, {'$set':{
+            'windows.%i.lowest_timestamp' % window_idx: lowest_timestamp,
+            'windows.%i.lowest_id' % window_idx: lowest_id}})
+
+    def add_failed(self, subreddit, window_idx, post_ids):
+        """Record posts in the window that couldn't be stored, so a later run can retry them"""
+        self.collection.update_one({'_id':subreddit},
+            {'$addToSet':{'windows.%i.failed_ids' % window_idx: {'$each':post_ids}}})
+
+    def remove_failed(self, subreddit, window_idx, post_ids):
+        self.collection.update_one({'_id':subreddit},
+            {'$pull':{'windows.%i.failed_ids' % window_idx: {'$in':post_ids}}})
+
+    def finish(self, subreddit, window_idx):
+        self.collection.update_one({'_id':subreddit}, {'$set':{'windows.%i.done' % window_idx: True}})
+
+    def reset(self, subreddit):
+        self.collection.delete_one({'_id':subreddit})
+
+class HistoricBackfill(object):
+    """
+    Scrapes every post of a subreddit between two timestamps into MongoDB.
+    The range is split into time windows that are scraped in parallel threads, each with its own praw session.
+    After each batch is written, the window's checkpoint moves down to the oldest post in the batch,
+    so after a crash a re-run picks up each window where it stopped.
+    Posts that are already stored are skipped before their comments are fetched.
+    Posts that can't be fetched (eg deleted) are recorded in the window's failed_ids and retried by later runs,
+    instead of holding the checkpoint back.
+
+    reddit_factory : callable returning a new praw.Reddit session. Each window thread gets its own,
+        use the praw-multiprocess handler so they share one rate limit
+
+    db : the pymongo database with the posts and checkpoints collections
+
+    windows : number of time windows to split a new backfill into, and the number of threads
+
+    batch_size : number of posts to write per batch, and to check against the db at once
+    """
+    def __init__(self, reddit_factory, db, subreddit, windows=4, batch_size=100):
+        self.reddit_factory = reddit_factory
+        self.collection = db[config.POSTS_COLLECTION]
+        self.checkpoints = ScrapeCheckpoints(db)
+        self.subreddit = subreddit
+        self.n_windows = windows
+        self.batch_size = batch_size
+
+    def __repr__(self):
+        return 'HistoricBackfill(subreddit="{self.subreddit}", windows={self.n_windows}, batch_size={self.batch_size})'.format(self=self)
+
+    def new_posts(self, posts):
+        """The posts whose _ids aren't in the posts collection yet, checked with one query"""
+        post_ids = [post.id for post in posts]
+        stored_ids = set(doc['_id'] for doc in self.collection.find({'_id':{'$in':post_ids}}, {'_id':True}))
+        return [post for post in posts if post.id not in stored_ids]
+
+    def scrape_window(self, window_idx, window):
+        """Scrape the window from its checkpoint down to its start. Returns the number of posts added"""
+        r = self.reddit_factory()
+        sink = PostUpsertSink(self.collection, batch_size=self.batch_size, flush_interval=None)
+        posts = praw.helpers.submissions_between(r, self.subreddit,
+            lowest_timestamp=window['start'], highest_timestamp=window['lowest_timestamp'], newest_first=True)
+
+        logger.info('subreddit "%s" window %i: scraping %s back to %s' % (
+            self.subreddit, window_idx, time.ctime(window['lowest_timestamp']), time.ctime(window['start'])))
+        # once a batch write fails, the checkpoint stays above it so the next run retries it
+        write_failed = False
+        failed_post_count = 0
+        for post_batch in chunked(posts, self.batch_size):
+            new_ids = set(post.id for post in self.new_posts(post_batch))
+            failed_ids = []
+            # before adding: a full batch is flushed by the last add_post, not just by the flush() below
+            failed_count = sink.failed_count
+            for post in post_batch:
+                if post.id in new_ids:
+                    try:
+                        sink.add_post(convert_praw_post(post))
+                    except requests.exceptions.HTTPError:
+                        logger.warning('HTTPError for "%s"' % post.url)
+                        failed_ids.append(post.id)
+                    except AttributeError as err:
+                        logger.warning(err)
+                        failed_ids.append(post.id)
+            sink.flush()
+            if sink.failed_count > failed_count:
+                write_failed = True
+            # recorded before the checkpoint moves past them
+            if failed_ids:
+                self.checkpoints.add_failed(self.subreddit, window_idx, failed_ids)
+                failed_post_count += len(failed_ids)
+            # posts come newest first, so everything from the last one up is stored or recorded as failed
+            if not write_failed:
+                checkpoint_post = post_batch[-1]
+                self.checkpoints.advance(self.subreddit, window_idx, checkpoint_post.created_utc, checkpoint_post.id)
+
+        if write_failed:
+            logger.warning('subreddit "%s" window %i: some batches failed to write, re-run to retry them' % (
+                self.subreddit, window_idx))
+            return sink.added_count
+        self.checkpoints.finish(self.subreddit, window_idx)
+        logger.info('subreddit "%s" window %i finished: added %i posts, %i failed posts recorded for retry' % (
+            self.subreddit, window_idx, sink.added_count, failed_post_count))
+        return sink.added_count
+
+    def retry_failed(self, window_idx, window):
+        """Try again to store the window's failed posts, by _id. Returns the number of posts added"""
+        r = self.reddit_factory()
+        sink = PostUpsertSink(self.collection, batch_size=self.batch_size, flush_interval=None)
+        logger.info('subreddit "%s" window %i: retrying %i failed posts' % (
+            self.subreddit, window_idx, len(window['failed_ids'])))
+        fetched_ids = []
+        for post_id in window['failed_ids']:
+            try:
+                sink.add_post(convert_praw_post(r.get_submission(submission_id=post_id)))
+                fetched_ids.append(post_id)
+            except requests.exceptions.HTTPError:
+                logger.warning('HTTPError for post "%s"' % post_id)
+            except AttributeError as err:
+                logger.warning(err)
+        sink.flush()
+        if fetched_ids and sink.failed_count == 0:
+            self.checkpoints.remove_failed(self.subreddit, window_idx, fetched_ids)
+        return sink.added_count
+
+    def backfill_window(self, window_idx, window):
+        """Retry the window's failed posts, then scrape the rest of it if it isn't done"""
+        added_count = 0
+        if window.get('failed_ids'):
+            added_count += self.retry_failed(window_idx, window)
+        if not window['done']:
+            added_count += self.scrape_window(window_idx, window)
+        return added_count
+
+    def run(self, lowest_timestamp, highest_timestamp=None):
+        """
+        Backfill from highest_timestamp (default now) down to lowest_timestamp,
+        skipping windows and parts of windows that earlier runs finished. Returns the number of posts added
+        """
+        if highest_timestamp is None:
+            highest_timestamp = time.time()
+        windows = self.checkpoints.plan(self.subreddit, lowest_timestamp, highest_timestamp, self.n_windows)
+        todo = [(idx, window) for idx, window in enumerate(windows) if not window['done'] or window.get('failed_ids')]
+        logger.info('backfilling subreddit "%s": %i of %i windows left' % (self.subreddit, len(todo), len(windows)))
+        if not todo:
+            return 0
+
+        pool = ThreadPool(min(self.n_windows, len(todo)))
+        try:
+            added_counts = pool.map(lambda idx_window: self.backfill_window(*idx_window), todo)
+        finally:
+            pool.close()
+            pool.join()
+
+        logger.info('***FINISHED BACKFILL of subreddit "%s": added %i posts***' % (self.subreddit, sum(added_counts)))
+        return sum(added_counts)
@@ -0,0 +1,154 @@
+#!/usr/bin/env python
+# End-to-end benchmark of the load -> preprocess -> NMF -> summarize pipeline on synthetic posts.
+# Writes a JSON report with wall time, docs/sec and peak RSS per stage.
+# Run from the repo root: python -m benchmarks.pipeline --n_posts 10000 --report bench.json
+import sys
+import json
+import time
+import platform
+import argparse
+import resource
+
+import nltk
+
+import config
+from process_text import PostManager, Preprocessor
+from nmf_topics import TopicModeler
+from summarizer import summarize_topic
+from complaint_index import COMPLAINT_QUERY_MIXIN
+from instrumentation import metrics
+from benchmarks.synthetic import load_posts
+
+def peak_rss_mb():
+    """Peak resident set size so far of this process and its finished child processes (eg --workers), in MB"""
+    # ru_maxrss is in KB on linux, bytes on OS X
+    unit = 1024.0 * 1024.0 if sys.platform == 'darwin' else 1024.0
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / unit
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / unit
+    return max(own, children)
+
+class PipelineBenchmark(object):
+    """
+    Runs each pipeline stage in order, recording its wall time, throughput and the peak RSS so far.
+    Every stage function returns the number of items (docs, or topics for summarize) it processed.
+    """
+    def __init__(self, mongoclient, db_name, subreddit='benchmark'):
+        self.mongoclient = mongoclient
+        self.db_name = db_name
+        self.subreddit = subreddit
+        self.postman = PostManager(mongoclient, subreddit, read_db=db_name)
+        self.stages = []
+
+    def __repr__(self):
+        return 'PipelineBenchmark(db_name="{self.db_name}", subreddit="{self.subreddit}")'.format(self=self)
+
+    def run_stage(self, name, unit, func, *args, **kwargs):
+        print '\n=== %s ===' % name
+        start = time.time()
+        item_count = func(*args, **kwargs)
+        seconds = time.time() - start
+
+        stage = {
+            'name': name,
+            'seconds': seconds,
+            'items': item_count,
+            'unit': unit,
+            'items_per_sec': item_count / max(seconds, 1e-9),
+            'peak_rss_mb': peak_rss_mb(),
+        }
+        self.stages.append(stage)
+        print '%s: %i %s in %.2f sec, %.1f %s/sec, peak RSS %.0f MB' % (
+            name, item_count, unit, seconds, stage['items_per_sec'], unit, stage['peak_rss_mb'])
+        return stage
+
+    def load(self, n_posts, mean_comments, seed):
+        collection = self.mongoclient[self.db_name][config.POSTS_COLLECTION]
+        return load_posts(collection, n_posts, self.subreddit, mean_comments, seed)
+
+    def preprocess(self, workers):
+        stopwords = nltk.corpus.stopwords.words('english') + ['nt','its']
+        prepro = Preprocessor(self.postman, document_level='postwise', min_word_len=3, max_word_len=20,
+            stopwords=stopwords, allowed_pos_tags=['JJ','JJR','JJS','RB','RBR','RBS'])
+        prepro.process(workers=workers).persist_corpus()
+        return self.postman.posts_read.find({'subreddit':self.subreddit, 'postwise':{'$exists':True}}).count()
+
+    def fit_nmf(self, n_topics, vectorizer_settings):
+        doc_texts = [text for _, text in self.postman.fetch_doc_text_body('postwise', COMPLAINT_QUERY_MIXIN)]
+        self.topic_modeler = TopicModeler(self.postman)
+        self.topic_modeler.train_topic_model(doc_texts, n_topics, vectorizer_settings)
+        return len(doc_texts)
+
+    def assign_topics(self):
+        self.postman.wipe_all_topics()
+        self.postman.save_doc_topics(self.topic_modeler, find_query_mixin=COMPLAINT_QUERY_MIXIN)
+        return self.postman.posts_read.find({'subreddit':self.subreddit,
+            'postwise.topic_assignment':{'$exists':True}}).count()
+
+    def summarize(self, max_docs):
+        topic_ids = sorted(self.postman.get_topics())
+        for topic_id in topic_ids:
+            summarize_topic(self.postman, topic_id, summary_ratio=0.05, single_doc_len=2500,
+                doc_char_limit=0, max_docs=max_docs)
+        return len(topic_ids)
+
+    def report(self, settings):
+        return {
+            'settings': settings,
+            'environment': {
+                'python': platform.python_version(),
+                'platform': platform.platform(),
+                'mongo': type(self.mongoclient).__module__,
+            },
+            'stages': self.stages,
+            # time in each instrumented step (fetch, tokenize, ...) across all the stages
+            'steps': metrics.snapshot(),
+            'total_seconds': sum(stage['seconds'] for stage in self.stages),
+            'peak_rss_mb': peak_rss_mb(),
+        }
+
+if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser(description='Benchmarks the whole pipeline on synthetic posts')
+    arg_parser.add_argument('--n_posts', type=int, help='number of synthetic posts, eg 1000 up to 1000000', default=1000)
+    arg_parser.add_argument('--mean_comments', type=int, help='mean number of comments per post', default=10)
+    arg_parser.add_argument('--seed', type=int, help='random seed for the synthetic posts', default=0)
+    arg_parser.add_argument('--db', type=str, help='MongoDB database to run in. It is dropped first!', default='benchmark')
+    arg_parser.add_argument('--mongomock', action='store_true',
+        help='run against an in-process mongomock stand-in instead of mongod (pip install mongomock)')
+    arg_parser.add_argument('--workers', type=int, help='preprocessing processes (needs mongod)', default=1)
+    arg_parser.add_argument('--n_topics', type=int, help='number of NMF topics', default=6)
+    arg_parser.add_argument('--max_docs', type=int, help='max docs to summarize per topic (0 for no limit)', default=200)
+    arg_parser.add_argument('--report', type=str, help='path to write the JSON report to. Default: print it')
+    args = arg_parser.parse_args()
+
+    if not args.db.startswith('benchmark'):
+        raise ValueError('--db "%s" would be dropped, use a name starting with "benchmark"' % args.db)
+
+    if args.mongomock:
+        try:
+            import mongomock
+        except ImportError:
+            sys.exit('--mongomock needs the mongomock package: pip install mongomock')
+        if args.workers > 1:
+            sys.exit('--workers needs a real mongod: worker processes can\'t share an in-process mongomock')
+        mongoclient = mongomock.MongoClient()
+    else:
+        from mongo_setup import mongoclient
+
+    mongoclient.drop_database(args.db)
+    benchmark = PipelineBenchmark(mongoclient, args.db)
+    vectorizer_settings = dict(stop_words='english', max_df=0.5, min_df=0.01)
+
+    benchmark.run_stage('load', 'posts', benchmark.load, args.n_posts, args.mean_comments, args.seed)
+    benchmark.run_stage('preprocess', 'posts', benchmark.preprocess, args.workers)
+    benchmark.run_stage('nmf_fit', 'docs', benchmark.fit_nmf, args.n_topics, vectorizer_settings)
+    benchmark.run_stage('assign_topics', 'docs', benchmark.assign_topics)
+    benchmark.run_stage('summarize', 'topics', benchmark.summarize, args.max_docs)
+
+    settings = {key:val for key, val in vars(args).items() if key != 'report'}
+    report_json = json.dumps(benchmark.report(settings), indent=2, sort_keys=True)
+    if args.report:
+        with open(args.report, 'w') as report_file:
+            report_file.write(report_json + '\n')
+        print '\nwrote report to %s' % args.report
+    else:
+        print report_json
@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+# Deterministic synthetic reddit posts, in the same schema the scrapers store (reddit_scraper.make_post_document).
+# Run from the repo root to load them into MongoDB: python -m benchmarks.synthetic --n_posts 100000 --db benchmark
+import random
+import argparse
+
+from reddit_scraper import make_post_document
+from bulk_writer import PostUpsertSink
+
+# each post is mostly about one of these, so topic models have something to find
+TOPIC_WORDS = [
+    ['laptop', 'battery', 'charger', 'screen', 'keyboard', 'hinge', 'warranty', 'overheating'],
+    ['printer', 'driver', 'cartridge', 'paper', 'scanner', 'wireless', 'toner', 'queue'],
+    ['update', 'windows', 'reboot', 'crash', 'freeze', 'install', 'settings', 'bluescreen'],
+    ['router', 'wifi', 'connection', 'signal', 'modem', 'bandwidth', 'ethernet', 'outage'],
+    ['phone', 'android', 'app', 'notification', 'camera', 'storage', 'bluetooth', 'headphones'],
+    ['landlord', 'rent', 'lease', 'deposit', 'repair', 'neighbor', 'apartment', 'heating'],
+]
+COMPLAINT_WORDS = ['annoying', 'frustrating', 'problem', 'stupid', 'broken', 'disappointing', 'faulty', 'sucks',
+    'impossible', 'exhausting', 'headache', 'junk', 'help', 'advice']
+FILLER_WORDS = ['the', 'my', 'it', 'is', 'was', 'and', 'but', 'so', 'really', 'just', 'again', 'every', 'time',
+    'today', 'after', 'still', 'never', 'always', 'when', 'then', 'new', 'old', 'week', 'day', 'thing', 'work']
+
+# 2015-01-01, posts are a minute apart
+START_TIMESTAMP = 1420070400
+
+def sentence(rng, topic_words, complaint_rate):
+    """One sentence of 6-16 words, mixing filler, topic and complaint words"""
+    words = []
+    for _ in range(rng.randint(6, 16)):
+        roll = rng.random()
+        if roll < complaint_rate:
+            words.append(rng.choice(COMPLAINT_WORDS))
+        elif roll < 0.45:
+            words.append(rng.choice(topic_words))
+        else:
+            words.append(rng.choice(FILLER_WORDS))
+    return words[0].capitalize() + ' ' + ' '.join(words[1:]) + '.'
+
+def paragraph(rng, topic_words, complaint_rate, max_sentences):
+    return ' '.join(sentence(rng, topic_words, complaint_rate) for _ in range(rng.randint(1, max_sentences)))
+
+def generate_posts(n_posts, subreddit='benchmark', mean_comments=10, complaint_share=0.5, seed=0):
+    """
+    Yields n_posts post documents, the same for the same arguments.
+
+    mean_comments : posts get 0 to 2 * mean_comments comments, uniformly
+
+    complaint_share : fraction of posts that use complaint words (config.SEARCH_WORDS)
+    """
+    rng = random.Random(seed)
+    for post_idx in xrange(n_posts):
+        topic_words = TOPIC_WORDS[rng.randrange(len(TOPIC_WORDS))]
+        complaint_rate = 0.08 if rng.random() < complaint_share else 0.0
+        created = START_TIMESTAMP + 60 * post_idx
+
+        comments = [('c%x_%i' % (post_idx, comment_idx), paragraph(rng, topic_words, complaint_rate, 4),
+            created + 60 * (comment_idx + 1))
+            for comment_idx in range(rng.randint(0, 2 * mean_comments))]
+
+        yield make_post_document('s%x' % post_idx, sentence(rng, topic_words, complaint_rate)[:-1], subreddit,
+            paragraph(rng, topic_words, complaint_rate, 6), created, comments or None)
+
+def load_posts(collection, n_posts, subreddit='benchmark', mean_comments=10, seed=0, batch_size=1000):
+    """Upsert the synthetic posts into the collection, the way the scrapers do. Returns the number of posts added"""
+    sink = PostUpsertSink(collection, batch_size=batch_size, flush_interval=None)
+    for post_doc in generate_posts(n_posts, subreddit, mean_comments, seed=seed):
+        sink.add_post(post_doc)
+    sink.close()
+    return sink.added_count
+
+if __name__ == '__main__':
+    import config
+    from mongo_setup import mongoclient
+
+    arg_parser = argparse.ArgumentParser(description='Loads deterministic synthetic posts into MongoDB')
+    arg_parser.add_argument('--n_posts', type=int, help='number of posts', default=1000)
+    arg_parser.add_argument('--mean_comments', type=int, help='mean number of comments per post', default=10)
+    arg_parser.add_argument('--subreddit', type=str, help='subreddit name for the posts', default='benchmark')
+    arg_parser.add_argument('--db', type=str, help='name of MongoDB database to load posts into', default='benchmark')
+    arg_parser.add_argument('--seed', type=int, help='random seed', default=0)
+    args = arg_parser.parse_args()
+
+    added_count = load_posts(mongoclient[args.db][config.POSTS_COLLECTION], args.n_posts,
+        args.subreddit, args.mean_comments, args.seed)
+    print 'added %i synthetic posts to subreddit "%s" in db "%s"' % (added_count, args.subreddit, args.db)
@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+# Benchmark Preprocessor.filter_tokens against the old per-word filter on the fixture corpus.
+# Run from the repo root: python -m benchmarks.token_filter
+import os
+import json
+import time
+import argparse
+
+import nltk
+
+from mongo_setup import mongoclient
+from process_text import PostManager, Preprocessor, all_comments_from_post
+
+FIXTURE_PATH = os.path.join(os.path.dirname(__file__), 'fixtures', 'posts.json')
+
+def load_fixture_docs(repeat):
+    """Tokenized documents from the fixture posts, repeated to make a bigger corpus"""
+    with open(FIXTURE_PATH) as fixture_file:
+        posts = json.load(fixture_file)
+    docs = [nltk.word_tokenize(all_comments_from_post(post)) for post in posts]
+    return docs * repeat
+
+def old_filter(prepro, stopwords_list, tokens):
+    """The filter from before filter_tokens: always POS tag, list stopwords, clean word by word"""
+    processed_document = []
+    for word, pos_tag in nltk.pos_tag(tokens):
+        if (word not in stopwords_list
+            and (prepro.max_word_len > len(word) > prepro.min_word_len)
+            and (prepro.allowed_pos_tags == None or pos_tag not in prepro.allowed_pos_tags)):
+            cleaned_word = prepro.clean_word(word)
+            if cleaned_word:
+                processed_document.append(cleaned_word)
+    return processed_document
+
+def time_it(func, docs):
+    start = time.time()
+    output = [func(tokens) for tokens in docs]
+    return time.time() - start, output
+
+if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser(description='Benchmarks the preprocessing token filter on the fixture corpus')
+    arg_parser.add_argument('--repeat', type=int, help='number of copies of the fixture corpus to filter', default=20)
+    args = arg_parser.parse_args()
+
+    docs = load_fixture_docs(args.repeat)
+    print 'filtering %i documents, %i tokens' % (len(docs), sum(len(doc) for doc in docs))
+
+    # nothing is written, the PostManager is just needed to build a Preprocessor
+    postman = PostManager(mongoclient, 'benchmark')
+    stopwords_list = nltk.corpus.stopwords.words('english') + ['nt','its']
+
+    for allowed_pos_tags in [['JJ','JJR','JJS','RB','RBR','RBS'], None]:
+        prepro = Preprocessor(postman, document_level='postwise', min_word_len=3, max_word_len=20,
+            stopwords=stopwords_list, allowed_pos_tags=allowed_pos_tags)
+        prepro.load_models()
+
+        old_seconds, old_output = time_it(lambda tokens: old_filter(prepro, stopwords_list, tokens), docs)
+        new_seconds, new_output = time_it(prepro.filter_tokens, docs)
+
+        if old_output != new_output:
+            raise AssertionError('filter_tokens output differs from the old filter')
+
+        print '\nallowed_pos_tags=%s' % allowed_pos_tags
+        print '  old filter:    %.3f sec' % old_seconds
+        print '  filter_tokens: %.3f sec' % new_seconds
+        print '  speedup:       %.1fx' % (old_seconds / max(new_seconds, 1e-9))
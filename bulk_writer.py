@@ -0,0 +1,233 @@
+# Buffers MongoDB write operations and sends them in unordered bulk_write batches
+import time
+import logging
+import threading
+
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+
+logger = logging.getLogger(__name__)
+
+class BulkWriter(object):
+    """
+    Collects pymongo write operations (UpdateOne, InsertOne, ...) for a single collection
+    and flushes them with one unordered bulk_write per batch, instead of one round trip per document.
+
+    collection : the pymongo collection to write to
+
+    batch_size : number of buffered operations that triggers a flush
+
+    flush_interval : if set, also flush when the oldest buffered operation has waited this many seconds.
+        Checked when an operation is added, and by flush_if_due()
+
+    Call flush() when you're done adding operations, or the last partial batch is never written.
+    Safe to share between threads.
+    """
+    def __init__(self, collection, batch_size=1000, flush_interval=None):
+        if batch_size < 1:
+            raise ValueError('batch_size must be at least 1, got %r' % batch_size)
+
+        self.collection = collection
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.ops = []
+        self.first_op_time = None
+        self.lock = threading.RLock()
+
+        # running stats, see report()
+        self.op_count = 0
+        self.flush_count = 0
+        self.flush_seconds = 0.0
+
+    def __repr__(self):
+        return 'BulkWriter(collection={self.collection.name}, batch_size={self.batch_size}, flush_interval={self.flush_interval})'.format(self=self)
+
+    def add(self, op):
+        """Buffer a write operation, flushing if the batch is full or has waited too long"""
+        with self.lock:
+            if not self.ops:
+                self.first_op_time = time.time()
+            self.ops.append(op)
+            if len(self.ops) >= self.batch_size:
+                self.flush()
+            else:
+                self.flush_if_due()
+
+    def flush_if_due(self):
+        """Flush if the oldest buffered operation is older than flush_interval"""
+        with self.lock:
+            if self.ops and self.flush_interval is not None and time.time() - self.first_op_time >= self.flush_interval:
+                return self.flush()
+
+    def flush(self):
+        """
+        Write all buffered operations. Returns the BulkWriteResult, or None if there was nothing to write.
+
+        If the write fails before MongoDB reports per-operation results (eg AutoReconnect or a timeout),
+        the operations stay buffered for the next flush and the error is raised.
+        A BulkWriteError means the batch was processed, so it's cleared from the buffer before raising.
+        """
+        with self.lock:
+            if not self.ops:
+                return None
+
+            buffered = self.ops
+            start = time.time()
+            try:
+                ops = self.build_ops(buffered)
+                result = self.collection.bulk_write(ops, ordered=False)
+            except BulkWriteError:
+                self.ops = []
+                self.count_flush(len(ops), start)
+                raise
+            self.ops = []
+            self.count_flush(len(ops), start)
+            return result
+
+    def count_flush(self, op_count, start):
+        self.flush_seconds += time.time() - start
+        self.flush_count += 1
+        self.op_count += op_count
+
+    def build_ops(self, buffered):
+        """Turns the buffered items into write operations at flush time. Override to buffer something else"""
+        return buffered
+
+    def stats(self):
+        """Returns the running stats as a (op_count, flush_count, flush_seconds) tuple"""
+        return self.op_count, self.flush_count, self.flush_seconds
+
+    def add_stats(self, stats):
+        """Fold in stats() from another BulkWriter, eg one that ran in a worker process"""
+        op_count, flush_count, flush_seconds = stats
+        self.op_count += op_count
+        self.flush_count += flush_count
+        self.flush_seconds += flush_seconds
+
+    def report(self):
+        """Print flush latency and throughput so far"""
+        if not self.flush_count:
+            print 'bulk writer: nothing written'
+            return
+        print 'bulk writer: wrote %i ops in %i batches, %.1f ms/batch, %.0f ops/sec' % (
+            self.op_count, self.flush_count,
+            1000 * self.flush_seconds / self.flush_count,
+            self.op_count / max(self.flush_seconds, 1e-9))
+
+class PostUpsertSink(BulkWriter):
+    """
+    Final stage of a scraper: buffers post documents and upserts them by _id in unordered bulk writes,
+    flushing every batch_size posts or every flush_interval seconds, whichever comes first.
+    Keeps running counts of added and updated posts, and logs one summary line per batch.
+
+    Comments are merged by their reddit id instead of rewriting the whole comments array:
+    at flush time the stored comment ids of the batch's posts are fetched with one query,
+    and only comments that aren't stored yet are $push'ed. Edits to stored comments aren't picked up.
+    Posts stored before comments had ids get their comments array replaced, which adds the ids.
+
+    Call start_timer() when posts arrive slowly (eg streaming new posts), so a partial batch
+    doesn't sit in the buffer until the next post shows up. Call close() when done.
+    """
+    def __init__(self, collection, batch_size=100, flush_interval=30):
+        super(PostUpsertSink, self).__init__(collection, batch_size=batch_size, flush_interval=flush_interval)
+        self.added_count = 0
+        self.updated_count = 0
+        self.failed_count = 0
+        self.pushed_comment_count = 0
+        self.batch_comment_count = 0
+        self.timer_thread = None
+        self.closed = threading.Event()
+
+    def __repr__(self):
+        return 'PostUpsertSink(collection={self.collection.name}, batch_size={self.batch_size}, flush_interval={self.flush_interval})'.format(self=self)
+
+    def add_post(self, post_doc):
+        """Buffer a post document. Upsert: update if _id already exists, otherwise insert"""
+        self.add(post_doc)
+
+    def stored_comment_ids(self, post_ids):
+        """
+        Returns {post _id : set of stored comment ids} for the stored posts among post_ids.
+        The set is None for posts with comments stored without ids.
+        """
+        stored = {}
+        for post in self.collection.find({'_id':{'$in':post_ids}}, {'comments.id':True}):
+            comment_ids = [comment.get('id') for comment in post.get('comments', [])]
+            stored[post['_id']] = None if None in comment_ids else set(comment_ids)
+        return stored
+
+    def build_ops(self, post_docs):
+        # the same post scraped twice in one batch: keep the last one
+        latest_docs = {}
+        for post_doc in post_docs:
+            latest_docs[post_doc['_id']] = post_doc
+        stored = self.stored_comment_ids(latest_docs.keys())
+
+        # added to pushed_comment_count once the batch is written
+        self.batch_comment_count = 0
+        ops = []
+        for post_id, post_doc in latest_docs.items():
+            comment_ids = stored.get(post_id)
+            if 'comments' not in post_doc or comment_ids is None:
+                # new post, post scraped without comments, or legacy comments without ids
+                ops.append(UpdateOne({'_id':post_id}, {'$set':post_doc}, upsert=True))
+                continue
+
+            new_comments = [comment for comment in post_doc['comments'] if comment['id'] not in comment_ids]
+            post_fields = {key:val for key, val in post_doc.items() if key != 'comments'}
+            post_fields['num_comments'] = len(comment_ids) + len(new_comments)
+            update = {'$set':post_fields}
+            if new_comments:
+                update['$push'] = {'comments':{'$each':new_comments}}
+                self.batch_comment_count += len(new_comments)
+            ops.append(UpdateOne({'_id':post_id}, update, upsert=True))
+        return ops
+
+    def flush(self):
+        with self.lock:
+            batch_size = len(self.ops)
+            start = time.time()
+            try:
+                result = super(PostUpsertSink, self).flush()
+            except BulkWriteError as err:
+                details = err.details
+                self.failed_count += len(details['writeErrors'])
+                self.added_count += details['nUpserted']
+                self.updated_count += details['nMatched']
+                logger.warning('batch of %i posts: %i failed, first error: %s' % (
+                    batch_size, len(details['writeErrors']), details['writeErrors'][0]['errmsg']))
+                return None
+            if result is None:
+                return None
+
+            if not result.acknowledged:
+                logger.warning('batch of %i posts was not acknowledged' % batch_size)
+                return result
+            self.added_count += result.upserted_count
+            self.updated_count += result.matched_count
+            self.pushed_comment_count += self.batch_comment_count
+            logger.info('batch of %i posts: added %i, updated %i in %.0f ms (total added %i, updated %i, new comments %i)' % (
+                batch_size, result.upserted_count, result.matched_count, 1000 * (time.time() - start),
+                self.added_count, self.updated_count, self.pushed_comment_count))
+            return result
+
+    def start_timer(self):
+        """Check for an overdue batch every second in a background thread, until close()"""
+        def check_until_closed():
+            while not self.closed.wait(1.0):
+                try:
+                    self.flush_if_due()
+                except Exception as err:
+                    # the batch stays buffered, so the next check, add_post or close() retries it
+                    logger.error('background flush of %i posts failed, will retry: %s' % (len(self.ops), err))
+
+        self.timer_thread = threading.Thread(target=check_until_closed)
+        self.timer_thread.daemon = True
+        self.timer_thread.start()
+
+    def close(self):
+        """Stop the timer thread and write the last partial batch. Raises if it still can't be written"""
+        self.closed.set()
+        if self.timer_thread is not None:
+            self.timer_thread.join()
+        self.flush()
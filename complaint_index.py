@@ -0,0 +1,147 @@
+#!/usr/bin/env python
+# Which complaint terms (config.SEARCH_WORDS) each post contains, computed from its postwise tokens.
+# Stored on the post for selecting the complaint subset, and as a term -> post inverted index.
+import argparse
+
+import pymongo
+from pymongo import UpdateOne, DeleteMany
+
+import config
+from bulk_writer import BulkWriter
+
+# find_query_mixin for the posts containing any of the complaint terms.
+# Replaces {'postwise.tokens': {'$in': config.SEARCH_WORDS}}
+COMPLAINT_QUERY_MIXIN = {'postwise.complaint_count': {'$gt': 0}}
+
+def complaint_term_counts(tokens, terms):
+    """{term : number of occurrences in tokens} for the terms that occur in tokens"""
+    term_counts = {}
+    for token in tokens:
+        if token in terms:
+            term_counts[token] = term_counts.get(token, 0) + 1
+    return term_counts
+
+class ComplaintIndex(object):
+    """
+    Keeps the complaint term fields of posts and the inverted index up to date:
+
+        postwise.complaint_hits : sorted list of the complaint terms in the post's tokens
+        postwise.complaint_count : number of complaint term occurrences in the post's tokens
+
+    and one document per (term, post) in the complaint_index collection:
+
+        {'_id': 'term:post _id', 'subreddit':..., 'term':..., 'post_id':..., 'count': occurrences in the post}
+
+    The terms each subreddit was last indexed with are kept in the complaint_terms collection,
+    so when config.SEARCH_WORDS changes, reindex() only revisits the posts containing added or removed terms.
+
+    postman : the PostManager. Everything is read from & written to its write db, where the postwise fields are
+
+    terms : the complaint terms
+    """
+    def __init__(self, postman, terms=config.SEARCH_WORDS, write_batch_size=1000):
+        self.postman = postman
+        self.terms = frozenset(terms)
+        write_db = postman.mongoclient[postman.write_db]
+        self.postings = write_db[config.COMPLAINT_INDEX_COLLECTION]
+        self.indexed_terms = write_db[config.COMPLAINT_TERMS_COLLECTION]
+        self.writer = BulkWriter(self.postings, batch_size=write_batch_size)
+
+    def __repr__(self):
+        return 'ComplaintIndex(subreddit="{self.postman.subreddit}", n_terms={0})'.format(len(self.terms), self=self)
+
+    def postwise_fields(self, post_id, tokens, previous_count=None):
+        """
+        The complaint fields to $set in the post's postwise field.
+        Queues the post's inverted index updates, call flush() after the last post.
+
+        previous_count : the post's stored postwise.complaint_count (0 if it has none), or None if unknown.
+            Stale postings are only deleted if the post may have had some
+        """
+        term_counts = complaint_term_counts(tokens, self.terms)
+        hits = sorted(term_counts)
+
+        # hits and stale postings are disjoint, so the unordered writes can go in any order
+        if previous_count is None or previous_count > 0:
+            self.writer.add(DeleteMany({'post_id':post_id, 'term':{'$nin':hits}}))
+        for term, term_count in term_counts.iteritems():
+            self.writer.add(UpdateOne({'_id':'%s:%s' % (term, post_id)},
+                {'$set':{'subreddit':self.postman.subreddit, 'term':term, 'post_id':post_id, 'count':term_count}},
+                upsert=True))
+        return {'complaint_hits':hits, 'complaint_count':sum(term_counts.itervalues())}
+
+    def flush(self):
+        self.writer.flush()
+        return self
+
+    def stored_terms(self):
+        """The terms the subreddit was last fully indexed with, or None if it never was"""
+        doc = self.indexed_terms.find_one({'_id':self.postman.subreddit})
+        return frozenset(doc['terms']) if doc else None
+
+    def save_terms(self):
+        """Record that every post in the subreddit is indexed with the current terms"""
+        self.indexed_terms.replace_one({'_id':self.postman.subreddit},
+            {'_id':self.postman.subreddit, 'terms':sorted(self.terms)}, upsert=True)
+
+    def reindex(self, batch_size=1000):
+        """
+        Bring the subreddit's complaint fields & inverted index up to date with the current terms, without re-tokenizing.
+        Only posts containing a term that was added or removed since the last index are revisited.
+        Returns the number of posts updated.
+        """
+        stored_terms = self.stored_terms()
+        find_query = {'subreddit':self.postman.subreddit, 'postwise.tokens':{'$exists':True}}
+        if stored_terms is None:
+            print 'no complaint index for subreddit "%s", indexing all posts' % self.postman.subreddit
+        else:
+            changed_terms = stored_terms ^ self.terms
+            if not changed_terms:
+                print 'complaint index is up to date'
+                return 0
+            print 'complaint terms changed: +%s -%s' % (sorted(self.terms - stored_terms), sorted(stored_terms - self.terms))
+            find_query['postwise.tokens'] = {'$in':sorted(changed_terms)}
+
+        post_writer = BulkWriter(self.postman.posts_write, batch_size=self.writer.batch_size)
+        cursor = self.postman.posts_write.find(find_query,
+            {'postwise.tokens':True, 'postwise.complaint_count':True}).batch_size(batch_size)
+        post_count = 0
+        for post in cursor:
+            fields = self.postwise_fields(post['_id'], post['postwise']['tokens'],
+                post['postwise'].get('complaint_count', 0))
+            post_writer.add(UpdateOne({'_id':post['_id']}, {'$set':{
+                'postwise.complaint_hits':fields['complaint_hits'],
+                'postwise.complaint_count':fields['complaint_count']}}))
+            post_count += 1
+        post_writer.flush()
+        self.flush()
+        self.save_terms()
+
+        print 'updated complaint fields of %i posts' % post_count
+        return post_count
+
+    def ensure_indexes(self):
+        # same as in mongo_setup.INDEXES
+        self.postings.create_index([('subreddit', pymongo.ASCENDING), ('term', pymongo.ASCENDING)], name='subreddit_term', background=True)
+        self.postings.create_index([('post_id', pymongo.ASCENDING)], name='post_id', background=True)
+
+    def post_ids(self, term):
+        """_ids of the subreddit's posts containing the term, from the inverted index"""
+        postings = self.postings.find({'subreddit':self.postman.subreddit, 'term':term}, {'post_id':True})
+        return [posting['post_id'] for posting in postings]
+
+if __name__ == '__main__':
+    from mongo_setup import mongoclient
+    from process_text import PostManager
+
+    arg_parser = argparse.ArgumentParser(
+        description='Updates the complaint term fields & inverted index after config.SEARCH_WORDS changed, without re-tokenizing')
+    arg_parser.add_argument('--subreddit', type=str, help='subreddit name', required=True)
+    arg_parser.add_argument('--read_db', type=str, help='name of MongoDB database to read tokenized posts from')
+    arg_parser.add_argument('--write_db', type=str, help='name of MongoDB database to write the index to')
+    args = arg_parser.parse_args()
+
+    postman = PostManager(mongoclient, args.subreddit, args.read_db, args.write_db)
+    complaint_index = ComplaintIndex(postman)
+    complaint_index.ensure_indexes()
+    complaint_index.reindex()
@@ -0,0 +1,214 @@
+#!/usr/bin/env python
+# Scrape the newest posts, including all comments, from many subreddits at once
+# over reddit's JSON API, and store them in MongoDB.
+import logging
+import argparse
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+
+import requests
+from requests.adapters import HTTPAdapter
+
+import config
+from mongo_setup import mongoclient
+from bulk_writer import PostUpsertSink
+from reddit_scraper import make_post_document
+
+logger = logging.getLogger(__name__)
+
+class RateLimiter(object):
+    """
+    Spaces out requests so that all the threads sharing it together stay under requests_per_minute.
+    Call wait() before each request.
+    """
+    def __init__(self, requests_per_minute):
+        self.interval = 60.0 / requests_per_minute
+        self.lock = threading.Lock()
+        self.next_time = time.time()
+
+    def wait(self):
+        with self.lock:
+            now = time.time()
+            sleep_secs = self.next_time - now
+            # reserve the next slot, then sleep outside the lock
+            self.next_time = max(now, self.next_time) + self.interval
+        if sleep_secs > 0:
+            time.sleep(sleep_secs)
+
+class RedditJSONClient(object):
+    """
+    Minimal client for reddit's public JSON API, safe to share between threads.
+    Keeps a pool of HTTP connections open, and sends every request through one RateLimiter.
+
+    base_url : point this at a fake reddit server for testing
+    """
+    def __init__(self, rate_limiter, user_agent, base_url='https://www.reddit.com', pool_size=10, max_retries=3):
+        self.rate_limiter = rate_limiter
+        self.base_url = base_url.rstrip('/')
+        self.max_retries = max_retries
+
+        self.session = requests.Session()
+        self.session.headers['User-Agent'] = user_agent
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def __repr__(self):
+        return 'RedditJSONClient(base_url="{self.base_url}")'.format(self=self)
+
+    def get_json(self, path, params=None):
+        """GET base_url + path, retrying with backoff when rate limited or on server errors"""
+        for attempt in range(self.max_retries + 1):
+            self.rate_limiter.wait()
+            response = self.session.get(self.base_url + path, params=params, timeout=30)
+            if response.status_code == 429 or response.status_code >= 500:
+                logger.warning('HTTP %i for "%s", attempt %i' % (response.status_code, path, attempt + 1))
+                # no point backing off after the last attempt
+                if attempt < self.max_retries:
+                    time.sleep(2 ** attempt)
+                continue
+            response.raise_for_status()
+            return response.json()
+        response.raise_for_status()
+
+    def new_submissions(self, subreddit, limit=1000):
+        """Yields the data dicts of the subreddit's newest posts, newest first. Reddit stops listing at ~1000"""
+        after = None
+        count = 0
+        while count < limit:
+            listing = self.get_json('/r/%s/new.json' % subreddit,
+                params={'limit':min(100, limit - count), 'after':after, 'raw_json':1})['data']
+            for child in listing['children'][:limit - count]:
+                yield child['data']
+                count += 1
+            after = listing['after']
+            if not after or not listing['children']:
+                return
+
+    def comments(self, post_id):
+        """Returns the post's comments as (id, body, created) tuples, flattened depth first"""
+        post_listing, comment_listing = self.get_json('/comments/%s.json' % post_id, params={'raw_json':1})
+        comments = []
+        stack = list(reversed(comment_listing['data']['children']))
+        while stack:
+            child = stack.pop()
+            # skip "load more comments" stubs, like MongoRedditStreamer does
+            if child['kind'] != 't1':
+                continue
+            comment = child['data']
+            comments.append((comment['id'], comment['body'], comment['created']))
+            replies = comment.get('replies')
+            if replies:
+                stack.extend(reversed(replies['data']['children']))
+        return comments
+
+def convert_json_to_document(post, comments):
+    """Same document as MongoRedditStreamer.convert_to_document, from a post's JSON data and its comments"""
+    return make_post_document(post['id'], post['title'], post['subreddit'].lower(),
+        post['selftext'], post['created'], comments if post['num_comments'] > 0 else None)
+
+class ConcurrentRedditIngester(object):
+    """
+    Scrapes many subreddits at once into MongoDB.
+    One thread per subreddit pages through its listing, and a pool of threads fetches comment trees.
+    All their requests share the client's rate limiter, so together they use up the allowed API rate.
+
+    client : a RedditJSONClient
+
+    collection : the pymongo collection to store posts in
+
+    workers : number of threads fetching comment trees
+
+    batch_size, flush_interval : go to PostUpsertSink
+    """
+    def __init__(self, client, collection, workers=8, batch_size=100, flush_interval=30):
+        self.client = client
+        self.workers = workers
+        self.sink = PostUpsertSink(collection, batch_size=batch_size, flush_interval=flush_interval)
+
+    def __repr__(self):
+        return 'ConcurrentRedditIngester(client={self.client}, sink={self.sink}, workers={self.workers})'.format(self=self)
+
+    def store_post(self, post):
+        """Fetch the post's comments, then queue it for upserting. A post that can't be fetched is logged & skipped"""
+        try:
+            comments = self.client.comments(post['id']) if post['num_comments'] > 0 else None
+            post_doc = convert_json_to_document(post, comments)
+        except requests.exceptions.RequestException as err:
+            logger.warning('%s for post "%s"' % (err, post.get('id')))
+            return
+        except Exception as err:
+            # eg a KeyError from unexpected JSON: skip the post, not the whole scrape
+            logger.warning('%r for post "%s"' % (err, post.get('id')))
+            return
+        self.sink.add_post(post_doc)
+
+    def scrape_subreddit(self, subreddit, comment_pool, limit):
+        """Page through the subreddit's newest posts, handing each one to comment_pool"""
+        pending = []
+        try:
+            for post in self.client.new_submissions(subreddit, limit=limit):
+                pending.append(comment_pool.apply_async(self.store_post, (post,)))
+        except requests.exceptions.RequestException as err:
+            logger.warning('%s listing subreddit "%s"' % (err, subreddit))
+        except Exception as err:
+            # eg a KeyError from an unexpected listing: keep the posts listed so far
+            logger.warning('%r listing subreddit "%s"' % (err, subreddit))
+
+        for result in pending:
+            result.get()
+        logger.info('finished subreddit "%s": %i posts' % (subreddit, len(pending)))
+        return len(pending)
+
+    def scrape(self, subreddits, limit=1000):
+        """Scrape up to limit of the newest posts from each subreddit. Returns the number of posts stored"""
+        if not subreddits:
+            logger.warning('no subreddits to scrape')
+            return 0
+        comment_pool = ThreadPool(self.workers)
+        listing_pool = ThreadPool(len(subreddits))
+        self.sink.start_timer()
+        try:
+            post_counts = listing_pool.map(lambda subreddit: self.scrape_subreddit(subreddit, comment_pool, limit), subreddits)
+        finally:
+            listing_pool.close()
+            comment_pool.close()
+            comment_pool.join()
+            self.sink.close()
+
+        logger.info('***FINISHED SCRAPING %i subreddits: added %i posts, updated %i posts, %i failed***' % (
+            len(subreddits), self.sink.added_count, self.sink.updated_count, self.sink.failed_count))
+        return sum(post_counts)
+
+if __name__ == '__main__':
+    # configured here, not on import, so modules & tests importing this one don't write a log file
+    logging.basicConfig(format='%(levelname)s %(asctime)s %(message)s',
+        level=logging.INFO,
+        filename=config.LOGFILE)
+
+    arg_parser = argparse.ArgumentParser(description='Scrapes the newest posts from many subreddits at once to MongoDB')
+    arg_parser.add_argument('--subreddits', type=str, help='comma-separated subreddit names', required=True)
+    arg_parser.add_argument('--db', type=str,
+        help='name of MongoDB database to persist posts to', default=config.DEFAULT_DB)
+    arg_parser.add_argument('--limit', type=int, help='max number of newest posts per subreddit', default=1000)
+    arg_parser.add_argument('--workers', type=int, help='number of threads fetching comments', default=8)
+    arg_parser.add_argument('--requests_per_minute', type=float, help='API rate limit, shared by all threads', default=60)
+    arg_parser.add_argument('--batch_size', type=int, help='number of posts per bulk upsert', default=100)
+    arg_parser.add_argument('--flush_interval', type=float,
+        help='max seconds a scraped post waits before being written', default=30)
+    arg_parser.add_argument('--base_url', type=str, help='reddit API url', default='https://www.reddit.com')
+
+    args = arg_parser.parse_args()
+
+    subreddits = [subreddit.strip() for subreddit in args.subreddits.split(',') if subreddit.strip()]
+    logger.info('{0}\nStarting concurrent scrape of subreddits: {1}\n{0}'.format('* ' * 12, ', '.join(subreddits)))
+
+    client = RedditJSONClient(RateLimiter(args.requests_per_minute),
+        user_agent='ubuntu:ian-scraper:v0.0.1 (by /u/ian-scraper)',
+        base_url=args.base_url, pool_size=args.workers)
+    ingester = ConcurrentRedditIngester(client, mongoclient[args.db][config.POSTS_COLLECTION], workers=args.workers,
+        batch_size=args.batch_size, flush_interval=args.flush_interval)
+
+    post_count = ingester.scrape(subreddits, limit=args.limit)
+    print 'scraped %i posts from %i subreddits' % (post_count, len(subreddits))
@@ -3,6 +3,19 @@ LOGFILE = 'scrape.log'
 DEFAULT_DB = 'reddit_test'
 POSTS_COLLECTION = 'posts'
 CORPUS_COLLECTION = 'corpora'
+SUMMARY_COLLECTION = 'summaries'
+# complaint term -> post inverted index, and the terms each subreddit was indexed with. See complaint_index.py
+COMPLAINT_INDEX_COLLECTION = 'complaint_index'
+COMPLAINT_TERMS_COLLECTION = 'complaint_terms'
+# historic scrape progress per subreddit, see backfill.ScrapeCheckpoints
+CHECKPOINT_COLLECTION = 'scrape_checkpoints'
+# cached topic summaries that haven't been used for this long are deleted by MongoDB
+SUMMARY_CACHE_TTL_DAYS = 30
+
+# trained topic models are saved under here, see TopicModeler.save_topic_model
+MODEL_DIR = 'models'
+# cached document-term matrices are saved under here, see matrix_cache.DocTermCache
+CACHE_DIR = 'cache'
 
 SEARCH_WORDS = ['shit','fuck','annoying','bullshit','junk',
 'asshole','fucker','frustrating','problem','complain','motherfucker','bitch',
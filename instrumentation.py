@@ -0,0 +1,264 @@
+# Per-stage timers & counters shared by the pipeline scripts, a periodic JSON lines dump of them
+# with throughput & ETA, and optional cProfile / tracemalloc profiling of a run
+import sys
+import json
+import time
+import pstats
+import cProfile
+from contextlib import contextmanager
+from warnings import warn
+
+try:
+    import tracemalloc
+except ImportError:
+    # only in python 3.4+
+    tracemalloc = None
+
+# stage names
+FETCH = 'fetch'
+TOKENIZE = 'tokenize'
+POS_TAG = 'pos_tag'
+FILTER = 'filter'
+WRITE = 'write'
+VECTORIZE = 'vectorize'
+NMF_FIT = 'nmf_fit'
+TRANSFORM = 'transform'
+SUMMARIZE = 'summarize'
+
+class Metrics(object):
+    """
+    Running wall time, number of timed calls and number of items for each pipeline stage, plus named counters.
+    Not thread-safe. Worker processes keep their own, see stats() and add_stats().
+
+    Eg:
+        with metrics.timer(TOKENIZE):
+            tokens = nltk.word_tokenize(text)
+    """
+    def __init__(self):
+        self.reset()
+
+    def __repr__(self):
+        return 'Metrics(stages={0})'.format(sorted(self.seconds))
+
+    def reset(self):
+        self.seconds = {}
+        self.calls = {}
+        self.items = {}
+        self.counters = {}
+        self.started_at = time.time()
+
+    def add(self, stage, seconds, items=1):
+        """Record one timed call of the stage, which handled the given number of items"""
+        self.seconds[stage] = self.seconds.get(stage, 0.0) + seconds
+        self.calls[stage] = self.calls.get(stage, 0) + 1
+        self.items[stage] = self.items.get(stage, 0) + items
+
+    @contextmanager
+    def timer(self, stage, items=1):
+        """Time the with block as one call of the stage"""
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.add(stage, time.time() - start, items)
+
+    def timed(self, stage, iterable):
+        """
+        Yields from iterable, timing each next() as one item of the stage.
+        Eg metrics.timed(FETCH, cursor) times the waits on the MongoDB cursor, not the work done with each doc.
+        """
+        iterator = iter(iterable)
+        while True:
+            start = time.time()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                self.add(stage, time.time() - start, items=0)
+                return
+            self.add(stage, time.time() - start)
+            yield item
+
+    def count(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def stats(self):
+        """The running metrics as plain dicts, eg to send back from a worker process"""
+        return {'seconds':dict(self.seconds), 'calls':dict(self.calls), 'items':dict(self.items),
+            'counters':dict(self.counters)}
+
+    def add_stats(self, stats):
+        """Fold in stats() from another Metrics, eg one that ran in a worker process"""
+        for field in ['seconds', 'calls', 'items', 'counters']:
+            totals = getattr(self, field)
+            for name, value in stats[field].iteritems():
+                totals[name] = totals.get(name, 0) + value
+
+    def snapshot(self):
+        """
+        One dict per stage, slowest stage first: total seconds, calls, items, items per second,
+        and share of the total time spent in timed stages.
+        Worker processes' stages run in parallel, so their seconds can add up to more than the wall time.
+        """
+        total_seconds = sum(self.seconds.itervalues())
+        stages = []
+        for stage, seconds in sorted(self.seconds.iteritems(), key=lambda item: -item[1]):
+            stages.append({
+                'stage': stage,
+                'seconds': seconds,
+                'calls': self.calls[stage],
+                'items': self.items[stage],
+                'items_per_sec': self.items[stage] / max(seconds, 1e-9),
+                'share': seconds / max(total_seconds, 1e-9),
+            })
+        return stages
+
+    def report(self):
+        """Print the time spent in each stage, bottleneck first"""
+        if not self.seconds:
+            print 'metrics: no stages timed'
+            return
+        print '\n%-12s %10s %10s %12s %6s' % ('stage', 'seconds', 'items', 'items/sec', 'share')
+        for stage in self.snapshot():
+            print '%-12s %10.2f %10i %12.1f %5.1f%%' % (stage['stage'], stage['seconds'], stage['items'],
+                stage['items_per_sec'], 100 * stage['share'])
+        for name, value in sorted(self.counters.iteritems()):
+            print '%s: %i' % (name, value)
+
+# shared by all the modules in a process
+metrics = Metrics()
+
+def format_eta(seconds):
+    if seconds is None:
+        return 'unknown'
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return '%i:%02i:%02i' % (hours, minutes, seconds)
+
+class ProgressReporter(object):
+    """
+    Reports progress through a run at most every interval seconds, as update() is called with the number of items done:
+    prints a progress line, and appends a JSON line with the throughput, ETA and stage metrics to path, if given.
+
+    label : name of the run, eg "preprocess"
+
+    total : number of items the run will do, for the ETA. None if unknown
+    """
+    def __init__(self, label, total=None, interval=30, path=None, metrics=metrics):
+        self.label = label
+        self.total = total
+        self.interval = interval
+        self.path = path
+        self.metrics = metrics
+        self.done_count = 0
+        self.started_at = time.time()
+        self.last_dump = self.started_at
+
+    def __repr__(self):
+        return 'ProgressReporter(label="{self.label}", total={self.total}, interval={self.interval}, path={self.path})'.format(self=self)
+
+    def update(self, done_count):
+        self.done_count = done_count
+        if time.time() - self.last_dump >= self.interval:
+            self.dump()
+
+    def record(self, final=False):
+        elapsed = time.time() - self.started_at
+        rate = self.done_count / max(elapsed, 1e-9)
+        eta = None
+        if self.total is not None and rate > 0:
+            eta = max(self.total - self.done_count, 0) / rate
+        return {
+            'time': time.time(),
+            'label': self.label,
+            'done': self.done_count,
+            'total': self.total,
+            'elapsed_seconds': elapsed,
+            'items_per_sec': rate,
+            'eta_seconds': eta,
+            'final': final,
+            'stages': self.metrics.snapshot(),
+            'counters': dict(self.metrics.counters),
+        }
+
+    def dump(self, final=False):
+        record = self.record(final)
+        self.last_dump = time.time()
+
+        slowest = record['stages'][0]['stage'] if record['stages'] else 'none'
+        print '%s: done %i out of %s, %.1f/sec, ETA %s, slowest stage: %s' % (self.label, record['done'],
+            record['total'] if record['total'] is not None else '?', record['items_per_sec'],
+            format_eta(record['eta_seconds']), slowest)
+        if self.path:
+            with open(self.path, 'a') as metrics_file:
+                metrics_file.write(json.dumps(record, sort_keys=True) + '\n')
+        return record
+
+    def finish(self, done_count=None):
+        """Dump the final record, whether or not the interval is up"""
+        if done_count is not None:
+            self.done_count = done_count
+        return self.dump(final=True)
+
+class Profiler(object):
+    """
+    Optional profiling of a whole run, eg from the CLI flags added by add_arguments().
+
+    cprofile_path : if given, cProfile the run, save the stats there (for pstats / snakeviz)
+        and print the top_n functions by cumulative time
+
+    trace_memory : if True, trace allocations with tracemalloc and print the top_n allocating lines.
+        tracemalloc needs python 3.4+, so this just warns on python 2
+    """
+    def __init__(self, cprofile_path=None, trace_memory=False, top_n=25):
+        self.cprofile_path = cprofile_path
+        self.trace_memory = trace_memory
+        self.top_n = top_n
+        self.profile = None
+
+    def __repr__(self):
+        return 'Profiler(cprofile_path={self.cprofile_path}, trace_memory={self.trace_memory})'.format(self=self)
+
+    @classmethod
+    def from_args(cls, args):
+        return cls(args.profile, args.trace_memory)
+
+    def start(self):
+        if self.trace_memory:
+            if tracemalloc is None:
+                warn('tracemalloc needs python 3.4+, not tracing memory')
+                self.trace_memory = False
+            else:
+                tracemalloc.start()
+        if self.cprofile_path:
+            self.profile = cProfile.Profile()
+            self.profile.enable()
+        return self
+
+    def stop(self):
+        if self.profile is not None:
+            self.profile.disable()
+            self.profile.dump_stats(self.cprofile_path)
+            print '\nsaved profile to %s, top %i functions by cumulative time:' % (self.cprofile_path, self.top_n)
+            pstats.Stats(self.profile, stream=sys.stdout).sort_stats('cumulative').print_stats(self.top_n)
+            self.profile = None
+        if self.trace_memory:
+            snapshot = tracemalloc.take_snapshot()
+            tracemalloc.stop()
+            print '\ntop %i lines by allocated memory:' % self.top_n
+            for stat in snapshot.statistics('lineno')[:self.top_n]:
+                print stat
+        return self
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+def add_arguments(arg_parser):
+    """Add the instrumentation flags to a script's ArgumentParser"""
+    arg_parser.add_argument('--metrics_path', type=str,
+        help='append JSON lines of stage timings, throughput and ETA to this file while running')
+    arg_parser.add_argument('--metrics_interval', type=float, help='seconds between progress reports', default=30)
+    arg_parser.add_argument('--profile', type=str, help='cProfile the run and save the stats to this file')
+    arg_parser.add_argument('--trace_memory', action='store_true', help='trace allocations with tracemalloc (python 3.4+)')
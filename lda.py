@@ -1,7 +1,9 @@
 # this is crappy, use nmf_topics.py instead.
 
 import argparse
+import itertools
 
+import numpy as np
 from gensim.models.ldamulticore import LdaMulticore
 # from gensim.models.ldamodel import LdaModel
 # from gensim.models.tfidfmodel import TfidfModel
@@ -10,15 +12,82 @@ from gensim import corpora
 import config
 from mongo_setup import mongoclient
 from process_text import PostManager
+from complaint_index import COMPLAINT_QUERY_MIXIN
+from token_corpus import TokenCorpus, load_or_export_token_corpus
+
+class MongoTokenDocs(object):
+    """
+    The postwise tokens of the subreddit's docs matching the query, as a re-iterable:
+    each pass streams them from MongoDB again, so they never all have to be in memory
+    """
+    def __init__(self, postman, find_query_mixin={}, batch_size=1000):
+        self.postman = postman
+        self.find_query_mixin = find_query_mixin
+        self.batch_size = batch_size
+        self.doc_count = None
+
+    def __repr__(self):
+        return 'MongoTokenDocs(subreddit="{self.postman.subreddit}", find_query_mixin={self.find_query_mixin})'.format(self=self)
+
+    def __len__(self):
+        if self.doc_count is None:
+            # same query as PostManager.fetch_doc_tokens
+            find_query = {'subreddit':self.postman.subreddit, 'postwise':{'$exists':True}}
+            find_query.update(self.find_query_mixin)
+            self.doc_count = self.postman.posts_read.find(find_query).count()
+        return self.doc_count
+
+    def __iter__(self):
+        return self.postman.fetch_doc_tokens('postwise', self.find_query_mixin, batch_size=self.batch_size)
+
+class StreamingBowCorpus(object):
+    """
+    Re-iterable gensim bag of words corpus over re-iterable token_docs, eg a MongoTokenDocs.
+    Each doc is converted with id2word.doc2bow as it's read, instead of keeping a list of all the docs' bows.
+    """
+    def __init__(self, token_docs, id2word):
+        self.token_docs = token_docs
+        self.id2word = id2word
+
+    def __repr__(self):
+        return 'StreamingBowCorpus(token_docs={self.token_docs})'.format(self=self)
+
+    def __len__(self):
+        return len(self.token_docs)
+
+    def __iter__(self):
+        doc2bow = self.id2word.doc2bow
+        for tokens in self.token_docs:
+            yield doc2bow(tokens)
+
+def dictionary_from_token_corpus(token_corpus):
+    """gensim Dictionary with the same ids & doc freqs as the TokenCorpus, without iterating over the docs in python"""
+    counts = token_corpus.count_matrix()
+    doc_freqs = np.bincount(counts.indices, minlength=len(token_corpus.vocabulary))
+
+    id2word = corpora.Dictionary()
+    id2word.token2id = {term:idx for idx, term in enumerate(token_corpus.vocabulary)}
+    id2word.dfs = dict(enumerate(doc_freqs.tolist()))
+    id2word.num_docs = len(token_corpus)
+    id2word.num_pos = int(counts.sum())
+    id2word.num_nnz = counts.nnz
+    return id2word
 
 class LdaProcessor(object):
     def __init__(self, token_docs, **filter_extremes_args):
         """
         token_docs : a list of lists of word or n-gram or sentence tokens.
             Eg, [['the','crazy','cat'],['that','doggone','dog']]
+            Or a token_corpus.TokenCorpus: then the Dictionary is built from its arrays,
+            and the bag of words corpus is streamed from disk instead of held in memory.
+            Or any other re-iterable of token lists, eg a MongoTokenDocs:
+            then the bag of words corpus is streamed from it on every pass.
         """
         self.token_docs = token_docs
-        self.id2word = corpora.Dictionary(token_docs)
+        if isinstance(token_docs, TokenCorpus):
+            self.id2word = dictionary_from_token_corpus(token_docs)
+        else:
+            self.id2word = corpora.Dictionary(token_docs)
         if filter_extremes_args:
             print 'filtering words with extreme frequencies'
             self.id2word.filter_extremes(**filter_extremes_args)
@@ -29,14 +98,36 @@ class LdaProcessor(object):
 
     def reset_bow_corpus(self, documents):
         """set or reset the corpus with the given documents"""
-        self.bow_corpus = [self.id2word.doc2bow(doc) for doc in documents]
+        if isinstance(documents, TokenCorpus):
+            # the filtered Dictionary has new ids, map the token corpus ids onto them
+            term_map = np.array([self.id2word.token2id.get(term, -1) for term in documents.vocabulary], dtype=np.int64)
+            self.bow_corpus = documents.bow(term_map)
+        elif isinstance(documents, list):
+            self.bow_corpus = [self.id2word.doc2bow(doc) for doc in documents]
+        else:
+            self.bow_corpus = StreamingBowCorpus(documents, self.id2word)
         return None
 
-    def train_lda(self, num_topics, **kwargs):
+    def train_lda(self, num_topics, workers=None, chunksize=2000, **kwargs):
+        """
+        workers : number of worker processes for LdaMulticore. None means one less than the number of cores
+
+        chunksize : number of docs each worker trains on at a time
+        """
         print 'training LDA...'
-        self.lda = LdaMulticore(self.bow_corpus, id2word=self.id2word, num_topics=num_topics, **kwargs)
+        self.lda = LdaMulticore(self.bow_corpus, id2word=self.id2word, num_topics=num_topics,
+            workers=workers, chunksize=chunksize, **kwargs)
         return self
 
+    def document_topics(self, bows):
+        """
+        (n_docs x num_topics) array of the topic distribution of each bag of words,
+        the same as lda.get_document_topics(bow, minimum_probability=0) for each doc,
+        but inferred for all the bows in one batch
+        """
+        gamma, _ = self.lda.inference(list(bows))
+        return gamma / gamma.sum(axis=1)[:, np.newaxis]
+
     def word_topics(self, num_words=10):
         return [topic[1] for topic in self.lda.print_topics(num_topics=self.lda.num_topics, num_words=num_words)]
 
@@ -52,18 +143,31 @@ if __name__ == '__main__':
     arg_parser.add_argument('--alpha', type=float, help='alpha hyperparameter for LDA. Low alpha means documents contain more dissimilar topics.')
     arg_parser.add_argument('--min_percent', type=float, help='Min percentage of docs that token must appear in to be included', default=0.0)
     arg_parser.add_argument('--max_percent', type=float, help='Max percentage of docs that token must appear in to be included', default=1.0)
+    arg_parser.add_argument('--token_corpus', action='store_true',
+        help='train from the compact on-disk token corpus (exported from MongoDB on the first run) instead of token lists in memory')
+    arg_parser.add_argument('--refresh_token_corpus', action='store_true',
+        help='with --token_corpus, re-export the token corpus from MongoDB')
+    arg_parser.add_argument('--cache_dir', type=str, help='dir for the token corpus', default=config.CACHE_DIR)
+    arg_parser.add_argument('--workers', type=int, help='number of LDA worker processes (default: number of cores - 1)')
+    arg_parser.add_argument('--chunksize', type=int, help='number of docs per LDA training chunk', default=2000)
+    arg_parser.add_argument('--batch_size', type=int, help='number of docs per MongoDB round trip', default=1000)
 
     args = arg_parser.parse_args()
 
     search_words = config.SEARCH_WORDS
 
-    search_words_query_mixin = {'postwise.tokens': {'$in': search_words}}
+    # docs containing any of the search words, flagged by the Preprocessor
+    search_words_query_mixin = COMPLAINT_QUERY_MIXIN
 
     postman = PostManager(mongoclient, args.subreddit)
 
     # corpus is a generator, of lists of word-tokens, for each document
-    print 'getting documents from mongo'
-    token_docs = list(postman.fetch_doc_tokens(document_level='postwise', find_query_mixin=search_words_query_mixin))
+    if args.token_corpus:
+        token_docs = load_or_export_token_corpus(postman, search_words_query_mixin,
+            cache_dir=args.cache_dir, refresh=args.refresh_token_corpus)
+    else:
+        print 'streaming documents from mongo'
+        token_docs = MongoTokenDocs(postman, search_words_query_mixin, batch_size=args.batch_size)
     print 'got %i token_docs documents' % len(token_docs)
 
     # use filtering here!!
@@ -79,9 +183,10 @@ if __name__ == '__main__':
 
     complaint_whitelist = lda_processor.id2word.doc2bow(search_words)
 
-    lda_kwargs = {lda_arg:vars(args)[lda_arg] for lda_arg in ['eta','alpha']}
+    # leave out unset hyperparameters, so LdaMulticore uses its defaults
+    lda_kwargs = {lda_arg:vars(args)[lda_arg] for lda_arg in ['eta','alpha'] if vars(args)[lda_arg] is not None}
 
-    lda_processor.train_lda(args.num_topics, **lda_kwargs)
+    lda_processor.train_lda(args.num_topics, workers=args.workers, chunksize=args.chunksize, **lda_kwargs)
 
     # make new complaint bow with re-trained id2word Dictionary
     complaint_bow = lda_processor.id2word.doc2bow(search_words)
@@ -99,4 +204,10 @@ if __name__ == '__main__':
     postman.wipe_all_topics()
 
     # save the topics for all the docs that we selected before
-    postman.save_doc_topics_LdaProcessor(lda_processor, find_query_mixin=search_words_query_mixin)
+    if isinstance(token_docs, TokenCorpus):
+        # the bows are already on disk, in the same order as the token corpus's doc _ids
+        postman.save_doc_topics_from_bow(lda_processor,
+            itertools.izip(token_docs.doc_ids, lda_processor.bow_corpus), chunk_size=args.chunksize)
+    else:
+        postman.save_doc_topics_LdaProcessor(lda_processor, find_query_mixin=search_words_query_mixin,
+            chunk_size=args.chunksize)
@@ -0,0 +1,272 @@
+# Local on-disk cache of the document-term matrix for a subreddit query,
+# so repeated topic modeling runs don't re-fetch and re-tokenize every doc from MongoDB
+import os
+import io
+import json
+import shutil
+import hashlib
+
+import numpy as np
+import scipy.sparse as sp
+from sklearn.feature_extraction.text import TfidfVectorizer, TfidfTransformer
+
+import config
+from utils import chunked
+from nmf_topics import build_vectorizer
+
+# bump this when the files written by DocTermCache.save change
+CACHE_FORMAT_VERSION = 2
+
+# TfidfVectorizer settings that are applied to the cached counts in DocTermCache.tfidf(),
+# so they aren't part of the cache key. Every other setting changes how docs are tokenized.
+TFIDF_SETTINGS = ['min_df', 'max_df', 'max_features', 'binary', 'norm', 'use_idf', 'smooth_idf', 'sublinear_tf', 'dtype']
+
+def cache_key(find_query_mixin, vectorizer_settings):
+    """Hash of the query and the tokenizing vectorizer settings"""
+    analyzer_settings = {key:val for key, val in vectorizer_settings.items() if key not in TFIDF_SETTINGS}
+    key_json = json.dumps([find_query_mixin, analyzer_settings], sort_keys=True)
+    return hashlib.sha1(key_json).hexdigest()[:12]
+
+class DocTermCache(object):
+    """
+    Caches the term count matrix of the postwise.text of docs matching a query, as CSR arrays on disk,
+    along with the vocabulary, the ordered list of doc _ids (one per matrix row) and their postwise.fingerprints.
+
+    The cache is keyed by subreddit, find_query_mixin, and the vectorizer settings that affect tokenizing.
+    Doc frequency & tf-idf settings like min_df and max_df are applied afterwards in tfidf(),
+    so experiments with different df settings or n_topics share one cache.
+
+    update() appends rows for docs added since the cache was built, replaces the rows of docs whose
+    postwise.fingerprint changed since (ie they were preprocessed again from different text),
+    and rebuilds it if docs were removed. update(rebuild=True) forces a rebuild, eg for docs without fingerprints.
+    """
+    def __init__(self, postman, find_query_mixin, vectorizer_settings, cache_dir=config.CACHE_DIR):
+        self.postman = postman
+        self.find_query_mixin = find_query_mixin
+        self.vectorizer_settings = vectorizer_settings
+        self.path = os.path.join(cache_dir, postman.subreddit, cache_key(find_query_mixin, vectorizer_settings))
+
+        self.reset()
+
+    def __repr__(self):
+        return 'DocTermCache(subreddit="{self.postman.subreddit}", find_query_mixin={self.find_query_mixin}, path="{self.path}")'.format(self=self)
+
+    def reset(self):
+        self.doc_ids = []
+        self.fingerprints = [] # postwise.fingerprint of each doc when it was cached
+        self.vocabulary = {} # term : column index
+        self.counts = sp.csr_matrix((0, 0), dtype=np.int32)
+
+    def find_query(self):
+        find_query = {'subreddit': self.postman.subreddit, 'postwise.text':{'$exists':True}}
+        find_query.update(self.find_query_mixin)
+        return find_query
+
+    def load(self):
+        """Load the cache from disk. Returns False if there's no usable cache"""
+        manifest_path = os.path.join(self.path, 'manifest.json')
+        if not os.path.exists(manifest_path):
+            return False
+        with open(manifest_path) as manifest_file:
+            manifest = json.load(manifest_file)
+        if manifest['format_version'] != CACHE_FORMAT_VERSION:
+            print 'ignoring doc-term cache with old format version %r' % manifest['format_version']
+            return False
+
+        with open(os.path.join(self.path, 'doc_ids.json')) as ids_file:
+            self.doc_ids = json.load(ids_file)
+        with open(os.path.join(self.path, 'fingerprints.json')) as fingerprints_file:
+            self.fingerprints = json.load(fingerprints_file)
+        with io.open(os.path.join(self.path, 'vocabulary.txt'), encoding='utf-8') as vocab_file:
+            self.vocabulary = {term:idx for idx, term in enumerate(vocab_file.read().splitlines())}
+
+        data, indices, indptr = [np.load(os.path.join(self.path, name + '.npy'), mmap_mode='r')
+            for name in ['data', 'indices', 'indptr']]
+        self.counts = sp.csr_matrix((data, indices, indptr), shape=(len(self.doc_ids), len(self.vocabulary)))
+        return True
+
+    def save(self):
+        """Write the cache to a temp dir, then swap it in, so a crash doesn't leave a half-written cache"""
+        tmp_path = self.path + '.tmp'
+        if os.path.exists(tmp_path):
+            shutil.rmtree(tmp_path)
+        os.makedirs(tmp_path)
+
+        for name in ['data', 'indices', 'indptr']:
+            np.save(os.path.join(tmp_path, name + '.npy'), getattr(self.counts, name))
+
+        terms = sorted(self.vocabulary, key=self.vocabulary.get)
+        with io.open(os.path.join(tmp_path, 'vocabulary.txt'), 'w', encoding='utf-8') as vocab_file:
+            for term in terms:
+                vocab_file.write(term + u'\n')
+        with open(os.path.join(tmp_path, 'doc_ids.json'), 'w') as ids_file:
+            json.dump(self.doc_ids, ids_file)
+        with open(os.path.join(tmp_path, 'fingerprints.json'), 'w') as fingerprints_file:
+            json.dump(self.fingerprints, fingerprints_file)
+
+        manifest = {
+            'format_version': CACHE_FORMAT_VERSION,
+            'subreddit': self.postman.subreddit,
+            'find_query_mixin': self.find_query_mixin,
+            'vectorizer_settings': self.vectorizer_settings,
+            'shape': self.counts.shape,
+        }
+        with open(os.path.join(tmp_path, 'manifest.json'), 'w') as manifest_file:
+            json.dump(manifest, manifest_file, indent=2, sort_keys=True)
+
+        if os.path.exists(self.path):
+            shutil.rmtree(self.path)
+        os.rename(tmp_path, self.path)
+
+    def update(self, chunk_size=2000, rebuild=False):
+        """
+        Bring the cache up to date with MongoDB: only the _ids & postwise.fingerprints of matching docs are fetched,
+        then the text of docs that aren't cached yet, or changed since, is tokenized and appended as new rows.
+
+        rebuild : if True, ignore the cache on disk and tokenize every doc again
+        """
+        if rebuild:
+            print 'rebuilding doc-term cache'
+        elif self.load():
+            print 'loaded doc-term cache with %i docs, %i terms' % self.counts.shape
+
+        current_docs = self.postman.posts_read.find(self.find_query(), {'postwise.fingerprint':True})
+        current_fingerprints = {}
+        current_ids = []
+        for doc in current_docs:
+            current_fingerprints[doc['_id']] = doc.get('postwise', {}).get('fingerprint')
+            current_ids.append(doc['_id'])
+        cached_id_set = set(self.doc_ids)
+
+        if not cached_id_set <= set(current_ids):
+            print '%i cached docs no longer match the query, rebuilding doc-term cache' % len(cached_id_set - set(current_ids))
+            self.reset()
+
+        changed_rows = [row for row, doc_id in enumerate(self.doc_ids)
+            if current_fingerprints[doc_id] != self.fingerprints[row]]
+        if changed_rows:
+            print 'replacing the rows of %i changed docs in doc-term cache' % len(changed_rows)
+            self._drop_rows(changed_rows)
+        cached_id_set = set(self.doc_ids)
+
+        new_ids = [doc_id for doc_id in current_ids if doc_id not in cached_id_set]
+        if not new_ids:
+            print 'doc-term cache is up to date'
+            return self
+
+        print 'tokenizing %i new docs for doc-term cache' % len(new_ids)
+        analyzer = TfidfVectorizer(**self.vectorizer_settings).build_analyzer()
+        new_rows = []
+        for id_chunk in chunked(new_ids, chunk_size):
+            docs = self.postman.posts_read.find({'_id':{'$in':id_chunk}}, {'postwise.text':True})
+            text_by_id = {doc['_id']:doc['postwise']['text'] for doc in docs}
+            new_rows.append(self._count_rows([text_by_id[doc_id] for doc_id in id_chunk], analyzer))
+
+        # new terms get new columns, so widen the old rows before stacking
+        n_terms = len(self.vocabulary)
+        old_counts = sp.csr_matrix((self.counts.data, self.counts.indices, self.counts.indptr),
+            shape=(self.counts.shape[0], n_terms))
+        new_rows = [sp.csr_matrix((rows.data, rows.indices, rows.indptr), shape=(rows.shape[0], n_terms))
+            for rows in new_rows]
+        self.counts = sp.vstack([old_counts] + new_rows, format='csr')
+        self.doc_ids.extend(new_ids)
+        self.fingerprints.extend(current_fingerprints[doc_id] for doc_id in new_ids)
+
+        self.save()
+        print 'doc-term cache now has %i docs, %i terms' % self.counts.shape
+        return self
+
+    def _drop_rows(self, rows):
+        """Remove the rows and their doc _ids, and any terms that only they had, like a fresh build would"""
+        keep = np.ones(len(self.doc_ids), dtype=bool)
+        keep[rows] = False
+        counts = self.counts[np.flatnonzero(keep)]
+        kept_columns = np.flatnonzero(np.bincount(counts.indices, minlength=counts.shape[1]))
+
+        terms = sorted(self.vocabulary, key=self.vocabulary.get)
+        self.vocabulary = {terms[idx]:column for column, idx in enumerate(kept_columns)}
+        self.counts = counts[:, kept_columns].tocsr()
+        self.counts.sort_indices()
+        self.doc_ids = [doc_id for doc_id, is_kept in zip(self.doc_ids, keep) if is_kept]
+        self.fingerprints = [fingerprint for fingerprint, is_kept in zip(self.fingerprints, keep) if is_kept]
+
+    def _count_rows(self, texts, analyzer):
+        """Term count rows for the texts, adding any new terms to the vocabulary"""
+        vocabulary = self.vocabulary
+        data = []
+        indices = []
+        indptr = [0]
+        for text in texts:
+            term_counts = {}
+            for term in analyzer(text):
+                idx = vocabulary.setdefault(term, len(vocabulary))
+                term_counts[idx] = term_counts.get(idx, 0) + 1
+            indices.extend(term_counts.keys())
+            data.extend(term_counts.values())
+            indptr.append(len(indices))
+
+        rows = sp.csr_matrix((np.array(data, dtype=np.int32), np.array(indices, dtype=np.int32), np.array(indptr)),
+            shape=(len(texts), len(vocabulary)))
+        rows.sort_indices()
+        return rows
+
+    def tfidf(self, vectorizer_settings=None):
+        """
+        The tf-idf matrix of the cached docs, with the doc frequency & tf-idf settings applied.
+        Returns (doc_ids, X, vectorizer), where row i of X is doc_ids[i]
+        and vectorizer is a fitted TfidfVectorizer with the same columns, to classify other docs with.
+        """
+        if vectorizer_settings is None:
+            vectorizer_settings = self.vectorizer_settings
+        terms = sorted(self.vocabulary, key=self.vocabulary.get)
+        X, vectorizer = tfidf_from_counts(self.counts, terms, vectorizer_settings)
+        return list(self.doc_ids), X, vectorizer
+
+def tfidf_from_counts(counts, terms, vectorizer_settings, keep=None):
+    """
+    Applies the doc frequency & tf-idf settings of a TfidfVectorizer to a term count matrix,
+    with the same result as fitting the vectorizer on the docs.
+    Returns (X, vectorizer), where vectorizer is a fitted TfidfVectorizer with the same columns as X.
+
+    counts : (n_docs x n_terms) sparse matrix of term counts
+    terms : list of terms, one per column of counts
+    keep : optional boolean array, one per column. Columns that are False are always dropped
+    """
+    n_docs = counts.shape[0]
+
+    if vectorizer_settings.get('binary', False):
+        counts = counts.copy()
+        counts.data = np.ones_like(counts.data)
+
+    # filter columns the same way CountVectorizer does: max_df, then min_df, then max_features
+    min_df = vectorizer_settings.get('min_df', 1)
+    max_df = vectorizer_settings.get('max_df', 1.0)
+    min_doc_count = min_df * n_docs if isinstance(min_df, float) else min_df
+    max_doc_count = max_df * n_docs if isinstance(max_df, float) else max_df
+
+    doc_freqs = np.bincount(counts.indices, minlength=counts.shape[1])
+    if keep is None:
+        keep = np.ones(counts.shape[1], dtype=bool)
+    keep = keep & (doc_freqs >= min_doc_count) & (doc_freqs <= max_doc_count)
+    kept_columns = np.flatnonzero(keep)
+
+    max_features = vectorizer_settings.get('max_features')
+    if max_features is not None and len(kept_columns) > max_features:
+        term_counts = np.asarray(counts[:, kept_columns].sum(axis=0)).ravel()
+        kept_columns = kept_columns[np.argsort(-term_counts, kind='mergesort')[:max_features]]
+
+    if len(kept_columns) == 0:
+        raise ValueError('After pruning, no terms remain. Try a lower min_df or a higher max_df.')
+
+    # sort the kept terms alphabetically, like sklearn's feature order
+    kept_columns = sorted(kept_columns, key=lambda idx: terms[idx])
+    vocabulary = [terms[idx] for idx in kept_columns]
+
+    transformer_settings = {key:vectorizer_settings[key] for key in ['norm', 'use_idf', 'smooth_idf', 'sublinear_tf']
+        if key in vectorizer_settings}
+    transformer = TfidfTransformer(**transformer_settings)
+    X = transformer.fit_transform(counts[:, kept_columns].astype(np.float64))
+
+    idf = transformer.idf_ if transformer.use_idf else np.ones(len(vocabulary))
+    vectorizer = build_vectorizer(vectorizer_settings, vocabulary, idf)
+    return X, vectorizer
@@ -1,15 +1,26 @@
+import argparse
+
 import pymongo
 import config
 import secrets
+
+def connect():
+    """
+    Returns a new MongoClient.
+    Use this in worker processes: MongoClients aren't safe to share across a fork.
+    """
+    try:
+        # if there's a MONGO_URI in secrets.py, use that URL
+        client = pymongo.MongoClient(secrets.MONGO_URI)
+        print 'connected to secret remote mongo'
+    except AttributeError:
+        # otherwise use localhost default
+        client = pymongo.MongoClient()
+        print 'connected to local MongoDB'
+    return client
+
 # This MongoClient is re-used by other scripts
-try:
-    # if there's a MONGO_URI in secrets.py, use that URL
-    mongoclient = pymongo.MongoClient(secrets.MONGO_URI)
-    print 'connected to secret remote mongo'
-except AttributeError:
-    # otherwise use localhost default
-    mongoclient = pymongo.MongoClient()
-    print 'connected to local MongoDB'
+mongoclient = connect()
 
 # convenience function for debugging
 def subreddit_counts():
@@ -21,3 +32,101 @@ def subreddit_counts():
     # print '\ncleaned posts by subreddit\n======================'
     # for sub in clean_posts.distinct('subreddit'):
     #     print '%s\t%i' % (sub, clean_posts.find({'subreddit':sub}).count())
+
+# Indexes for the PostManager access paths, as (collection name, key list, index name)
+INDEXES = [
+    # posts in a subreddit, and _id range scans over them (PostManager.id_ranges, Preprocessor.process)
+    (config.POSTS_COLLECTION, [('subreddit', pymongo.ASCENDING), ('_id', pymongo.ASCENDING)], 'subreddit_id'),
+    # docs containing any of the complaint terms (complaint_index.COMPLAINT_QUERY_MIXIN)
+    (config.POSTS_COLLECTION, [('subreddit', pymongo.ASCENDING), ('postwise.complaint_count', pymongo.ASCENDING)], 'subreddit_complaint_count'),
+    # multikey: docs containing given tokens, for complaint_index re-indexing when config.SEARCH_WORDS changes
+    (config.POSTS_COLLECTION, [('subreddit', pymongo.ASCENDING), ('postwise.tokens', pymongo.ASCENDING)], 'subreddit_tokens'),
+    # docs in a topic, most representative first (fetch_top_topic_docs), distinct topics (get_topics), merge_topics
+    (config.POSTS_COLLECTION, [('subreddit', pymongo.ASCENDING), ('postwise.topic_assignment.topic', pymongo.ASCENDING),
+        ('postwise.topic_assignment.prob', pymongo.DESCENDING)], 'subreddit_topic_prob'),
+    (config.CORPUS_COLLECTION, [('subreddit', pymongo.ASCENDING)], 'subreddit'),
+    # the complaint term -> post inverted index
+    (config.COMPLAINT_INDEX_COLLECTION, [('subreddit', pymongo.ASCENDING), ('term', pymongo.ASCENDING)], 'subreddit_term'),
+    (config.COMPLAINT_INDEX_COLLECTION, [('post_id', pymongo.ASCENDING)], 'post_id'),
+]
+
+def ensure_indexes(db):
+    """Create any missing INDEXES. Builds in the background, so the db stays usable on big collections"""
+    for collection_name, keys, name in INDEXES:
+        db[collection_name].create_index(keys, name=name, background=True)
+        print 'index "%s" on %s.%s' % (name, db.name, collection_name)
+
+def access_path_queries(db, subreddit, topic_id='0'):
+    """
+    The queries PostManager runs, as (description, collection, find_query, projection, sort) tuples.
+    Docs with a postwise.text field aren't indexed separately: that filter rides on the subreddit prefix.
+    """
+    posts = db[config.POSTS_COLLECTION]
+    return [
+        ('id_ranges', posts, {'subreddit':subreddit}, {'_id':True}, [('_id', pymongo.ASCENDING)]),
+        ('posts in subreddit', posts, {'subreddit':subreddit}, None, None),
+        ('text body docs', posts, {'subreddit':subreddit, 'postwise.text':{'$exists':True}}, {'postwise.text':True}, None),
+        ('complaint docs', posts, {'subreddit':subreddit, 'postwise.text':{'$exists':True},
+            'postwise.complaint_count':{'$gt':0}}, {'postwise.text':True}, None),
+        ('complaint term postings', db[config.COMPLAINT_INDEX_COLLECTION],
+            {'subreddit':subreddit, 'term':config.SEARCH_WORDS[0]}, {'post_id':True, '_id':False}, None),
+        ('top topic docs', posts, {'subreddit':subreddit, 'postwise.topic_assignment.topic':topic_id},
+            {'postwise.text':True}, [('postwise.topic_assignment.prob', pymongo.DESCENDING)]),
+        ('corpus', db[config.CORPUS_COLLECTION], {'subreddit':subreddit}, None, None),
+    ]
+
+def plan_stages(plan):
+    """Flattens a winning plan into a list of stage names, outermost first, like ['PROJECTION', 'IXSCAN subreddit_id']"""
+    stages = []
+    while plan:
+        stage = plan['stage']
+        if 'indexName' in plan:
+            stage += ' ' + plan['indexName']
+        stages.append(stage)
+        children = plan.get('inputStages') or [plan.get('inputStage')]
+        plan = children[0]
+    return stages
+
+def explain_report(db, subreddit, topic_id='0'):
+    """
+    Print the winning query plan of each PostManager access path, with keys & docs examined.
+    A COLLSCAN stage means the query isn't index-backed. A plan without FETCH is covered by its index.
+    """
+    print 'query plans for subreddit "%s" in db "%s"\n%s' % (subreddit, db.name, '=' * 40)
+    reports = []
+    for description, collection, find_query, projection, sort in access_path_queries(db, subreddit, topic_id):
+        cursor = collection.find(find_query, projection)
+        if sort:
+            cursor = cursor.sort(sort)
+        reports.append((description, cursor.explain()))
+
+    distinct_query = {'distinct':config.POSTS_COLLECTION, 'key':'postwise.topic_assignment.topic',
+        'query':{'subreddit':subreddit}}
+    reports.append(('distinct topics', db.command('explain', distinct_query)))
+
+    for description, explanation in reports:
+        stages = plan_stages(explanation['queryPlanner']['winningPlan'])
+        stats = explanation.get('executionStats', {})
+        print '%s\n\tplan: %s\n\treturned %s, keys examined %s, docs examined %s' % (
+            description, ' <- '.join(stages),
+            stats.get('nReturned', '?'), stats.get('totalKeysExamined', '?'), stats.get('totalDocsExamined', '?'))
+        if any(stage.startswith('COLLSCAN') for stage in stages):
+            print '\tWARNING: collection scan, run with --ensure_indexes'
+
+if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser(description='Create indexes for the PostManager queries and show their query plans')
+    arg_parser.add_argument('--db', type=str, help='name of MongoDB database', default=config.DEFAULT_DB)
+    arg_parser.add_argument('--ensure_indexes', action='store_true', help='if included, create any missing indexes')
+    arg_parser.add_argument('--explain', type=str, metavar='SUBREDDIT',
+        help='print the query plans of the PostManager queries for this subreddit')
+    arg_parser.add_argument('--topic_id', type=str, help='topic to explain the topic queries with', default='0')
+
+    args = arg_parser.parse_args()
+
+    db = mongoclient[args.db]
+    if args.ensure_indexes:
+        ensure_indexes(db)
+    if args.explain:
+        explain_report(db, args.explain, args.topic_id)
+    if not args.ensure_indexes and not args.explain:
+        subreddit_counts()
@@ -6,6 +6,7 @@ requirements = [
     'stopwords',
     'averaged_perceptron_tagger',
     'punkt',
+    'wordnet',
 ]
 
 for data_name in requirements:
@@ -1,15 +1,115 @@
+import os
+import io
+import json
+import time
+import hashlib
 import argparse
+from collections import Counter
 
+import numpy as np
+import scipy.sparse as sp
 from sklearn.feature_extraction.text import TfidfVectorizer
 from sklearn.decomposition import NMF
 
 import config
 from mongo_setup import mongoclient
 from process_text import PostManager
+from utils import chunked
+from online_nmf import OnlineNMF
+from complaint_index import COMPLAINT_QUERY_MIXIN
+import instrumentation
+from instrumentation import metrics, ProgressReporter, Profiler, VECTORIZE, NMF_FIT, TRANSFORM
+
+# bump this when the files written by TopicModeler.save_topic_model change
+MODEL_FORMAT_VERSION = 1
+
+# what a topic model's features come from:
+#   "text" : the vectorizer's analyzer run over postwise.text
+#   "tokens" : the Preprocessor's postwise.tokens, eg from a token_corpus.TokenCorpus
+MODEL_SOURCES = ['text', 'tokens']
+
+def model_key(subreddit, vectorizer_settings, n_topics, source='text'):
+    """
+    Relative path of a saved topic model: one dir per subreddit, one subdir per settings, topic count & source.
+    Models trained on text keep the key they had before the source was added.
+    """
+    if source not in MODEL_SOURCES:
+        raise ValueError('model source not understood: %r' % source)
+    settings_json = json.dumps(vectorizer_settings, sort_keys=True)
+    settings_hash = hashlib.sha1(settings_json).hexdigest()[:12]
+    suffix = '' if source == 'text' else '-' + source
+    return os.path.join(subreddit, '%s-%itopics%s' % (settings_hash, n_topics, suffix))
+
+def build_vectorizer(vectorizer_settings, vocabulary, idf):
+    """
+    Makes a fitted TfidfVectorizer without fitting it.
+    vocabulary : list of terms, in feature index order
+    idf : array of idf weights, one per term
+    """
+    vectorizer = TfidfVectorizer(**vectorizer_settings)
+    vectorizer.vocabulary_ = {term:idx for idx, term in enumerate(vocabulary)}
+
+    n_features = len(vocabulary)
+    try:
+        vectorizer.idf_ = idf
+    except AttributeError:
+        # older sklearn has no idf_ setter
+        vectorizer._tfidf._idf_diag = sp.spdiags(idf, diags=0, m=n_features, n=n_features, format='csr')
+    return vectorizer
+
+def build_nmf(components):
+    """Makes a fitted NMF without fitting it, from its (n_topics x n_features) components matrix"""
+    n_topics = components.shape[0]
+    nmf = NMF(n_components=n_topics)
+    nmf.components_ = components
+    nmf.n_components_ = n_topics
+    return nmf
+
+def fit_vocabulary(text_docs, vectorizer_settings):
+    """
+    One streaming pass over text_docs to get the vocabulary & idf weights a TfidfVectorizer would fit,
+    without holding the documents in memory. Only the document frequency of each term is kept.
+    Supports the min_df, max_df, max_features and smooth_idf settings.
+
+    Returns (vocabulary, idf, n_docs)
+    """
+    analyzer = TfidfVectorizer(**vectorizer_settings).build_analyzer()
+
+    doc_freqs = Counter()
+    n_docs = 0
+    for text in text_docs:
+        doc_freqs.update(set(analyzer(text)))
+        n_docs += 1
+
+    # float df settings are proportions of docs, ints are doc counts, same as sklearn
+    min_df = vectorizer_settings.get('min_df', 1)
+    max_df = vectorizer_settings.get('max_df', 1.0)
+    min_doc_count = min_df * n_docs if isinstance(min_df, float) else min_df
+    max_doc_count = max_df * n_docs if isinstance(max_df, float) else max_df
+
+    terms = [term for term, df in doc_freqs.iteritems() if min_doc_count <= df <= max_doc_count]
+    max_features = vectorizer_settings.get('max_features')
+    if max_features is not None:
+        # unlike sklearn, which ranks by total term count, rank by doc freq
+        terms = sorted(terms, key=lambda term: doc_freqs[term], reverse=True)[:max_features]
+    vocabulary = sorted(terms)
+
+    df = np.array([doc_freqs[term] for term in vocabulary], dtype=np.float64)
+    if vectorizer_settings.get('smooth_idf', True):
+        idf = np.log((1.0 + n_docs) / (1.0 + df)) + 1.0
+    else:
+        idf = np.log(n_docs / df) + 1.0
+
+    return vocabulary, idf, n_docs
 
 class TopicModeler(object):
     def __init__(self, postman):
         self.postman = postman
+        # the training matrix & its doc _ids (one per row), kept around for split_topic
+        self.X = None
+        self.doc_ids = None
+        # see MODEL_SOURCES. A "tokens" model can't classify docs from their postwise.text
+        self.source = 'text'
 
     def print_top_words(self, n_top_words=20, show_vals=False):
         for topic_idx, topic_words in enumerate(self.word_values()):
@@ -28,7 +128,8 @@ class TopicModeler(object):
 
         return all_words
 
-    def train_topic_model(self, text_docs, n_topics, vectorizer_settings=dict(stop_words='english', max_df=0.06, min_df=0.02)):
+    def train_topic_model(self, text_docs, n_topics, vectorizer_settings=dict(stop_words='english', max_df=0.06, min_df=0.02),
+        doc_ids=None):
         """
         Train a tfidf => NMF topic model
 
@@ -36,65 +137,355 @@ class TopicModeler(object):
 
         n_topics : int
             The number of topics to classify the given documents into
+
+        doc_ids : optional list of the text_docs' _ids.
+            If given, the tf-idf matrix is kept so split_topic can reuse its rows.
         """
         print 'generating tf-idf matrix'
-        self.vectorizer = TfidfVectorizer(**vectorizer_settings)
+        vectorizer = TfidfVectorizer(**vectorizer_settings)
+
+        with metrics.timer(VECTORIZE, len(text_docs)):
+            X = vectorizer.fit_transform(text_docs)
 
-        X = self.vectorizer.fit_transform(text_docs)
+        return self.train_topic_model_from_matrix(X, vectorizer, n_topics, vectorizer_settings, doc_ids=doc_ids)
+
+    def train_topic_model_from_matrix(self, X, vectorizer, n_topics, vectorizer_settings, doc_ids=None, source='text'):
+        """
+        Train NMF on an already vectorized tf-idf matrix, eg from matrix_cache.DocTermCache.tfidf()
+
+        vectorizer : the fitted TfidfVectorizer that made X
+
+        doc_ids : optional list of _ids, one per row of X.
+            If given, X is kept so split_topic can reuse its rows.
+
+        source : "tokens" if X was made from postwise.tokens (eg token_corpus.TokenCorpus.tfidf()), see MODEL_SOURCES
+        """
+        self.vectorizer_settings = vectorizer_settings
+        self.vectorizer = vectorizer
+        self.source = source
+        if doc_ids is not None:
+            self.X = X
+            self.doc_ids = doc_ids
 
         print 'running NMF'
-        self.nmf = NMF(n_components=n_topics).fit(X)
+        with metrics.timer(NMF_FIT, X.shape[0]):
+            self.nmf = NMF(n_components=n_topics).fit(X)
+
+        return self
+
+    def train_topic_model_streaming(self, text_docs_factory, n_topics,
+        vectorizer_settings=dict(stop_words='english', max_df=0.06, min_df=0.02), batch_size=1000, n_passes=1):
+        """
+        Train a tfidf => NMF topic model without loading all the documents into memory.
+        Makes one pass over the docs to fix the vocabulary & idf weights,
+        then n_passes more to fit an OnlineNMF one batch of batch_size docs at a time.
+
+        text_docs_factory : function that returns a new iterable of text docs each time it's called,
+            eg lambda: (text for _, text in postman.fetch_doc_text_body('postwise'))
+
+        n_topics : int
+            The number of topics to classify the given documents into
+        """
+        print 'fitting vocabulary'
+        with metrics.timer(VECTORIZE, 0):
+            vocabulary, idf, n_docs = fit_vocabulary(text_docs_factory(), vectorizer_settings)
+        print 'got %i terms from %i docs' % (len(vocabulary), n_docs)
+
+        self.vectorizer_settings = vectorizer_settings
+        self.vectorizer = build_vectorizer(vectorizer_settings, vocabulary, idf)
+
+        online_nmf = OnlineNMF(n_components=n_topics, n_features=len(vocabulary))
+        for pass_idx in range(n_passes):
+            print 'running online NMF, pass %i of %i' % (pass_idx + 1, n_passes)
+            for text_batch in chunked(text_docs_factory(), batch_size):
+                with metrics.timer(VECTORIZE, len(text_batch)):
+                    X_batch = self.vectorizer.transform(text_batch)
+                with metrics.timer(NMF_FIT, len(text_batch)):
+                    online_nmf.partial_fit(X_batch)
+
+        # classify docs with sklearn's NMF transform, same as a model from train_topic_model
+        self.nmf = build_nmf(online_nmf.components_)
 
         return self
 
+    def model_path(self, n_topics, vectorizer_settings, model_dir=config.MODEL_DIR, source='text'):
+        return os.path.join(model_dir, model_key(self.postman.subreddit, vectorizer_settings, n_topics, source))
+
+    def save_topic_model(self, model_dir=config.MODEL_DIR):
+        """
+        Save the trained vectorizer & NMF, so a later run can classify docs without retraining.
+        Writes the vocabulary as text and the idf vector & NMF components as .npy files,
+        plus a manifest.json, to a dir keyed by subreddit, vectorizer settings, n_topics & source.
+        Returns the dir path.
+        """
+        components = self.nmf.components_
+        path = self.model_path(components.shape[0], self.vectorizer_settings, model_dir, self.source)
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+        vocabulary = self.vectorizer.get_feature_names()
+        with io.open(os.path.join(path, 'vocabulary.txt'), 'w', encoding='utf-8') as vocab_file:
+            for term in vocabulary:
+                vocab_file.write(term + u'\n')
+        np.save(os.path.join(path, 'idf.npy'), self.vectorizer.idf_)
+        np.save(os.path.join(path, 'components.npy'), components)
+
+        manifest = {
+            'format_version': MODEL_FORMAT_VERSION,
+            'subreddit': self.postman.subreddit,
+            'vectorizer_settings': self.vectorizer_settings,
+            'source': self.source,
+            'n_topics': components.shape[0],
+            'n_features': len(vocabulary),
+            'saved_at': time.time(),
+        }
+        with open(os.path.join(path, 'manifest.json'), 'w') as manifest_file:
+            json.dump(manifest, manifest_file, indent=2, sort_keys=True)
+
+        print 'saved topic model to %s' % path
+        return path
+
+    def load_topic_model(self, n_topics, vectorizer_settings, model_dir=config.MODEL_DIR, source='text'):
+        """
+        Load a topic model saved by save_topic_model with the same subreddit, vectorizer settings, n_topics & source.
+        The NMF components are memory-mapped, not read into memory.
+
+        source : "tokens" to load a model trained on the token corpus, see MODEL_SOURCES
+        """
+        path = self.model_path(n_topics, vectorizer_settings, model_dir, source)
+        with open(os.path.join(path, 'manifest.json')) as manifest_file:
+            manifest = json.load(manifest_file)
+        if manifest['format_version'] != MODEL_FORMAT_VERSION:
+            raise ValueError('topic model at %s has format version %r, expected %r' % (
+                path, manifest['format_version'], MODEL_FORMAT_VERSION))
+        # manifests from before the source was recorded are all text models
+        if manifest.get('source', 'text') != source:
+            raise ValueError('topic model at %s was trained on %s, expected %s' % (
+                path, manifest.get('source', 'text'), source))
+
+        with io.open(os.path.join(path, 'vocabulary.txt'), encoding='utf-8') as vocab_file:
+            vocabulary = vocab_file.read().splitlines()
+        idf = np.load(os.path.join(path, 'idf.npy'))
+        components = np.load(os.path.join(path, 'components.npy'), mmap_mode='r')
+
+        self.vectorizer_settings = vectorizer_settings
+        self.vectorizer = build_vectorizer(vectorizer_settings, vocabulary, idf)
+        self.nmf = build_nmf(components)
+        self.source = source
+
+        print 'loaded %i-topic model from %s' % (n_topics, path)
+        return self
+
+    def topic_rows(self, topic_id):
+        """
+        Returns (doc_ids, X) for the docs currently assigned to topic_id,
+        slicing their rows out of the kept training matrix. Only the _ids are fetched from MongoDB.
+        """
+        topic_query = {'subreddit':self.postman.subreddit, 'postwise.topic_assignment.topic':topic_id}
+        topic_doc_ids = set(doc['_id'] for doc in self.postman.posts_read.find(topic_query, {'_id':True}))
+
+        rows = [row for row, doc_id in enumerate(self.doc_ids) if doc_id in topic_doc_ids]
+        if len(rows) < len(topic_doc_ids):
+            print 'warning: %i docs in topic "%s" aren\'t in the training matrix, leaving them out' % (
+                len(topic_doc_ids) - len(rows), topic_id)
+
+        return [self.doc_ids[row] for row in rows], self.X[rows]
+
     def split_topic(self, topic_id, n_subtopics):
         """
         If you're splitting a topic into subtopics:
             -select only docs with postwise.topic_assignment.topic == parent_topic_id
             -prepend the parent topic_id to get topics like "3.0", "3.1", "3.2", using a topic_id_namer
+
+        Uses the parent's tf-idf rows if the training matrix was kept (see train_topic_model's doc_ids),
+        otherwise fetches the topic's docs and vectorizes them with the parent's vectorizer.
+        Returns a TopicModeler for the subtopics, which can be split again.
         """
         print 'Splitting topic "%s" into %i subtopics' % (topic_id, n_subtopics)
 
-        topic_id_mixin = {'postwise.topic_assignment.topic':topic_id}
+        if self.X is not None:
+            doc_ids, X = self.topic_rows(topic_id)
+        elif self.source != 'text':
+            raise ValueError('the model was trained on %s, so the topic\'s docs can\'t be vectorized from their text. '
+                'Set X & doc_ids from the token corpus, see token_corpus.TokenCorpus.transform' % self.source)
+        else:
+            topic_id_mixin = {'postwise.topic_assignment.topic':topic_id}
+            doc_id_text_generator = self.postman.fetch_doc_text_body(document_level='postwise', find_query_mixin=topic_id_mixin)
+            doc_ids, text_docs = [], []
+            for doc_id, text_body in doc_id_text_generator:
+                doc_ids.append(doc_id)
+                text_docs.append(text_body)
+            X = self.vectorizer.transform(text_docs)
 
-        doc_id_text_generator = postman.fetch_doc_text_body(document_level='postwise', find_query_mixin=topic_id_mixin)
-        text_docs = [text_body for doc_id, text_body in doc_id_text_generator]
+        if len(doc_ids) < n_subtopics:
+            raise ValueError('topic "%s" has %i docs, can\'t split it into %i subtopics' % (topic_id, len(doc_ids), n_subtopics))
 
-        nmf, vectorizer = train_topic_model(text_docs, n_topics=n_subtopics)
+        subtopic_modeler = TopicModeler(self.postman).train_topic_model_from_matrix(X, self.vectorizer,
+            n_topics=n_subtopics, vectorizer_settings=self.vectorizer_settings, doc_ids=doc_ids, source=self.source)
 
-        self.postman.save_doc_topics_Sklearn(nmf, vectorizer, find_query_mixin=topic_id_mixin,
+        self.postman.save_doc_topics_from_matrix(subtopic_modeler, doc_ids, X,
             topic_id_namer=lambda int_id: '.'.join((topic_id, str(int_id))) )
 
         print 'split completed'
-        self.print_top_words()
+        subtopic_modeler.print_top_words()
+        return subtopic_modeler
 
 if __name__ == '__main__':
     arg_parser = argparse.ArgumentParser(description='Generates keywords or sentences for queried documents in subreddit')
     arg_parser.add_argument('--subreddit', type=str, help='subreddit name (or "all" to get all posts', required=True)
-    arg_parser.add_argument('--n_topics', type=int, help='number of topics for NMF', required=True)
+    arg_parser.add_argument('--n_topics', type=int, help='number of topics for NMF. Required unless sweeping')
     arg_parser.add_argument('--min_df', type=float, help='min doc freq for words', required=True)
     arg_parser.add_argument('--max_df', type=float, help='max doc freq for words', required=True)
+    arg_parser.add_argument('--model_dir', type=str, help='dir to save & load trained topic models', default=config.MODEL_DIR)
+    arg_parser.add_argument('--load_model', action='store_true',
+        help='classify docs with a previously saved model with the same settings, instead of training one')
+    arg_parser.add_argument('--streaming', action='store_true',
+        help='train on batches of docs streamed from MongoDB, instead of loading them all into memory')
+    arg_parser.add_argument('--batch_size', type=int, help='number of docs per NMF batch with --streaming', default=1000)
+    arg_parser.add_argument('--cache', action='store_true',
+        help='use the local doc-term matrix cache, only fetching & tokenizing docs that are new since the last run')
+    arg_parser.add_argument('--cache_dir', type=str, help='dir for the doc-term matrix cache', default=config.CACHE_DIR)
+    arg_parser.add_argument('--rebuild_cache', action='store_true',
+        help='with --cache, re-tokenize every doc instead of updating the cached doc-term matrix')
+    arg_parser.add_argument('--token_corpus', action='store_true',
+        help='train on the preprocessed tokens in the compact on-disk token corpus, instead of the text in MongoDB')
+    arg_parser.add_argument('--refresh_token_corpus', action='store_true',
+        help='with --token_corpus, re-export the token corpus from MongoDB')
+    arg_parser.add_argument('--split_topic', type=str,
+        help='split this topic of the saved model into subtopics, instead of training & assigning topics')
+    arg_parser.add_argument('--n_subtopics', type=int, help='number of subtopics for --split_topic', default=2)
+    arg_parser.add_argument('--sweep_n_topics', type=int, nargs='+',
+        help='sweep mode: fit every combination of these topic counts & the sweep df settings, then keep the most coherent')
+    arg_parser.add_argument('--sweep_min_df', type=float, nargs='+', help='min doc freqs to sweep. Default: --min_df')
+    arg_parser.add_argument('--sweep_max_df', type=float, nargs='+', help='max doc freqs to sweep. Default: --max_df')
+    arg_parser.add_argument('--sweep_report', type=str, help='save the sweep results to this JSON file')
+    arg_parser.add_argument('--workers', type=int, help='number of processes to fit sweep models with', default=1)
+    instrumentation.add_arguments(arg_parser)
 
     args = arg_parser.parse_args()
+    if args.n_topics is None and not args.sweep_n_topics:
+        arg_parser.error('--n_topics is required, unless sweeping with --sweep_n_topics')
+    profiler = Profiler.from_args(args).start()
+    progress = ProgressReporter('nmf_topics', path=args.metrics_path)
 
     postman = PostManager(mongoclient, args.subreddit)
     topic_modeler = TopicModeler(postman)
 
-    print 'fetching docs containing SEARCH_WORDS'
-    search_words = config.SEARCH_WORDS
-    query_mixin = {'postwise.tokens': {'$in': search_words}}
-
-    doc_id_text_generator = postman.fetch_doc_text_body(document_level='postwise', find_query_mixin=query_mixin)
-    doc_dict = {doc_id:text_body for doc_id, text_body in doc_id_text_generator}
+    # docs containing any of config.SEARCH_WORDS, flagged by the Preprocessor
+    query_mixin = COMPLAINT_QUERY_MIXIN
 
     vectorizer_settings = dict(stop_words='english', max_df=args.max_df, min_df=args.min_df)
+    # models trained on the token corpus are saved, loaded & applied separately from text models
+    model_source = 'tokens' if args.token_corpus else 'text'
+
+    if args.sweep_n_topics:
+        # imported here, since topic_sweep imports this module
+        from topic_sweep import TopicSweep, sweep_counts
+        source = 'cache' if args.cache else 'token_corpus' if args.token_corpus else 'mongo'
+        doc_ids, counts, terms, keep = sweep_counts(postman, query_mixin, vectorizer_settings, source=source,
+            cache_dir=args.cache_dir, refresh_token_corpus=args.refresh_token_corpus, rebuild_cache=args.rebuild_cache)
+
+        sweep = TopicSweep(doc_ids, counts, terms, vectorizer_settings, keep=keep, workers=args.workers,
+            source='tokens' if source == 'token_corpus' else 'text')
+        sweep.run(args.sweep_n_topics, args.sweep_min_df or [args.min_df], args.sweep_max_df or [args.max_df])
+        if args.sweep_report:
+            sweep.save_report(args.sweep_report)
+        else:
+            sweep.report()
+
+        # only the chosen configuration is saved & assigned
+        topic_modeler, doc_ids, X = sweep.best_topic_modeler(postman)
+        topic_modeler.save_topic_model(model_dir=args.model_dir)
+        topic_modeler.print_top_words()
+
+        print 'wiping all topics...'
+        postman.wipe_all_topics()
+        print 'persisting topics...'
+        postman.save_doc_topics_from_matrix(topic_modeler, doc_ids, X)
+    elif args.split_topic is not None:
+        topic_modeler.load_topic_model(args.n_topics, vectorizer_settings, model_dir=args.model_dir, source=model_source)
+        if args.token_corpus:
+            # imported here, since token_corpus imports this module via matrix_cache
+            from token_corpus import load_or_export_token_corpus
+            token_corpus = load_or_export_token_corpus(postman, query_mixin,
+                cache_dir=args.cache_dir, refresh=args.refresh_token_corpus)
+            topic_modeler.X = token_corpus.transform(topic_modeler.vectorizer)
+            topic_modeler.doc_ids = list(token_corpus.doc_ids)
+        elif args.cache:
+            # reuse the cached rows, if they were vectorized the same way as the saved model.
+            # imported here, since matrix_cache imports this module
+            from matrix_cache import DocTermCache
+            cache = DocTermCache(postman, query_mixin, vectorizer_settings, cache_dir=args.cache_dir).update(
+                rebuild=args.rebuild_cache)
+            doc_ids, X, vectorizer = cache.tfidf()
+            if (vectorizer.get_feature_names() == topic_modeler.vectorizer.get_feature_names()
+                and np.allclose(vectorizer.idf_, topic_modeler.vectorizer.idf_)):
+                topic_modeler.X = X
+                topic_modeler.doc_ids = doc_ids
+            else:
+                print 'doc-term cache doesn\'t match the saved model, vectorizing the topic\'s docs instead'
+
+        topic_modeler.split_topic(args.split_topic, args.n_subtopics)
+    else:
+        doc_ids = None
+        if args.load_model:
+            topic_modeler.load_topic_model(args.n_topics, vectorizer_settings, model_dir=args.model_dir, source=model_source)
+            if args.token_corpus:
+                # a tokens model classifies the token corpus rows, not postwise.text
+                from token_corpus import load_or_export_token_corpus
+                token_corpus = load_or_export_token_corpus(postman, query_mixin,
+                    cache_dir=args.cache_dir, refresh=args.refresh_token_corpus)
+                doc_ids, X = list(token_corpus.doc_ids), token_corpus.transform(topic_modeler.vectorizer)
+        elif args.cache:
+            # imported here, since matrix_cache imports this module
+            from matrix_cache import DocTermCache
+            cache = DocTermCache(postman, query_mixin, vectorizer_settings, cache_dir=args.cache_dir).update(
+                rebuild=args.rebuild_cache)
+            doc_ids, X, vectorizer = cache.tfidf()
+
+            topic_modeler.train_topic_model_from_matrix(X, vectorizer,
+                n_topics=args.n_topics, vectorizer_settings=vectorizer_settings)
+            topic_modeler.save_topic_model(model_dir=args.model_dir)
+        elif args.token_corpus:
+            # imported here, since token_corpus imports this module via matrix_cache
+            from token_corpus import load_or_export_token_corpus
+            token_corpus = load_or_export_token_corpus(postman, query_mixin,
+                cache_dir=args.cache_dir, refresh=args.refresh_token_corpus)
+            doc_ids, X, vectorizer = token_corpus.tfidf(vectorizer_settings)
+
+            topic_modeler.train_topic_model_from_matrix(X, vectorizer,
+                n_topics=args.n_topics, vectorizer_settings=vectorizer_settings, source='tokens')
+            topic_modeler.save_topic_model(model_dir=args.model_dir)
+        elif args.streaming:
+            print 'streaming docs containing SEARCH_WORDS'
+            text_docs_factory = lambda: (text_body for doc_id, text_body in
+                postman.fetch_doc_text_body(document_level='postwise', find_query_mixin=query_mixin))
+
+            topic_modeler.train_topic_model_streaming(text_docs_factory,
+                n_topics=args.n_topics, vectorizer_settings=vectorizer_settings, batch_size=args.batch_size)
+            topic_modeler.save_topic_model(model_dir=args.model_dir)
+        else:
+            print 'fetching docs containing SEARCH_WORDS'
+            doc_id_text_generator = postman.fetch_doc_text_body(document_level='postwise', find_query_mixin=query_mixin)
+            doc_dict = {doc_id:text_body for doc_id, text_body in doc_id_text_generator}
+
+            topic_modeler.train_topic_model(doc_dict.values(),
+                n_topics=args.n_topics, vectorizer_settings=vectorizer_settings)
+            topic_modeler.save_topic_model(model_dir=args.model_dir)
 
-    topic_modeler.train_topic_model(doc_dict.values(),
-        n_topics=args.n_topics, vectorizer_settings=vectorizer_settings)
+        topic_modeler.print_top_words()
 
-    topic_modeler.print_top_words()
+        print 'wiping all topics...'
+        postman.wipe_all_topics()
+        print 'persisting topics...'
+        if doc_ids is not None:
+            # classify the cached rows, no need to re-fetch the docs.
+            # a model trained on the token corpus has to be: its features are tokens, not postwise text
+            postman.save_doc_topics_from_matrix(topic_modeler, doc_ids, X)
+        else:
+            postman.save_doc_topics(topic_modeler, find_query_mixin=query_mixin)
 
-    print 'wiping all topics...'
-    postman.wipe_all_topics()
-    print 'persisting topics...'
-    postman.save_doc_topics(topic_modeler, find_query_mixin=query_mixin)
+    profiler.stop()
+    # done = docs classified
+    progress.finish(metrics.items.get(TRANSFORM, 0))
+    metrics.report()
@@ -0,0 +1,82 @@
+# Mini-batch NMF, for fitting topic models on corpora that don't fit in memory
+import numpy as np
+
+class OnlineNMF(object):
+    """
+    Online NMF: fits the components (topics) one mini-batch of documents at a time,
+    with multiplicative updates. Adapted from Mairal et al. 2010, "Online Learning for Matrix Factorization
+    and Sparse Coding", with the dictionary update done by multiplicative updates to keep it non-negative.
+
+    Memory use depends on the batch size and n_components x n_features, not on the number of documents.
+    Instead of the documents, it keeps running sums of W^T W (n_components x n_components)
+    and W^T X (n_components x n_features) over all the batches seen so far.
+
+    n_components : number of topics
+
+    n_features : number of columns in each batch, eg len(vectorizer.vocabulary_)
+
+    decay : each partial_fit multiplies the running sums by this before adding the new batch,
+        so the first batches (fit with a poor early guess of the components) count for less.
+        1.0 means no forgetting.
+
+    inner_iter : number of multiplicative update iterations per batch
+    """
+    def __init__(self, n_components, n_features, decay=0.95, inner_iter=20, random_state=None):
+        self.n_components = n_components
+        self.n_features = n_features
+        self.decay = decay
+        self.inner_iter = inner_iter
+        self.random = np.random.RandomState(random_state)
+
+        self.components_ = None
+        self.A = np.zeros((n_components, n_components))
+        self.B = np.zeros((n_components, n_features))
+        self.n_batches = 0
+
+    def __repr__(self):
+        return 'OnlineNMF(n_components={self.n_components}, n_features={self.n_features}, decay={self.decay}, inner_iter={self.inner_iter})'.format(self=self)
+
+    def _init_components(self, X):
+        # same scaling as sklearn's NMF random init
+        scale = np.sqrt(X.mean() / self.n_components)
+        self.components_ = scale * self.random.rand(self.n_components, self.n_features)
+
+    def _solve_w(self, X, n_iter):
+        """Non-negative least squares for the doc-topic weights W, holding the components fixed"""
+        H = self.components_
+        HHt = H.dot(H.T)
+        XHt = np.asarray(X.dot(H.T))
+
+        W = self.random.rand(X.shape[0], self.n_components) * np.sqrt(X.mean() / self.n_components)
+        for _ in range(n_iter):
+            W *= XHt / (W.dot(HHt) + 1e-10)
+        return W
+
+    def partial_fit(self, X):
+        """
+        Update the components with a batch of documents. X : (n_docs, n_features) matrix, sparse or dense.
+        Batches before the first one with any nonzero values are skipped
+        """
+        if X.shape[0] == 0:
+            return self
+        if self.components_ is None:
+            if X.sum() == 0:
+                # components scaled by an all-zero batch start at 0, and multiplicative updates can't move them off it
+                return self
+            self._init_components(X)
+
+        W = self._solve_w(X, self.inner_iter)
+
+        self.A = self.decay * self.A + W.T.dot(W)
+        self.B = self.decay * self.B + np.asarray(X.T.dot(W)).T
+
+        H = self.components_
+        for _ in range(self.inner_iter):
+            H *= self.B / (self.A.dot(H) + 1e-10)
+
+        self.n_batches += 1
+        return self
+
+    def transform(self, X):
+        """Doc-topic weights for X, using the fitted components"""
+        return self._solve_w(X, 10 * self.inner_iter)
@@ -2,14 +2,25 @@
 # Load reddit posts from MongoDB, preprocess, and add fields of cleaned tokens to each post document
 import re
 import string
+import hashlib
 import argparse
-import random
+import copy
+import multiprocessing
 from warnings import warn
 
 import config
-from mongo_setup import mongoclient
-
+from mongo_setup import mongoclient, connect
+from bulk_writer import BulkWriter
+from utils import chunked
+from complaint_index import ComplaintIndex
+import instrumentation
+from instrumentation import metrics, ProgressReporter, Profiler, FETCH, TOKENIZE, POS_TAG, FILTER, WRITE, VECTORIZE, TRANSFORM
+
+import numpy as np
+import pymongo
 import nltk
+from pymongo import UpdateOne
+from nltk.tag.perceptron import PerceptronTagger
 from nltk.stem.porter import PorterStemmer
 from nltk.stem.lancaster import LancasterStemmer
 
@@ -40,61 +51,137 @@ class PostManager(object):
     def __repr__(self):
         return 'Postmanager(mongoclient={self.mongoclient}, subreddit="{self.subreddit}", read_db="{self.read_db}", write_db="{self.write_db}")'.format(self=self)
 
-    def fetch_doc_tokens(self, document_level, find_query_mixin={}):
+    def id_ranges(self, n_ranges):
+        """
+        Splits the subreddit's posts into n_ranges contiguous _id ranges of roughly equal size.
+        Returns a list of (lower, upper) _id bounds. lower is inclusive, upper is exclusive,
+        and the upper bound of the last range is None (unbounded).
+        Each bound is found by skipping along the (subreddit, _id) index, so the _ids aren't all fetched.
+        """
+        subreddit_query = {'subreddit':self.subreddit}
+        post_count = self.posts_read.find(subreddit_query).count()
+        if not post_count:
+            return []
+
+        range_len = max(1, -(-post_count // n_ranges)) # ceiling division
+        lower_bounds = []
+        for skip in range(0, post_count, range_len):
+            cursor = self.posts_read.find(subreddit_query, {'_id':True}).sort('_id', 1).skip(skip).limit(1)
+            lower_bounds.extend(doc['_id'] for doc in cursor)
+        upper_bounds = lower_bounds[1:] + [None]
+        return zip(lower_bounds, upper_bounds)
+
+    def id_range_query(self, lower, upper):
+        """Find query for the subreddit's posts with lower <= _id < upper (upper=None means unbounded)"""
+        id_query = {'$gte':lower}
+        if upper is not None:
+            id_query['$lt'] = upper
+        return {'subreddit':self.subreddit, '_id':id_query}
+
+    def fetch_doc_tokens(self, document_level, find_query_mixin={}, projection=None, batch_size=1000):
         """
         Generator which yields tokens for the docs which have been processed and tokenized
 
-        required_tokens :
-            An optional list of strings
+        projection : fields to fetch. Default: just the tokens, not the raw text & comments
+
+        batch_size : number of docs per cursor round trip
         """
         if document_level != 'postwise':
             raise NotImplementedError('document_level:%s' % document_level)
 
         query = {'subreddit':self.subreddit, document_level:{'$exists':True}}
         query.update(find_query_mixin)
+        if projection is None:
+            projection = {document_level + '.tokens':True, '_id':False}
 
-        for doc in self.posts_read.find(query):
+        for doc in metrics.timed(FETCH, self.posts_read.find(query, projection).batch_size(batch_size)):
             try:
                 yield doc[document_level]['tokens']
             except KeyError:
                 # XXX: this shouldn't happen...
                 print 'woop, doc missing %s.tokens' % document_level
 
-    def fetch_doc_text_body(self, document_level, find_query_mixin={}):
-        """Yields (_id, text_body) for all docs with a concatenated text body field."""
+    def fetch_doc_text_body(self, document_level, find_query_mixin={}, projection=None, batch_size=1000, count=False):
+        """
+        Yields (_id, text_body) for all docs with a concatenated text body field.
+
+        projection : fields to fetch. Default: just the text body, not the raw text & comments
+
+        batch_size : number of docs per cursor round trip
+
+        count : if True, print the number of matching docs first (an extra query)
+        """
         find_query = {'subreddit': self.subreddit, 'postwise.text':{'$exists':True}}
         find_query.update(find_query_mixin)
 
         if document_level != 'postwise':
             raise NotImplementedError('document_level:%s' % document_level)
+        if projection is None:
+            projection = {document_level + '.text':True}
 
-        print 'found %i matching the query for text body docs' % self.posts_read.find(find_query).count()
+        if count:
+            print 'found %i matching the query for text body docs' % self.posts_read.find(find_query).count()
 
-        for doc in self.posts_read.find(find_query):
+        for doc in metrics.timed(FETCH, self.posts_read.find(find_query, projection).batch_size(batch_size)):
             yield doc['_id'], doc[document_level]['text']
 
-    # XXX: Deprecated!
-    # def save_doc_topics_LdaProcessor(self, lda_processor, find_query_mixin={}):
-    #     """
-    #     Uses the trained LDA model in the LdaProcessor to classify all documents in the subreddit,
-    #     or all documents returned by the find_query_mixin query dict
-    #     """
-    #     # XXX: assumes postwise document_level
-    #
-    #     # add/modify user-specified key:vals to the find_query
-    #     find_query = {'subreddit': self.subreddit, 'postwise.tokens':{'$exists':True}}
-    #     find_query.update(find_query_mixin)
-    #
-    #     doc_count = 0
-    #     warn('Unlike save_doc_topics_Sklearn which stores topics as strings, save_doc_topics_LdaProcessor stores topics as ints.\nAlso, there is no "postwise.topic_assignment" field')
-    #     for doc in self.posts_read.find(find_query):
-    #         tokens = doc['postwise']['tokens']
-    #         doc_bow = lda_processor.id2word.doc2bow(tokens)
-    #         topic_distros = lda_processor.lda.get_document_topics(doc_bow, minimum_probability=0)
-    #         topic_dicts = [{'topic_id':topic_id, 'prob':prob} for topic_id, prob in topic_distros]
-    #         self.posts_write.update({'_id':doc['_id']},{'$set':{'postwise.topic_distro':topic_dicts}}, upsert=True)
-    #         doc_count += 1
-    #     print 'Saved topic distros for %i documents' % doc_count
+    def fetch_top_topic_docs(self, topic_id, limit=0, batch_size=100):
+        """
+        Yields (_id, text_body) for the docs assigned to topic_id, most representative first
+        (highest postwise.topic_assignment.prob). The sort happens on the server and only the text is fetched.
+
+        limit : max number of docs to yield. 0 means no limit
+        """
+        find_query = {'subreddit':self.subreddit, 'postwise.topic_assignment.topic':topic_id}
+        cursor = (self.posts_read.find(find_query, {'postwise.text':True})
+            .sort('postwise.topic_assignment.prob', pymongo.DESCENDING)
+            .limit(limit)
+            .batch_size(batch_size))
+
+        for doc in metrics.timed(FETCH, cursor):
+            yield doc['_id'], doc['postwise']['text']
+
+    def save_doc_topics_LdaProcessor(self, lda_processor, find_query_mixin={}, topic_id_namer=str,
+        chunk_size=2000, write_batch_size=1000, distro_min_prob=0.01):
+        """
+        Uses the trained LDA model in the LdaProcessor to classify all documents in the subreddit,
+        or all documents returned by the find_query_mixin query dict.
+        The docs' tokens are streamed from MongoDB, see save_doc_topics_from_bow for the fields written.
+        """
+        # XXX: assumes postwise document_level
+        find_query = {'subreddit': self.subreddit, 'postwise.tokens':{'$exists':True}}
+        find_query.update(find_query_mixin)
+
+        id2word = lda_processor.id2word
+        cursor = self.posts_read.find(find_query, {'postwise.tokens':True}).batch_size(chunk_size)
+        doc_id_bows = ((doc['_id'], id2word.doc2bow(doc['postwise']['tokens'])) for doc in metrics.timed(FETCH, cursor))
+        self.save_doc_topics_from_bow(lda_processor, doc_id_bows, topic_id_namer=topic_id_namer,
+            chunk_size=chunk_size, write_batch_size=write_batch_size, distro_min_prob=distro_min_prob)
+
+    def save_doc_topics_from_bow(self, lda_processor, doc_id_bows, topic_id_namer=str,
+        chunk_size=2000, write_batch_size=1000, distro_min_prob=0.01):
+        """
+        Classifies docs with the LdaProcessor's trained LDA model, one chunk of chunk_size docs at a time.
+        Like save_doc_topics, each doc's strongest topic goes in postwise.topic_assignment,
+        and its topic distribution goes in postwise.topic_distro, leaving out topics below distro_min_prob.
+
+        doc_id_bows : iterable of (doc _id, bag of words) pairs,
+            eg zip(token_corpus.doc_ids, lda_processor.bow_corpus)
+        """
+        writer = BulkWriter(self.posts_write, batch_size=write_batch_size)
+
+        doc_count = 0
+        for chunk in chunked(doc_id_bows, chunk_size):
+            doc_ids, bows = zip(*chunk)
+            with metrics.timer(TRANSFORM, len(chunk)):
+                topic_distros = lda_processor.document_topics(bows)
+            self.save_topic_assignments(doc_ids, topic_distros, writer, topic_id_namer, distro_min_prob=distro_min_prob)
+            doc_count += len(chunk)
+
+        with metrics.timer(WRITE, 0):
+            writer.flush()
+        print 'Saved topic distros for %i documents' % doc_count
+        writer.report()
 
     def merge_topics(self, topic_ids):
         """
@@ -117,14 +204,22 @@ class PostManager(object):
 
         print 'merged %i documents into "%s"' % (result['nModified'], new_topic_id)
 
-    def save_doc_topics(self, topic_modeler, find_query_mixin={}, topic_id_namer=str):
+    def save_doc_topics(self, topic_modeler, find_query_mixin={}, topic_id_namer=str,
+        chunk_size=2000, write_batch_size=1000):
         """
         Uses the trained TopicModeler to assign
         all docs in the find query to their "strongest" single topic.
 
         topic_id_namer(int_id) : function which takes an int and maps it to a name.
             Default topic_id_namer is str, so you get: "0", "1", ... N. (Strings)
+
+        chunk_size : number of docs to vectorize & classify at once, as a single sparse matrix
+
+        write_batch_size : number of topic assignments per MongoDB bulk write
         """
+        if topic_modeler.source != 'text':
+            raise ValueError('the topic model was trained on %s, it can\'t classify docs from their postwise.text. '
+                'Use save_doc_topics_from_matrix' % topic_modeler.source)
         nmf = topic_modeler.nmf
         vectorizer = topic_modeler.vectorizer
         # only update docs that are the current subreddit,
@@ -132,43 +227,62 @@ class PostManager(object):
         find_query = {'subreddit': self.subreddit, 'postwise.tokens':{'$exists':True}}
         find_query.update(find_query_mixin)
 
+        cursor = self.posts_read.find(find_query, {'postwise.text':True}).batch_size(chunk_size)
+        writer = BulkWriter(self.posts_write, batch_size=write_batch_size)
+
         doc_count = 0
-        for doc in self.posts_read.find(find_query):
-            text_body = doc['postwise']['text']
-
-            # Make a dict topic_id:topic_prob, where topic_id is determined by topic_id_namer function
-            topic_distros = nmf.transform(vectorizer.transform([text_body]))[0]
-            topic_dict = {topic_id_namer(topic_id):prob for topic_id, prob in enumerate(topic_distros)}
-
-            # assign each doc to its most probable topic. In case of a tie, chose a random one.
-            # buffer_val allows small variation between two topics to count as a tie,
-            # eg 0.0323423 is close enough to 0.0323487
-            #
-            # individal prob values will shrink as number of topics grow,
-            # so the buffer should also shrink as number of topics grow.
-            buffer_val = 0.001/(len(topic_distros))
-            strongest_topics = [topic_id for topic_id, prob in topic_dict.items()
-                if (max(topic_distros) - prob < buffer_val)]
-
-            topic_assignment = random.choice(strongest_topics)
-
-            # DEBUG: introspect the docs with multiple topics
-            # if len(strongest_topics) != 1:
-            #     print 'DEBUG: Got ambigious topic, choosing randomly.'
-            #     print buffer_val
-            #     print topic_distros
-            #     print strongest_topics
-            #     print topic_assignment
-
-            # self.posts_write.update({'_id':doc['_id']},{'$set':{'postwise.topic_distro':topic_dict, 'postwise.topic_assignment':{'topic':topic_assignment,'prob':topic_dict[topic_assignment]}}}, upsert=True)
-            #
-            # ^ actually, don't persist the topic_distro. Just the assignment.
-            self.posts_write.update({'_id':doc['_id']},{'$set':{
-                'postwise.topic_assignment':{
-                    'topic':topic_assignment,'prob':topic_dict[topic_assignment]}}}, upsert=True)
-
-            doc_count += 1
+        for docs in chunked(metrics.timed(FETCH, cursor), chunk_size):
+            doc_ids = [doc['_id'] for doc in docs]
+            with metrics.timer(VECTORIZE, len(docs)):
+                X = vectorizer.transform([doc['postwise']['text'] for doc in docs])
+            with metrics.timer(TRANSFORM, len(docs)):
+                topic_distros = nmf.transform(X)
+            self.save_topic_assignments(doc_ids, topic_distros, writer, topic_id_namer)
+            doc_count += len(docs)
+
+        with metrics.timer(WRITE, 0):
+            writer.flush()
         print 'Saved topic distros for %i documents' % doc_count
+        writer.report()
+
+    def save_doc_topics_from_matrix(self, topic_modeler, doc_ids, X, topic_id_namer=str,
+        chunk_size=2000, write_batch_size=1000):
+        """
+        Like save_doc_topics, but classifies the rows of an already vectorized doc-term matrix
+        (eg from matrix_cache.DocTermCache) instead of fetching and vectorizing docs from MongoDB.
+
+        doc_ids : list of doc _ids, one per row of X
+        """
+        writer = BulkWriter(self.posts_write, batch_size=write_batch_size)
+
+        for start in range(0, len(doc_ids), chunk_size):
+            with metrics.timer(TRANSFORM, len(doc_ids[start:start + chunk_size])):
+                topic_distros = topic_modeler.nmf.transform(X[start:start + chunk_size])
+            self.save_topic_assignments(doc_ids[start:start + chunk_size], topic_distros, writer, topic_id_namer)
+
+        with metrics.timer(WRITE, 0):
+            writer.flush()
+        print 'Saved topic distros for %i documents' % len(doc_ids)
+        writer.report()
+
+    def save_topic_assignments(self, doc_ids, topic_distros, writer, topic_id_namer=str, distro_min_prob=None):
+        """
+        Queue up a postwise.topic_assignment update in the BulkWriter for each doc,
+        using the doc's strongest topic in the topic_distros matrix (one row per doc in doc_ids).
+
+        distro_min_prob : if given, also save the doc's topics with at least this prob
+            as a postwise.topic_distro list of {'topic_id':..., 'prob':...}
+        """
+        topic_idxs, topic_probs = strongest_topics(topic_distros)
+
+        # by default, don't persist the whole topic_distro, just the assignment.
+        with metrics.timer(WRITE, len(doc_ids)):
+            for doc_idx, (doc_id, topic_idx, prob) in enumerate(zip(doc_ids, topic_idxs, topic_probs)):
+                update = {'postwise.topic_assignment':{'topic':topic_id_namer(int(topic_idx)), 'prob':float(prob)}}
+                if distro_min_prob is not None:
+                    update['postwise.topic_distro'] = [{'topic_id':topic_id_namer(int(distro_idx)), 'prob':float(distro_prob)}
+                        for distro_idx, distro_prob in enumerate(topic_distros[doc_idx]) if distro_prob >= distro_min_prob]
+                writer.add(UpdateOne({'_id':doc_id}, {'$set':update}, upsert=True))
 
     def wipe_all_topics(self):
         """
@@ -242,6 +356,39 @@ class PostManager(object):
     #         yield '\n'.join(comments)
 
 
+# a single character class, optionally repeated, eg r'[^a-zA-Z\- ]' or r'[0-9]+'
+CHAR_CLASS_PATTERN = re.compile(r'^\[\^?\]?(?:[^\]\\]|\\.)*\][+*]?$')
+
+def is_char_class_pattern(pattern):
+    """True if the regex pattern string is a single character class, see Preprocessor.clean_words"""
+    return bool(CHAR_CLASS_PATTERN.match(pattern))
+
+def strongest_topics(topic_distros):
+    """
+    Picks the most probable topic for each row (doc) of the topic_distros matrix.
+    In case of a tie, choose a random one.
+
+    Returns a (topic_idxs, topic_probs) pair of arrays, with an entry per row.
+    """
+    topic_distros = np.asarray(topic_distros)
+    n_docs, n_topics = topic_distros.shape
+
+    # buffer_val allows small variation between two topics to count as a tie,
+    # eg 0.0323423 is close enough to 0.0323487
+    #
+    # individal prob values will shrink as number of topics grow,
+    # so the buffer should also shrink as number of topics grow.
+    buffer_val = 0.001/n_topics
+    max_probs = topic_distros.max(axis=1)
+    is_strongest = (max_probs[:, np.newaxis] - topic_distros) < buffer_val
+
+    # give each of the strongest topics a random score and take the best one,
+    # which is a uniform random choice between the tied topics
+    tie_breakers = np.where(is_strongest, np.random.random_sample(topic_distros.shape), -1)
+    topic_idxs = tie_breakers.argmax(axis=1)
+
+    return topic_idxs, topic_distros[np.arange(n_docs), topic_idxs]
+
 def each_comment_from_post(post):
     """
     Yields each individual comment in a post.
@@ -254,6 +401,19 @@ def each_comment_from_post(post):
     for comment in post['comments']:
         yield comment['text']
 
+def text_fingerprint(text):
+    """Content hash of a document's text, used to tell whether a post changed since it was last preprocessed"""
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+def callback_name(callback):
+    """Stable name for a function or bound method (unlike its repr, which has a memory address)"""
+    if callback is None:
+        return None
+    owner = getattr(callback, '__self__', None)
+    if owner is not None:
+        return '%s.%s' % (type(owner).__name__, callback.__name__)
+    return getattr(callback, '__name__', repr(callback))
+
 def all_comments_from_post(post, prepend_title=True):
     """
     Concatenates all a posts's comments together and returns the result
@@ -287,7 +447,7 @@ class Preprocessor(object):
     min_word_len & max_word_len : thresholds for word length (no. characters).
         Words with lengths outside these bounds will be dropped.
 
-    stopwords : list of words to exclude
+    stopwords : collection of words to exclude (stored as a frozenset)
 
     allowed_pos_tags : list of Part of Speech (POS) tags to include.
         If None, all tags are included
@@ -299,10 +459,27 @@ class Preprocessor(object):
         EG:
             nltk.stem.lancaster.LancasterStemmer().stem
             nltk.stem.WordNetLemmatizer().lemmatize
+
+    write_batch_size : number of postwise updates to buffer before sending them to MongoDB in one bulk_write
+
+    read_batch_size : number of posts per cursor round trip when reading posts
+
+    complaint_terms : terms to flag in each post's tokens, see complaint_index.ComplaintIndex.
+        Changing them doesn't change the settings_hash: run complaint_index.py instead of re-tokenizing
+
+    incremental : if True, skip posts whose text and preprocessor settings haven't changed
+        since they were last preprocessed, and add to the persisted corpus instead of replacing it.
+        Each post's postwise field stores a "fingerprint" of its text and the "settings_hash" used.
+
+    progress_interval : seconds between progress reports while processing, see instrumentation.ProgressReporter
+
+    metrics_path : if given, the progress reports are also appended to this file as JSON lines
     """
     def __init__(self, postman, document_level, min_doc_wordcount=0, max_doc_wordcount=float('inf'),
         min_word_len=float('-inf'), max_word_len=float('inf'), stopwords=nltk.corpus.stopwords.words('english'),
-        allowed_pos_tags=None, stem_or_lemma_callback=None, filter_pattern=r'[^a-zA-Z\- ]'):
+        allowed_pos_tags=None, stem_or_lemma_callback=None, filter_pattern=r'[^a-zA-Z\- ]', write_batch_size=1000,
+        read_batch_size=500, complaint_terms=config.SEARCH_WORDS, incremental=False,
+        progress_interval=30, metrics_path=None):
 
         # Assign text_generator function depending on document_level
         if document_level not in ['commentwise', 'postwise']:
@@ -315,30 +492,142 @@ class Preprocessor(object):
         self.max_doc_wordcount = max_doc_wordcount
         self.min_word_len = min_word_len
         self.max_word_len = max_word_len
-        self.stopwords = stopwords
-        self.allowed_pos_tags = allowed_pos_tags
+        # sets, for O(1) membership tests on every token
+        self.stopwords = frozenset(stopwords)
+        self.allowed_pos_tags = frozenset(allowed_pos_tags) if allowed_pos_tags is not None else None
         self.stem_or_lemma_callback = stem_or_lemma_callback
         # pattern to replace characters in each word
         # default: remove all non-alpha characters except for hyphen and space
         self.filter_pattern = re.compile(filter_pattern)
+        # clean_words() joins words with this before running filter_pattern,
+        # so it has to survive the pattern. None means clean word by word.
+        self.clean_separator = None
+        if is_char_class_pattern(filter_pattern):
+            self.clean_separator = next((sep for sep in [u' ', u'\n', u'\x00']
+                if self.filter_pattern.sub(u'', sep) == sep), None)
 
         self.corpus = set() #this set holds all the words in the documents
+        # NLTK models are loaded once by load_models(), not on every post
+        self.tagger = None
+        # postwise updates are buffered here. Call flush() after the last preprocess_post()
+        self.writer = BulkWriter(self.postman.posts_write, batch_size=write_batch_size)
+        self.read_batch_size = read_batch_size
+        self.complaint_index = ComplaintIndex(self.postman, complaint_terms, write_batch_size=write_batch_size)
+
+        self.incremental = incremental
+        self.skipped_count = 0 # unchanged posts skipped in incremental mode
+        self.settings_hash = self.compute_settings_hash()
+
+        self.progress_interval = progress_interval
+        self.metrics_path = metrics_path
 
     def __repr__(self):
         return 'Preprocessor(document_level="{self.document_level}", min_doc_wordcount={self.min_doc_wordcount}, max_doc_wordcount={self.max_doc_wordcount}, min_word_len={self.min_word_len}, max_word_len={self.max_word_len}, stopwords=stopwords, allowed_pos_tags={self.allowed_pos_tags}, stem_or_lemma_callback={self.stem_or_lemma_callback}), filter_pattern=r"{self.filter_pattern}"'.format(self=self)
 
-    def valid_word(self, word, pos_tag=None):
-        """Evaluates all the conditions that determine whether to keep or discard a word"""
-        return (
-            word not in self.stopwords
-            and (self.max_word_len > len(word) > self.min_word_len)
-            and (pos_tag==None or self.allowed_pos_tags==None or pos_tag not in self.allowed_pos_tags)
+    def compute_settings_hash(self):
+        """Hash of all the settings that affect a post's tokens"""
+        settings = (
+            self.document_level,
+            self.min_doc_wordcount, self.max_doc_wordcount,
+            self.min_word_len, self.max_word_len,
+            sorted(self.stopwords),
+            sorted(self.allowed_pos_tags) if self.allowed_pos_tags is not None else None,
+            callback_name(self.stem_or_lemma_callback),
+            self.filter_pattern.pattern,
         )
+        return hashlib.sha1(repr(settings)).hexdigest()
+
+    def is_unchanged(self, post, fingerprint):
+        """True if the post was already preprocessed from the same text with the same settings"""
+        postwise = post.get('postwise', {})
+        return (postwise.get('fingerprint') == fingerprint
+            and postwise.get('settings_hash') == self.settings_hash)
+
+    def read_posts(self, find_query):
+        """
+        Iterable of the posts to preprocess. When the updates go to the db the posts are read from,
+        only the fields preprocess_post() reads are fetched, not the comments' dates & ids.
+        Otherwise whole posts are fetched, since they get copied over to the write db,
+        and their postwise field is swapped for the one in the write db, see with_stored_postwise()
+        """
+        if self.postman.read_db == self.postman.write_db:
+            projection = {'title':True, 'text':True, 'comments.text':True,
+                'postwise.fingerprint':True, 'postwise.settings_hash':True, 'postwise.complaint_count':True}
+            return self.postman.posts_read.find(find_query, projection).batch_size(self.read_batch_size)
+        cursor = self.postman.posts_read.find(find_query).batch_size(self.read_batch_size)
+        return self.with_stored_postwise(cursor)
+
+    def with_stored_postwise(self, posts):
+        """
+        Yields the posts with their postwise field replaced by the fingerprint, settings_hash & complaint_count
+        last written to the write db (or no postwise field, if there's none there),
+        since that's what incremental runs and the complaint index compare against.
+        Looked up one batch of posts at a time.
+        """
+        for post_batch in chunked(posts, self.read_batch_size):
+            stored_docs = self.postman.posts_write.find(
+                {'_id':{'$in':[post['_id'] for post in post_batch]}, 'postwise':{'$exists':True}},
+                {'postwise.fingerprint':True, 'postwise.settings_hash':True, 'postwise.complaint_count':True})
+            stored = {doc['_id']:doc['postwise'] for doc in stored_docs}
+            for post in post_batch:
+                post.pop('postwise', None)
+                if post['_id'] in stored:
+                    post['postwise'] = stored[post['_id']]
+                yield post
+
+    def load_models(self):
+        """
+        Load the NLTK POS tagger.
+        nltk.pos_tag unpickles a fresh tagger on every call, so keep one around instead.
+        """
+        if self.tagger is None:
+            self.tagger = PerceptronTagger()
+        return self
 
     def clean_word(self, word):
         """Lowercase word and remove junk characters using self.filter_pattern"""
         return self.filter_pattern.sub(u'', word.lower())
 
+    def clean_words(self, words):
+        """
+        clean_word() for a list of words, in a single lower() and filter_pattern pass over the joined words.
+        Only used when filter_pattern is a single character class like the default, which matches one character
+        at a time and so can't match across the separator. Other patterns (eg anchored ones like "^-+")
+        are cleaned word by word, as is everything if the separator is in a word or gets eaten by the pattern.
+        """
+        sep = self.clean_separator
+        if sep is not None and words:
+            joined = sep.join(words)
+            if joined.count(sep) == len(words) - 1:
+                cleaned = self.filter_pattern.sub(u'', joined.lower()).split(sep)
+                if len(cleaned) == len(words):
+                    return cleaned
+        return [self.clean_word(word) for word in words]
+
+    def filter_tokens(self, tokens):
+        """
+        Filter stage for a tokenized document: drops tokens with a POS tag in allowed_pos_tags (if given),
+        stopwords, and words outside the length limits, then cleans the rest with clean_words() and drops empty words.
+        Only POS tags the tokens if there's a POS filter.
+        benchmarks/token_filter.py checks it against the original word-by-word filter.
+        """
+        if self.allowed_pos_tags is not None:
+            allowed_pos_tags = self.allowed_pos_tags
+            with metrics.timer(POS_TAG):
+                tagged = self.load_models().tagger.tag(tokens)
+            tokens = [word for word, pos_tag in tagged if pos_tag not in allowed_pos_tags]
+
+        with metrics.timer(FILTER):
+            stopwords = self.stopwords
+            min_word_len = self.min_word_len
+            max_word_len = self.max_word_len
+            kept = [word for word in tokens
+                if word not in stopwords and max_word_len > len(word) > min_word_len]
+
+            # things like digits and other junk become empty string,
+            # so exclude them from final document
+            return [word for word in self.clean_words(kept) if word]
+
     def preprocess_post(self, post):
         """
         Tokenize words in raw-text document bodies
@@ -355,27 +644,46 @@ class Preprocessor(object):
             if doc_text == '':
                 return []
 
-            tokens = nltk.word_tokenize(doc_text)
-            # TODO: skip this if there's no POS filtering args!
-            tagged = nltk.pos_tag(tokens)
-
-            # filter out most invalid words with valid_word()
-            processed_document = []
-            for word, pos_tag in tagged:
-                if self.valid_word(word, pos_tag):
-                    cleaned_word = self.clean_word(word)
-                    # things like digits and other junk become empty string,
-                    # so exclude them from final document
-                    if cleaned_word:
-                        processed_document.append(cleaned_word)
+            fingerprint = text_fingerprint(doc_text)
+            if self.incremental and self.is_unchanged(post, fingerprint):
+                # its words are already in the persisted corpus
+                self.skipped_count += 1
+                return []
+
+            with metrics.timer(TOKENIZE):
+                tokens = nltk.word_tokenize(doc_text)
+            # POS tag (only if there's a POS filter), then filter & clean the tokens
+            processed_document = self.filter_tokens(tokens)
+
+            # postings are only made along with postwise.complaint_count, so a post without one has none
+            previous_count = post.get('postwise', {}).get('complaint_count', 0)
+
             # finally, update the post
-            post['postwise'] = {'tokens': processed_document, 'text': doc_text}
-            self.postman.posts_write.update_one({'_id':post['_id']}, {'$set':post}, upsert=True)
+            post['postwise'] = {'tokens': processed_document, 'text': doc_text,
+                'fingerprint': fingerprint, 'settings_hash': self.settings_hash}
+            # queueing the updates includes the bulk writes whenever a batch fills up
+            with metrics.timer(WRITE):
+                post['postwise'].update(self.complaint_index.postwise_fields(post['_id'], processed_document,
+                    previous_count))
+                if self.postman.read_db == self.postman.write_db:
+                    # the post is already in the write db, so only send the new field
+                    update = {'postwise': post['postwise']}
+                else:
+                    # copy the whole post over to the write db
+                    update = post
+                self.writer.add(UpdateOne({'_id':post['_id']}, {'$set':update}, upsert=True))
         else:
             raise NotImplementedError('document_level: "%s"' % self.document_level)
 
         return processed_document
 
+    def flush(self):
+        """Write any buffered postwise & complaint index updates to MongoDB"""
+        with metrics.timer(WRITE, 0):
+            self.writer.flush()
+            self.complaint_index.flush()
+        return self
+
     # def doc_has_valid_wc(self, document):
     #     """
     #     Returns True if document length is withing the specified bounds.
@@ -393,39 +701,82 @@ class Preprocessor(object):
         return [self.stem_or_lemma_callback(word) for word in document]
 
     def persist_corpus(self):
-        """Delete existing corpus (set of unique words) and make a new one."""
+        """
+        Delete existing corpus (set of unique words) and make a new one.
+        In incremental mode, add the new words to the existing corpus instead,
+        as long as it was made with the same preprocessor settings.
+        Otherwise the corpus is rebuilt from the stored tokens of every post, since posts preprocessed
+        with the current settings by an earlier, interrupted run were skipped and aren't in self.corpus.
+        """
         subreddit = self.postman.subreddit
         corpus_coll = self.postman.corpus_write
         subreddit_query = {'subreddit':subreddit}
 
+        if self.incremental:
+            existing = corpus_coll.find_one(subreddit_query, {'settings_hash':True})
+            if existing and existing.get('settings_hash') == self.settings_hash:
+                corpus_coll.update_one({'_id':existing['_id']},
+                    {'$addToSet':{'corpus':{'$each':list(self.corpus)}}})
+                print 'added %i words to existing corpus' % len(self.corpus)
+                return self
+            print 'no corpus with matching settings, rebuilding it from the stored tokens'
+            self.corpus = self.stored_corpus()
+
         preexisting_corpora = corpus_coll.find(subreddit_query).count()
         print 'deleting %i existing corpora for subreddit' % preexisting_corpora
         corpus_coll.delete_many(subreddit_query)
 
-        result = corpus_coll.insert_one({'subreddit':subreddit, 'corpus':list(self.corpus)})
+        result = corpus_coll.insert_one({'subreddit':subreddit, 'corpus':list(self.corpus),
+            'settings_hash':self.settings_hash})
         print 'persisted corpus of length %i' % (len(self.corpus))
 
         # chaining
         return self
 
-    def process(self):
+    def stored_corpus(self):
+        """Set of the words in the postwise tokens in the write db of the posts preprocessed with the current settings"""
+        find_query = {'subreddit':self.postman.subreddit, 'postwise.settings_hash':self.settings_hash}
+        cursor = self.postman.posts_write.find(find_query, {'postwise.tokens':True}).batch_size(self.read_batch_size)
+        corpus = set()
+        for post in metrics.timed(FETCH, cursor):
+            corpus.update(post['postwise']['tokens'])
+        return corpus
+
+    def process(self, workers=1):
         """
         Master function for preprocessing documents.
         Reads from postman.posts_read and outputs to postman.posts_write
+
+        workers : number of processes to preprocess with.
+            With workers > 1, the subreddit's posts are split into _id ranges
+            and each range is tokenized in a separate process.
         """
         # tokenize, then filter & otherwise process words in each document
         # using steps in preprocess_doc()
-
         all_posts_count = self.postman.posts_read.find({'subreddit': self.postman.subreddit}).count()
+        progress = ProgressReporter('preprocess', total=all_posts_count,
+            interval=self.progress_interval, path=self.metrics_path)
 
-        for post_idx, post in enumerate(self.postman.posts_read.find({'subreddit': self.postman.subreddit})):
-            # preprocess the post and add the new words to the corpus
-            new_words = self.preprocess_post(post)
-            self.corpus.update(new_words)
-
-            # print on every Nth post so you know it's alive
-            if post_idx % 100 == 0:
-                print 'done post %i out of %i' % (post_idx, all_posts_count)
+        if workers > 1:
+            self.process_parallel(workers, progress=progress)
+        else:
+            posts = metrics.timed(FETCH, self.read_posts({'subreddit': self.postman.subreddit}))
+            for post_idx, post in enumerate(posts):
+                # preprocess the post and add the new words to the corpus
+                new_words = self.preprocess_post(post)
+                self.corpus.update(new_words)
+                progress.update(post_idx + 1)
+            self.flush()
+
+        metrics.count('skipped_posts', self.skipped_count)
+        progress.finish()
+        self.writer.report()
+        if self.incremental:
+            print 'skipped %i unchanged posts' % self.skipped_count
+            # skipped posts may have been indexed with other complaint terms
+            self.complaint_index.reindex()
+        else:
+            self.complaint_index.save_terms()
 
         #TODO:
         print 'word count and other corpus-level filters not implemented, skipping...'
@@ -441,12 +792,91 @@ class Preprocessor(object):
 
         return self
 
+    def process_parallel(self, workers, ranges_per_worker=4, progress=None):
+        """
+        Preprocess the subreddit's posts in a pool of worker processes.
+        Each worker gets its own MongoClient and NLTK models, then tokenizes one _id range at a time.
+        The postwise fields and the corpus come out the same as a serial process() run.
+
+        ranges_per_worker : split the posts into workers * ranges_per_worker _id ranges,
+            so a worker that finishes early can pick up more work.
+
+        progress : optional instrumentation.ProgressReporter, updated as each range is done.
+            The workers' stage metrics are added to the shared instrumentation.metrics
+        """
+        id_ranges = self.postman.id_ranges(workers * ranges_per_worker)
+        print 'preprocessing %i _id ranges with %i workers' % (len(id_ranges), workers)
+
+        pool = multiprocessing.Pool(workers, initializer=_init_worker, initargs=(self,))
+        try:
+            done_posts = 0
+            for new_words, post_count, skipped_count, writer_stats, metrics_stats in pool.imap_unordered(_process_id_range, id_ranges):
+                self.corpus.update(new_words)
+                self.skipped_count += skipped_count
+                self.writer.add_stats(writer_stats)
+                metrics.add_stats(metrics_stats)
+                done_posts += post_count
+                if progress is not None:
+                    progress.update(done_posts)
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+
+        return self
+
+# Each worker process in Preprocessor.process_parallel keeps its own Preprocessor here
+_worker_prepro = None
+
+def _init_worker(prepro):
+    """
+    Pool initializer for Preprocessor.process_parallel.
+    MongoClients aren't fork-safe, so the worker's Preprocessor gets a new PostManager with its own client.
+    """
+    global _worker_prepro
+    postman = prepro.postman
+
+    _worker_prepro = copy.copy(prepro)
+    _worker_prepro.postman = PostManager(connect(), postman.subreddit, postman.read_db, postman.write_db)
+    _worker_prepro.corpus = set()
+    _worker_prepro.complaint_index = ComplaintIndex(_worker_prepro.postman, prepro.complaint_index.terms,
+        write_batch_size=prepro.complaint_index.writer.batch_size)
+    _worker_prepro.load_models()
+    # don't count the parent's metrics from before the fork
+    metrics.reset()
+
+def _process_id_range(id_range):
+    """
+    Preprocess all the posts in a single (lower, upper) _id range.
+    Returns (words, post_count, skipped_count, writer_stats, metrics_stats), where the stats cover just this range.
+    """
+    lower, upper = id_range
+    postman = _worker_prepro.postman
+    _worker_prepro.skipped_count = 0
+    _worker_prepro.writer = BulkWriter(postman.posts_write, batch_size=_worker_prepro.writer.batch_size)
+    metrics.reset()
+
+    words = set()
+    post_count = 0
+    for post in metrics.timed(FETCH, _worker_prepro.read_posts(postman.id_range_query(lower, upper))):
+        words.update(_worker_prepro.preprocess_post(post))
+        post_count += 1
+    _worker_prepro.flush()
+    return words, post_count, _worker_prepro.skipped_count, _worker_prepro.writer.stats(), metrics.stats()
+
 if __name__ == "__main__":
     arg_parser = argparse.ArgumentParser(description='Scrapes then streams posts from given subreddit to MongoDB')
     arg_parser.add_argument('--subreddit', type=str, help='subreddit name (or "all" to get all posts', required=True)
     arg_parser.add_argument('--read_db', type=str, help='name of MongoDB database to read raw posts from')
     arg_parser.add_argument('--write_db', type=str, help='name of MongoDB database to persist posts to')
     arg_parser.add_argument('--min_comments', type=int, help='minimum number of comments for each post', default=0)
+    arg_parser.add_argument('--workers', type=int, help='number of processes to preprocess posts with', default=1)
+    arg_parser.add_argument('--batch_size', type=int, help='number of post updates per MongoDB bulk write', default=1000)
+    arg_parser.add_argument('--incremental', action='store_true',
+        help='only tokenize posts that are new or changed since the last run, and add to the existing corpus')
+    instrumentation.add_arguments(arg_parser)
     args = arg_parser.parse_args()
 
     postman = PostManager(mongoclient, args.subreddit, args.read_db, args.write_db)
@@ -461,7 +891,11 @@ if __name__ == "__main__":
 
     prepro = Preprocessor(postman, document_level='postwise', min_doc_wordcount=40,
         min_word_len=3, max_word_len=20, stopwords=stopwords,
-        allowed_pos_tags=allowed_pos_tags, stem_or_lemma_callback=None, filter_pattern=r'[^a-zA-Z\- ]')
+        allowed_pos_tags=allowed_pos_tags, stem_or_lemma_callback=None, filter_pattern=r'[^a-zA-Z\- ]',
+        write_batch_size=args.batch_size, incremental=args.incremental,
+        progress_interval=args.metrics_interval, metrics_path=args.metrics_path)
 
     # process the raw text and persist to corpus to Mongo
-    prepro.process().persist_corpus()
+    with Profiler.from_args(args):
+        prepro.process(workers=args.workers).persist_corpus()
+    metrics.report()
@@ -13,15 +13,61 @@ from praw.handlers import MultiprocessHandler
 
 import config
 from mongo_setup import mongoclient
+from bulk_writer import PostUpsertSink
 import secrets
 # document conversion adapted from
 # https://gist.github.com/ludar/fe29455bcd121bb79cf9
 
-logging.basicConfig(format='%(levelname)s %(asctime)s %(message)s',
-    level=logging.DEBUG,
-    filename=config.LOGFILE)
 logger = logging.getLogger(__name__)
 
+def make_post_document(post_id, title, subreddit, text, created, comments):
+    """
+    Builds the MongoDB document for a post. Shared by every scraper, so they all store the same schema.
+
+    created : post creation timestamp
+    comments : list of (comment_id, comment_text, created_timestamp) tuples, in depth-first order,
+        or None if the post's comments weren't fetched (then the doc has no 'comments' field).
+        The reddit comment ids let PostUpsertSink send only the comments that aren't stored yet
+    """
+    post_doc = {
+        '_id': post_id,
+        'title': title,
+        # 'author': {
+        #     'id': post.author.id,
+        #     'name': post.author.name
+        # },
+        'subreddit': subreddit,
+        'text': text,
+        'date': datetime.fromtimestamp(created),
+        'num_comments': len(comments) if comments else 0
+    }
+    if comments is not None:
+        post_doc['comments'] = [
+            {
+                'id': comment_id,
+                'text': comment_text,
+                # 'author': {
+                #     'id': comment.author.id,
+                #     'name': comment.author.name
+                # },
+                'created': datetime.fromtimestamp(comment_created)
+            }
+            for comment_id, comment_text, comment_created in comments
+        ]
+    return post_doc
+
+def convert_praw_post(post):
+    """Document for a praw Submission. Fetches all its comments if there are any"""
+    # get comments if there are any
+    comments = None
+    if post.num_comments > 0:
+        comment_list = praw.helpers.flatten_tree(post.comments, depth_first=True)
+        comments = [(comment.id, comment.body, comment.created) for comment in comment_list]
+
+    #lowercase the subreddit names
+    return make_post_document(post.id, post.title, post.subreddit.display_name.lower(),
+        post.selftext, post.created, comments)
+
 class MongoRedditStreamer(object):
     """Streams reddit posts into MongoDB"""
     def __init__(self, r, mongoclient, db_name, collection_name, subreddit='all', get_historic=False):
@@ -56,92 +102,33 @@ class MongoRedditStreamer(object):
         self.db = self.client[db_name]
         self.collection = self.db[collection_name]
         if get_historic:
-            # get all posts from beginning of the subreddit to now
-            # start from the last post scraped in same subreddit in the database
-            # submissions_between scrapes backwards in time, newer to older
-            # That means if you get a single old post, we'll skip to there
-            # There's a built-in 2-hour-backward offset
-
-            # TODO: This doesn't work! It just scrapes from most recent!
-            # XXX: is submissions_between broken? Try it on its own.
-            # oldest_posts = self.collection.find({'subreddit':self.subreddit}).sort('date', pymongo.ASCENDING)
-            # try:
-            #     oldest_post_date = oldest_posts.next()['date']
-            #     oldest_timestamp = time.mktime(oldest_post_date.timetuple())
-            #     print 'oldest_timestamp', oldest_timestamp
-            #     logger.info('Starting historic scrape from date: %s for subreddit "%s".' % (oldest_post_date, self.subreddit))
-            # except StopIteration:
-            #     logger.info('No existing posts in subreddit "%s", starting historic scrape from beginning of subreddit.' % self.subreddit)
-            #     oldest_timestamp = None
-            #
-            # self.post_generator = praw.helpers.submissions_between(self.r, self.subreddit, highest_timestamp=oldest_timestamp, newest_first=True, verbosity=2)
-
+            # get all posts from now back to the start of the subreddit, newest first.
+            # This always starts from now: for a backfill that resumes where it left off
+            # and scans in parallel, use backfill.HistoricBackfill (the --historic flag)
             self.post_generator = praw.helpers.submissions_between(self.r, self.subreddit, highest_timestamp=None, newest_first=True)
         else:
             # get past ~1000 posts and stream in new ones
             self.post_generator = praw.helpers.submission_stream(self.r, self.subreddit)
 
     def convert_to_document(self, post):
-        # get comments if there are any
-        comments = {}
-        if post.num_comments > 0:
-            comment_list = praw.helpers.flatten_tree(post.comments, depth_first=True)
-
-            comments = {'comments': [
-                {
-                    'text': comment.body,
-                    # 'author': {
-                    #     'id': comment.author.id,
-                    #     'name': comment.author.name
-                    # },
-                    'created': datetime.fromtimestamp(comment.created)
-                }
-                for comment in comment_list
-            ]}
-
-        post_doc = {
-            '_id': post.id,
-            'title': post.title,
-            # 'author': {
-            #     'id': post.author.id,
-            #     'name': post.author.name
-            # },
-            'subreddit': post.subreddit.display_name.lower(), #lowercase the subreddit names
-            'text': post.selftext,
-            'date': datetime.fromtimestamp(post.created),
-            'num_comments': 0 if not comments else len(comments['comments'])
-        }
-        post_doc.update(comments)
-        return post_doc
-
-    def scrape_to_db(self):
+        return convert_praw_post(post)
+
+    def scrape_to_db(self, batch_size=100, flush_interval=30):
+        """
+        Convert posts as they come in and upsert them in batches.
+
+        batch_size : number of posts per bulk upsert
+
+        flush_interval : max seconds a converted post waits in the buffer before it's written
+        """
+        sink = PostUpsertSink(self.collection, batch_size=batch_size, flush_interval=flush_interval)
+        # the stream can block for a long time waiting for new posts, so flush overdue batches in the background
+        sink.start_timer()
         try:
             new_posts = self.post_generator
             for post in new_posts:
                 try:
-                    post_doc = self.convert_to_document(post)
-                    # upsert: update if _id (post.id) already exists. otherwise, insert.
-                    updated = self.collection.update_one(
-                        {'_id':post_doc['_id']},
-                        {'$set':post_doc},
-                        upsert=True)
-
-                    # logger.debug('id:%r ack: %s matched:%s modified:%s' % (post_doc['_id'], updated.acknowledged, updated.matched_count, updated.modified_count))
-
-                    try:
-                        post_info_str = 'title:"%s", _id:"%s", date:"%s", subreddit:"%s"' % (post.title[:30], post_doc['_id'], post_doc['date'], post_doc['subreddit'])
-                    except KeyError as err:
-                        post_info_str = post_doc['_id']
-                        logger.warn('Error: %s -- Post _id:"%s" missing keys that I wanted to log.'% (err, post_info_str))
-
-                    if not updated.acknowledged:
-                        logger.warn('Failed to add post %s\nraw_result:"%s"' % (post_info_str, str(updated.raw_result)))
-                    if updated.matched_count == 1:
-                        logger.info('Updated existing post %s' % post_info_str)
-                    elif updated.matched_count == 0:
-                        logger.info('Added new post %s' % post_info_str)
-                    else:
-                        logger.critical('wtf? multiple indexes??')
+                    sink.add_post(self.convert_to_document(post))
 
                 except requests.exceptions.HTTPError:
                     logger.warning('HTTPError for "%s"' % post.url)
@@ -151,9 +138,16 @@ class MongoRedditStreamer(object):
             logger.info('***FINISHED SCRAPING: No more posts found***')
         except KeyboardInterrupt:
             sys.exit(0)
-
+        finally:
+            sink.close()
+            logger.info('added %i posts, updated %i posts, %i failed' % (sink.added_count, sink.updated_count, sink.failed_count))
 
 if __name__ == "__main__":
+    # configured here, not on import: concurrent_scraper & backfill import this module
+    logging.basicConfig(format='%(levelname)s %(asctime)s %(message)s',
+        level=logging.DEBUG,
+        filename=config.LOGFILE)
+
     # r.set_oauth_app_info(
     #     client_id=secrets.CLIENT_ID,
     #     client_secret=secrets.SECRET,
@@ -173,7 +167,16 @@ if __name__ == "__main__":
     arg_parser.add_argument('--db', type=str,
         help='name of MongoDB database to persist posts to', default=config.DEFAULT_DB)
     arg_parser.add_argument('--historic', action='store_true',
-        help='if included, get all historic posts. Otherwise just stream.')
+        help='if included, get all historic posts, resuming from the last checkpoint. Otherwise just stream.')
+    arg_parser.add_argument('--windows', type=int,
+        help='with --historic, number of time windows to scrape in parallel', default=4)
+    arg_parser.add_argument('--lowest_timestamp', type=float,
+        help='with --historic, UTC epoch seconds to scrape back to. Default: when the subreddit was created')
+    arg_parser.add_argument('--restart', action='store_true',
+        help='with --historic, forget the checkpoint and plan the backfill from scratch')
+    arg_parser.add_argument('--batch_size', type=int, help='number of posts per bulk upsert', default=100)
+    arg_parser.add_argument('--flush_interval', type=float,
+        help='max seconds a scraped post waits before being written', default=30)
 
     args = arg_parser.parse_args()
 
@@ -188,13 +191,28 @@ if __name__ == "__main__":
     else:
         logger.info('Using db: "%s"' % args.db)
 
-    streamer = MongoRedditStreamer(
-        r=r,
-        mongoclient=mongoclient,
-        db_name=args.db,
-        collection_name=config.POSTS_COLLECTION,
-        subreddit=args.subreddit,
-        get_historic=args.historic
-    )
+    if args.historic:
+        from backfill import HistoricBackfill
 
-    streamer.scrape_to_db()
+        # each time window gets its own session, they share the praw-multiprocess rate limit
+        reddit_factory = lambda: praw.Reddit('ubuntu:ian-scraper:v0.0.1 (by /u/ian-scraper)', handler=MultiprocessHandler())
+        lowest_timestamp = args.lowest_timestamp
+        if lowest_timestamp is None:
+            lowest_timestamp = r.get_subreddit(args.subreddit).created_utc
+
+        backfill = HistoricBackfill(reddit_factory, mongoclient[args.db], args.subreddit,
+            windows=args.windows, batch_size=args.batch_size)
+        if args.restart:
+            backfill.checkpoints.reset(args.subreddit)
+        backfill.run(lowest_timestamp)
+    else:
+        streamer = MongoRedditStreamer(
+            r=r,
+            mongoclient=mongoclient,
+            db_name=args.db,
+            collection_name=config.POSTS_COLLECTION,
+            subreddit=args.subreddit,
+            get_historic=False
+        )
+
+        streamer.scrape_to_db(batch_size=args.batch_size, flush_interval=args.flush_interval)
@@ -1,78 +1,215 @@
 #!/usr/bin/env python
 # Summarize each topic generated from nmf_topics.py
+import json
+import hashlib
 import argparse
+import multiprocessing
+from datetime import datetime
 
-from gensim.summarization import keywords, summarize
+from textrank import keywords, summarize
 
 import config
-from mongo_setup import mongoclient
+from mongo_setup import mongoclient, connect
 from process_text import PostManager
+import instrumentation
+from instrumentation import metrics, ProgressReporter, Profiler, SUMMARIZE
 
 # set up encoding to allow piping unicode to file
 import sys
 import codecs
 sys.stdout=codecs.getwriter('utf-8')(sys.stdout)
 
+# part of every SummaryCache key: bump it whenever the keywords & sentences
+# summarize_topic produces for the same docs & settings change, eg a new summarizing engine
+SUMMARY_ENGINE = 'textrank-1'
+
+def assemble_topic_text(doc_texts, doc_char_limit, single_doc_len):
+    """
+    Concatenates docs, each truncated to single_doc_len characters,
+    until the text is at least doc_char_limit characters long (or there are no docs left).
+    A doc_char_limit of 0 means no limit: use all the docs.
+    Builds the text in one join at the end, instead of re-copying it for every doc.
+
+    doc_texts : iterable of text bodies, most representative first
+    Returns (text, n_docs_used)
+    """
+    pieces = []
+    text_len = 0
+    for text_body in doc_texts:
+        if doc_char_limit and text_len >= doc_char_limit:
+            break
+        piece = text_body[:single_doc_len]
+        pieces.append(piece)
+        # +1 for the joining space
+        text_len += len(piece) + 1
+
+    return ' '.join(pieces), len(pieces)
+
+def summarize_topic(postman, topic_id, summary_ratio, single_doc_len, doc_char_limit, max_docs=0,
+    generate_keywords=True, generate_sentences=True):
+    """
+    Generate keywords and/or summary sentences for the docs assigned to a single topic,
+    using the topic's most representative docs (highest topic prob) up to doc_char_limit characters
+    (or all the topic's docs, if doc_char_limit is 0).
+    Returns the report for the topic as a string, so topics summarized in parallel can be printed in order.
+
+    max_docs : max number of docs to use. 0 means no limit
+    """
+    lines = ['\nTopic #%s:\n=============' % topic_id]
+    doc_id_text_generator = postman.fetch_top_topic_docs(topic_id, limit=max_docs)
+
+    concat_txt, doc_count = assemble_topic_text(
+        (text_body for doc_id, text_body in doc_id_text_generator), doc_char_limit, single_doc_len)
+    if doc_char_limit and len(concat_txt) < doc_char_limit:
+        lines.append('not enough docs found')
+
+    lines.append('used %i concatenated docs for this topic' % doc_count)
+    lines.append('actual character length of concatenated docs: %i' % len(concat_txt))
+
+    # make sure you have something
+    if len(concat_txt) == 0:
+        lines.append('got nothing for this topic')
+        return '\n'.join(lines)
+
+    with metrics.timer(SUMMARIZE, doc_count):
+        if generate_keywords:
+            lines.append('\ngenerating keywords\n------------------------------\n')
+            summary = keywords(concat_txt, ratio=summary_ratio, split=True, lemmatize=True)
+            lines.append(', '.join(summary))
+        if generate_sentences:
+            lines.append('\ngenerating sentences\n------------------------------\n')
+            summary = summarize(concat_txt, split=True, ratio=summary_ratio)
+            for sentence in summary:
+                lines.append(' * ' + sentence)
+
+    return '\n'.join(lines)
+
+class SummaryCache(object):
+    """
+    Persistent cache of topic reports from summarize_topic, in a MongoDB collection.
+
+    A topic's report is keyed by a hash of the topic's sorted doc _ids, the summarize_topic settings and SUMMARY_ENGINE,
+    so it's recomputed when docs join or leave the topic, the settings change, or the summarizer does.
+    Entries that haven't been used for ttl_days are deleted by a MongoDB TTL index.
+    """
+    def __init__(self, postman, ttl_days=config.SUMMARY_CACHE_TTL_DAYS):
+        self.postman = postman
+        self.collection = postman.mongoclient[postman.write_db][config.SUMMARY_COLLECTION]
+        self.collection.create_index('last_used', expireAfterSeconds=int(ttl_days * 24 * 60 * 60))
+
+    def __repr__(self):
+        return 'SummaryCache(postman={self.postman}, collection={self.collection.name})'.format(self=self)
+
+    def topic_key(self, topic_id, settings):
+        find_query = {'subreddit':self.postman.subreddit, 'postwise.topic_assignment.topic':topic_id}
+        doc_ids = sorted(doc['_id'] for doc in self.postman.posts_read.find(find_query, {'_id':True}))
+        key_json = json.dumps([SUMMARY_ENGINE, self.postman.subreddit, topic_id, doc_ids, settings], sort_keys=True)
+        return hashlib.sha1(key_json).hexdigest()
+
+    def get(self, key):
+        """Returns the cached report, or None. Using an entry resets its TTL"""
+        entry = self.collection.find_one_and_update({'_id':key}, {'$set':{'last_used':datetime.utcnow()}})
+        return entry['report'] if entry else None
+
+    def put(self, key, topic_id, report):
+        self.collection.replace_one({'_id':key}, {
+            'subreddit':self.postman.subreddit,
+            'topic_id':topic_id,
+            'engine':SUMMARY_ENGINE,
+            'report':report,
+            'last_used':datetime.utcnow(),
+        }, upsert=True)
+
+def summarize_topic_cached(postman, topic_id, summary_cache=None, **settings):
+    """summarize_topic, but reuses the report from summary_cache if the topic hasn't changed"""
+    if summary_cache is None:
+        return summarize_topic(postman, topic_id, **settings)
+
+    key = summary_cache.topic_key(topic_id, settings)
+    report = summary_cache.get(key)
+    if report is not None:
+        metrics.count('cached_summaries')
+        return report + '\n(cached summary)'
+
+    report = summarize_topic(postman, topic_id, **settings)
+    summary_cache.put(key, topic_id, report)
+    return report
+
+# Each worker process in a --jobs pool keeps its own PostManager, SummaryCache & settings here
+_worker_postman = None
+_worker_summary_cache = None
+_worker_settings = None
+
+def _init_worker(subreddit, read_db, settings, use_cache):
+    """Pool initializer: MongoClients aren't fork-safe, so each worker connects on its own"""
+    global _worker_postman, _worker_summary_cache, _worker_settings
+    _worker_postman = PostManager(connect(), subreddit, read_db)
+    _worker_summary_cache = SummaryCache(_worker_postman) if use_cache else None
+    _worker_settings = settings
+
+def _summarize_topic_worker(topic_id):
+    """Returns (topic report, the worker's stage metrics for just this topic)"""
+    metrics.reset()
+    topic_report = summarize_topic_cached(_worker_postman, topic_id, _worker_summary_cache, **_worker_settings)
+    return topic_report, metrics.stats()
+
 if __name__ == '__main__':
     arg_parser = argparse.ArgumentParser(description='Generates keywords or sentences for queried documents in subreddit')
     arg_parser.add_argument('--subreddit', type=str, help='subreddit name (or "all" to get all posts', required=True)
     # arg_parser.add_argument('--topic_id', type=int, help='topic id to summarize', required=True)
     # arg_parser.add_argument('--topic_thresh', type=float, help='threshold for specified topic probability of documents', required=True)
     arg_parser.add_argument('--summary_ratio', type=float, help='document to summary ratio. Smaller means shorter summary.', default=0.2)
-    arg_parser.add_argument('--single_doc_len', type=float, help='all individual documents are truncated to N characters', default=2500)
+    arg_parser.add_argument('--single_doc_len', type=int, help='all individual documents are truncated to N characters', default=2500)
+    arg_parser.add_argument('--doc_char_limit', type=int, help='rough max number of characters to summarize per topic (0 for the full topic text)', default=0)
+    arg_parser.add_argument('--max_docs', type=int, help='max number of docs to summarize per topic (0 for no limit)', default=0)
+    arg_parser.add_argument('--jobs', type=int, help='number of topics to summarize in parallel processes', default=1)
+    arg_parser.add_argument('--no_cache', action='store_true',
+        help='recompute every topic summary, instead of reusing cached summaries of unchanged topics')
+    instrumentation.add_arguments(arg_parser)
 
     args = arg_parser.parse_args()
+    profiler = Profiler.from_args(args).start()
 
     postman = PostManager(mongoclient, args.subreddit)
 
     search_words = config.SEARCH_WORDS
 
-    doc_char_limit = 60000
+    doc_char_limit = args.doc_char_limit
     print 'looking at topic-modeled posts in subreddit "%s"' % args.subreddit
     # print 'using topic prob threshold %f' % args.topic_thresh
-    print 'per-topic character limit is roughly %i' % doc_char_limit
+    if doc_char_limit:
+        print 'per-topic character limit is roughly %i' % doc_char_limit
+    else:
+        print 'no per-topic character limit, summarizing the full text of each topic'
     print 'per-post character limit is %i' % args.single_doc_len
 
-    for topic_id in sorted(postman.get_topics()):
-        print '\nTopic #%s:\n=============' % topic_id
-        # query_mixin = {'postwise.tokens': {'$in': search_words}} #TODO: make query more general
-        # query_mixin = {'postwise.topic_distro':{'$elemMatch':{'topic_id':topic_id, 'prob':{'$gt':args.topic_thresh}}}}
-        query_mixin = {'postwise.topic_assignment.topic':topic_id}
-        doc_id_text_generator = postman.fetch_doc_text_body(document_level='postwise', find_query_mixin=query_mixin)
-
-        concat_txt = ''
-        breakout = 0 #dumb infinite loop preventer
-        while len(concat_txt) < doc_char_limit:
-            if breakout > 9999:
-                raise IOError('this should never happen')
-            try:
-                doc_id, text_body = doc_id_text_generator.next()
-            except StopIteration:
-                print 'not enough docs found, breaking'
-                break
-            concat_txt = ' '.join([concat_txt, text_body[:args.single_doc_len]])
-            breakout += 1
-
-        print 'used %i concatenated docs for this topic' % breakout
-        print 'actual character length of concatenated docs: %i' % len(concat_txt)
-
-        # make sure you have something
-        if len(concat_txt) == 0:
-            print 'got nothing for this topic'
-            continue
-
-        # TODO: make arga
-        generate_keywords = True
-        generate_sentences = True
+    # TODO: make arga
+    settings = dict(summary_ratio=args.summary_ratio, single_doc_len=args.single_doc_len,
+        doc_char_limit=doc_char_limit, max_docs=args.max_docs, generate_keywords=True, generate_sentences=True)
 
-        if generate_keywords:
-            print '\ngenerating keywords\n------------------------------\n'
-            summary = keywords(concat_txt, ratio=args.summary_ratio, split=True, lemmatize=True)
-            print ', '.join(summary)
-        if generate_sentences:
-            print '\ngenerating sentences\n------------------------------\n'
-            summary = summarize(concat_txt, split=True, ratio=args.summary_ratio)
-            for sentence in summary:
-                print ' * ' + sentence
+    topic_ids = sorted(postman.get_topics())
+    progress = ProgressReporter('summarize', total=len(topic_ids), interval=args.metrics_interval, path=args.metrics_path)
+    if args.jobs > 1:
+        pool = multiprocessing.Pool(args.jobs, initializer=_init_worker,
+            initargs=(postman.subreddit, postman.read_db, settings, not args.no_cache))
+        try:
+            # imap yields results in topic order, as soon as each next topic is done
+            for topic_idx, (topic_report, metrics_stats) in enumerate(pool.imap(_summarize_topic_worker, topic_ids)):
+                print topic_report
+                metrics.add_stats(metrics_stats)
+                progress.update(topic_idx + 1)
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+    else:
+        summary_cache = None if args.no_cache else SummaryCache(postman)
+        for topic_idx, topic_id in enumerate(topic_ids):
+            print summarize_topic_cached(postman, topic_id, summary_cache, **settings)
+            progress.update(topic_idx + 1)
 
-        # it's sentence or keyword depending on --sentence flag
+    profiler.stop()
+    progress.finish()
+    metrics.report()
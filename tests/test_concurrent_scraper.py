@@ -0,0 +1,107 @@
+# Drives RedditJSONClient and ConcurrentRedditIngester against a fake reddit JSON server on localhost.
+# Run from the repo root: python -m unittest discover tests
+import json
+import time
+import unittest
+import threading
+import BaseHTTPServer
+
+import requests
+
+import concurrent_scraper
+from concurrent_scraper import RateLimiter, RedditJSONClient, ConcurrentRedditIngester
+
+try:
+    import mongomock
+except ImportError:
+    mongomock = None
+
+class FakeRedditHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Answers each path with the next of its scripted (status, data) responses, repeating the last one"""
+    def do_GET(self):
+        path = self.path.split('?')[0]
+        self.server.requested_paths.append(path)
+        responses = self.server.responses.get(path, [(404, {'error': 404})])
+        status, data = responses.pop(0) if len(responses) > 1 else responses[0]
+        body = json.dumps(data)
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+def comment(comment_id, replies=()):
+    return {'kind': 't1', 'data': {'id': comment_id, 'body': 'comment %s' % comment_id, 'created': 1000.0,
+        'replies': {'data': {'children': list(replies)}} if replies else ''}}
+
+def post_data(post_id, num_comments):
+    return {'id': post_id, 'title': 'title %s' % post_id, 'subreddit': 'Linux', 'selftext': 'text',
+        'created': 1000.0, 'num_comments': num_comments}
+
+def listing(children, after=None):
+    return {'data': {'children': children, 'after': after}}
+
+class ConcurrentScraperTest(unittest.TestCase):
+    def setUp(self):
+        self.server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), FakeRedditHandler)
+        self.server.responses = {}
+        self.server.requested_paths = []
+        self.server_thread = threading.Thread(target=self.server.serve_forever)
+        self.server_thread.daemon = True
+        self.server_thread.start()
+
+        # record the backoff sleeps instead of waiting them out
+        self.sleeps = []
+        self.real_sleep = concurrent_scraper.time.sleep
+        concurrent_scraper.time.sleep = self.sleeps.append
+
+        self.client = RedditJSONClient(RateLimiter(1e6), user_agent='test',
+            base_url='http://127.0.0.1:%i' % self.server.server_port, max_retries=2)
+
+    def tearDown(self):
+        concurrent_scraper.time.sleep = self.real_sleep
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_retries_rate_limit_and_server_errors(self):
+        self.server.responses['/r/linux/new.json'] = [(429, {}), (503, {}), (200, listing([]))]
+        self.assertEqual(self.client.get_json('/r/linux/new.json'), listing([]))
+        self.assertEqual(len(self.server.requested_paths), 3)
+        self.assertEqual(self.sleeps, [1, 2])
+
+    def test_gives_up_without_sleeping_after_last_attempt(self):
+        self.server.responses['/r/linux/new.json'] = [(500, {})]
+        self.assertRaises(requests.exceptions.HTTPError, self.client.get_json, '/r/linux/new.json')
+        self.assertEqual(len(self.server.requested_paths), 3)
+        self.assertEqual(self.sleeps, [1, 2])
+
+    def test_comments_flattened_depth_first(self):
+        more = {'kind': 'more', 'data': {'children': ['z']}}
+        tree = [comment('a', [comment('b', [comment('c')]), more]), comment('d')]
+        self.server.responses['/comments/p1.json'] = [(200, [listing([]), listing(tree)])]
+        comments = self.client.comments('p1')
+        self.assertEqual([comment_id for comment_id, body, created in comments], ['a', 'b', 'c', 'd'])
+        self.assertEqual(comments[0], ('a', 'comment a', 1000.0))
+
+    @unittest.skipIf(mongomock is None, 'needs mongomock')
+    def test_scrape_skips_bad_posts(self):
+        bad_post = post_data('p2', 0)
+        del bad_post['title']
+        self.server.responses['/r/linux/new.json'] = [(200, listing([
+            {'kind': 't3', 'data': post_data('p1', 1)},
+            {'kind': 't3', 'data': bad_post},
+            {'kind': 't3', 'data': post_data('p3', 0)},
+        ]))]
+        self.server.responses['/comments/p1.json'] = [(503, {}), (200, [listing([]), listing([comment('a')])])]
+
+        collection = mongomock.MongoClient().db.posts
+        ingester = ConcurrentRedditIngester(self.client, collection, workers=2, batch_size=10, flush_interval=60)
+        self.assertEqual(ingester.scrape(['linux']), 3)
+        self.assertEqual(sorted(doc['_id'] for doc in collection.find()), ['p1', 'p3'])
+        self.assertEqual(ingester.scrape([]), 0)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,26 @@
+# Run from the repo root: python -m unittest discover tests
+import unittest
+
+import numpy as np
+import scipy.sparse as sp
+
+from online_nmf import OnlineNMF
+
+class OnlineNMFTest(unittest.TestCase):
+    def test_all_zero_first_batch_is_skipped(self):
+        random = np.random.RandomState(0)
+        model = OnlineNMF(n_components=3, n_features=20, random_state=0)
+
+        # eg a batch of docs without any vocabulary terms
+        model.partial_fit(sp.csr_matrix((10, 20)))
+        self.assertIsNone(model.components_)
+        self.assertEqual(model.n_batches, 0)
+
+        for _ in range(5):
+            model.partial_fit(sp.csr_matrix(random.rand(10, 20) * (random.rand(10, 20) > 0.5)))
+        self.assertEqual(model.n_batches, 5)
+        self.assertTrue((model.components_.sum(axis=1) > 0).all())
+        self.assertTrue(model.transform(random.rand(4, 20)).sum() > 0)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,137 @@
+# Extractive summaries and keywords with TextRank, on sparse matrices.
+# Drop-in for the keywords() and summarize() functions from gensim.summarization (removed in gensim 4)
+import re
+import math
+
+import numpy as np
+import scipy.sparse as sp
+import nltk
+from sklearn.feature_extraction.text import TfidfVectorizer, ENGLISH_STOP_WORDS
+
+WORD_PATTERN = re.compile(r'[a-z][a-z\-]*[a-z]')
+
+def pagerank(adjacency, damping=0.85, tol=1e-6, max_iter=100):
+    """
+    PageRank scores for the nodes of a weighted graph, by power iteration.
+
+    adjacency : (n x n) sparse matrix of edge weights. Nodes without edges get the baseline score.
+    """
+    n_nodes = adjacency.shape[0]
+    if n_nodes == 0:
+        return np.zeros(0)
+
+    adjacency = sp.csr_matrix(adjacency, dtype=np.float64)
+    out_weights = np.asarray(adjacency.sum(axis=1)).ravel()
+    is_dangling = out_weights == 0
+
+    # row-normalize into a transition matrix, and transpose so scores flow along the edges
+    inv_out_weights = np.zeros(n_nodes)
+    inv_out_weights[~is_dangling] = 1.0 / out_weights[~is_dangling]
+    transitions = (sp.diags(inv_out_weights).dot(adjacency)).T.tocsr()
+
+    scores = np.full(n_nodes, 1.0 / n_nodes)
+    for _ in range(max_iter):
+        # dangling nodes spread their score evenly over every node
+        dangling_score = scores[is_dangling].sum() / n_nodes
+        new_scores = (1 - damping) / n_nodes + damping * (transitions.dot(scores) + dangling_score)
+        converged = np.abs(new_scores - scores).sum() < tol
+        scores = new_scores
+        if converged:
+            break
+    return scores
+
+def top_k_similarities(X, top_k, max_cells=10 ** 7):
+    """
+    Sparse cosine similarity graph of the rows of X (l2 normalized), with only each row's top_k most similar rows.
+    Computed as a sparse product a chunk of rows at a time, with chunks of max_cells // n_rows rows,
+    so at most max_cells similarities are in memory at once however long the text is,
+    and only top_k per row are kept. Symmetric, without self-loops.
+    """
+    n_rows = X.shape[0]
+    chunk_size = max(1, max_cells // n_rows)
+    X_T = X.T.tocsc()
+    rows, cols, weights = [], [], []
+    for chunk_start in range(0, n_rows, chunk_size):
+        chunk = X[chunk_start:chunk_start + chunk_size].dot(X_T).tocsr()
+        for chunk_row in range(chunk.shape[0]):
+            row = chunk_start + chunk_row
+            row_cols = chunk.indices[chunk.indptr[chunk_row]:chunk.indptr[chunk_row + 1]]
+            row_weights = chunk.data[chunk.indptr[chunk_row]:chunk.indptr[chunk_row + 1]]
+            not_self = row_cols != row
+            row_cols, row_weights = row_cols[not_self], row_weights[not_self]
+            if len(row_cols) > top_k:
+                top = np.argpartition(-row_weights, top_k - 1)[:top_k]
+                row_cols, row_weights = row_cols[top], row_weights[top]
+            rows.append(np.full(len(row_cols), row, dtype=np.int64))
+            cols.append(row_cols)
+            weights.append(row_weights)
+    similarity = sp.csr_matrix((np.concatenate(weights), (np.concatenate(rows), np.concatenate(cols))),
+        shape=(n_rows, n_rows))
+    similarity.eliminate_zeros()
+    # keep an edge if it's in the top k of either sentence
+    return similarity.maximum(similarity.T)
+
+def n_to_keep(n_items, ratio):
+    return max(1, int(math.ceil(ratio * n_items)))
+
+def summarize(text, ratio=0.2, split=False, top_k=50):
+    """
+    Extractive summary: the most central sentences of the text, in their original order.
+    Sentences are nodes, edges are the cosine similarity of their tf-idf vectors,
+    keeping each sentence's top_k most similar sentences so the graph stays sparse on long texts.
+
+    ratio : fraction of the sentences to keep
+    split : if True, return a list of sentences. Otherwise return them joined by newlines
+    top_k : max number of edges per sentence
+    """
+    sentences = [sentence.strip() for sentence in nltk.sent_tokenize(text) if sentence.strip()]
+    if len(sentences) <= 1:
+        return sentences if split else '\n'.join(sentences)
+
+    try:
+        X = TfidfVectorizer(stop_words='english').fit_transform(sentences)
+    except ValueError:
+        # nothing but stopwords
+        return [] if split else ''
+
+    # rows are l2 normalized, so X X^T is the cosine similarity
+    scores = pagerank(top_k_similarities(X, top_k))
+    top_idxs = sorted(np.argsort(-scores, kind='mergesort')[:n_to_keep(len(sentences), ratio)])
+    summary = [sentences[idx] for idx in top_idxs]
+    return summary if split else '\n'.join(summary)
+
+def keywords(text, ratio=0.2, split=False, lemmatize=False, window=2):
+    """
+    The most central words of the text. Words are nodes,
+    edges are weighted by how often two words appear within window words of each other (stopwords removed).
+
+    ratio : fraction of the unique words to keep
+    split : if True, return a list of keywords. Otherwise return them joined by newlines
+    lemmatize : if True, merge inflections of a word with nltk's WordNetLemmatizer
+    """
+    words = [word for word in WORD_PATTERN.findall(text.lower()) if word not in ENGLISH_STOP_WORDS]
+    if lemmatize:
+        lemmatizer = nltk.stem.WordNetLemmatizer()
+        lemmas = {word:lemmatizer.lemmatize(word) for word in set(words)}
+        words = [lemmas[word] for word in words]
+    if not words:
+        return [] if split else ''
+
+    vocabulary = {}
+    word_ids = np.array([vocabulary.setdefault(word, len(vocabulary)) for word in words])
+    n_words = len(vocabulary)
+
+    # one sparse matrix of co-occurrence counts, summed over every offset in the window
+    cooccurrence = sp.csr_matrix((n_words, n_words))
+    for offset in range(1, window):
+        rows, cols = word_ids[:-offset], word_ids[offset:]
+        counts = sp.coo_matrix((np.ones(len(rows)), (rows, cols)), shape=(n_words, n_words)).tocsr()
+        cooccurrence = cooccurrence + counts + counts.T
+    # no self-loops, eg from a repeated word
+    cooccurrence = cooccurrence - sp.diags(cooccurrence.diagonal())
+    cooccurrence.eliminate_zeros()
+
+    scores = pagerank(cooccurrence)
+    terms = sorted(vocabulary, key=vocabulary.get)
+    top_words = [terms[idx] for idx in np.argsort(-scores, kind='mergesort')[:n_to_keep(n_words, ratio)]]
+    return top_words if split else '\n'.join(top_words)
@@ -0,0 +1,225 @@
+#!/usr/bin/env python
+# Compact on-disk copy of the postwise tokens of a subreddit's docs,
+# so topic modeling runs can read them without MongoDB or millions of small python objects
+import os
+import io
+import json
+import time
+import shutil
+import hashlib
+import argparse
+
+import numpy as np
+import scipy.sparse as sp
+from sklearn.feature_extraction.text import ENGLISH_STOP_WORDS
+
+import config
+from mongo_setup import mongoclient
+from process_text import PostManager
+from utils import chunked
+from matrix_cache import tfidf_from_counts
+from complaint_index import COMPLAINT_QUERY_MIXIN
+
+# bump this when the files written by export_token_corpus change
+TOKEN_CORPUS_FORMAT_VERSION = 1
+
+TOKEN_DTYPE = np.int32
+OFFSET_DTYPE = np.int64
+
+def token_corpus_path(subreddit, find_query_mixin, cache_dir=config.CACHE_DIR):
+    """Dir of the token corpus for the subreddit's docs matching find_query_mixin"""
+    query_hash = hashlib.sha1(json.dumps(find_query_mixin, sort_keys=True)).hexdigest()[:12]
+    return os.path.join(cache_dir, subreddit, 'tokens-' + query_hash)
+
+def export_token_corpus(postman, path, find_query_mixin={}, batch_size=1000):
+    """
+    Write the postwise.tokens of the docs matching the query to path, streaming them from MongoDB.
+    Only the vocabulary is held in memory. Returns the TokenCorpus.
+
+    Files:
+        tokens.int32 : every doc's token ids, one doc after another, as a flat array
+        offsets.int64 : doc i's token ids are tokens[offsets[i]:offsets[i + 1]]
+        vocabulary.txt : term of each token id, one per line
+        doc_ids.json : _id of each doc
+        manifest.json : format version, query, and sizes
+    """
+    tmp_path = path + '.tmp'
+    if os.path.exists(tmp_path):
+        shutil.rmtree(tmp_path)
+    os.makedirs(tmp_path)
+
+    find_query = {'subreddit':postman.subreddit, 'postwise.tokens':{'$exists':True}}
+    find_query.update(find_query_mixin)
+    cursor = postman.posts_read.find(find_query, {'postwise.tokens':True}).batch_size(batch_size)
+
+    vocabulary = {} # term : token id
+    doc_ids = []
+    n_tokens = 0
+    with open(os.path.join(tmp_path, 'tokens.int32'), 'wb') as tokens_file, \
+        open(os.path.join(tmp_path, 'offsets.int64'), 'wb') as offsets_file:
+        np.zeros(1, dtype=OFFSET_DTYPE).tofile(offsets_file)
+        for docs in chunked(cursor, batch_size):
+            token_ids = [vocabulary.setdefault(term, len(vocabulary))
+                for doc in docs for term in doc['postwise']['tokens']]
+            doc_lens = [len(doc['postwise']['tokens']) for doc in docs]
+
+            np.array(token_ids, dtype=TOKEN_DTYPE).tofile(tokens_file)
+            (n_tokens + np.cumsum(doc_lens, dtype=OFFSET_DTYPE)).tofile(offsets_file)
+            n_tokens += len(token_ids)
+            doc_ids.extend(doc['_id'] for doc in docs)
+
+    terms = sorted(vocabulary, key=vocabulary.get)
+    with io.open(os.path.join(tmp_path, 'vocabulary.txt'), 'w', encoding='utf-8') as vocab_file:
+        for term in terms:
+            vocab_file.write(term + u'\n')
+    with open(os.path.join(tmp_path, 'doc_ids.json'), 'w') as ids_file:
+        json.dump(doc_ids, ids_file)
+
+    manifest = {
+        'format_version': TOKEN_CORPUS_FORMAT_VERSION,
+        'subreddit': postman.subreddit,
+        'find_query_mixin': find_query_mixin,
+        'n_docs': len(doc_ids),
+        'n_tokens': n_tokens,
+        'n_terms': len(terms),
+        'exported_at': time.time(),
+    }
+    with open(os.path.join(tmp_path, 'manifest.json'), 'w') as manifest_file:
+        json.dump(manifest, manifest_file, indent=2, sort_keys=True)
+
+    if os.path.exists(path):
+        shutil.rmtree(path)
+    os.rename(tmp_path, path)
+    print 'exported %i tokens of %i docs, %i terms to %s' % (n_tokens, len(doc_ids), len(terms), path)
+    return TokenCorpus(path)
+
+def load_or_export_token_corpus(postman, find_query_mixin={}, cache_dir=config.CACHE_DIR, refresh=False):
+    """The token corpus for the query, exporting it from MongoDB first if it isn't there (or refresh is True)"""
+    path = token_corpus_path(postman.subreddit, find_query_mixin, cache_dir)
+    if not refresh and os.path.exists(os.path.join(path, 'manifest.json')):
+        token_corpus = TokenCorpus(path)
+        print 'loaded %r' % token_corpus
+        return token_corpus
+    return export_token_corpus(postman, path, find_query_mixin)
+
+class TokenCorpus(object):
+    """
+    Reader for a token corpus written by export_token_corpus. The token ids & offsets are memory-mapped.
+    Iterating over it yields each doc's array of token ids.
+    """
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, 'manifest.json')) as manifest_file:
+            self.manifest = json.load(manifest_file)
+        if self.manifest['format_version'] != TOKEN_CORPUS_FORMAT_VERSION:
+            raise ValueError('token corpus at %s has format version %r, expected %r' % (
+                path, self.manifest['format_version'], TOKEN_CORPUS_FORMAT_VERSION))
+
+        with io.open(os.path.join(path, 'vocabulary.txt'), encoding='utf-8') as vocab_file:
+            self.vocabulary = vocab_file.read().splitlines()
+        with open(os.path.join(path, 'doc_ids.json')) as ids_file:
+            self.doc_ids = json.load(ids_file)
+
+        self.offsets = np.memmap(os.path.join(path, 'offsets.int64'), dtype=OFFSET_DTYPE, mode='r')
+        if self.manifest['n_tokens']:
+            self.tokens = np.memmap(os.path.join(path, 'tokens.int32'), dtype=TOKEN_DTYPE, mode='r')
+        else:
+            # can't memory-map an empty file
+            self.tokens = np.zeros(0, dtype=TOKEN_DTYPE)
+
+    def __repr__(self):
+        return 'TokenCorpus(path="{self.path}", n_docs={0}, n_terms={1})'.format(len(self), len(self.vocabulary), self=self)
+
+    def __len__(self):
+        return len(self.doc_ids)
+
+    def __iter__(self):
+        offsets = self.offsets
+        for idx in xrange(len(self)):
+            yield self.tokens[offsets[idx]:offsets[idx + 1]]
+
+    def token_docs(self):
+        """Yields each doc as a list of terms, like PostManager.fetch_doc_tokens"""
+        vocabulary = self.vocabulary
+        for token_ids in self:
+            yield [vocabulary[token_id] for token_id in token_ids]
+
+    def count_matrix(self):
+        """(n_docs x n_terms) sparse matrix of term counts, built straight from the token & offset arrays"""
+        # copies, since summing the duplicate entries sorts the arrays in place
+        counts = sp.csr_matrix((np.ones(len(self.tokens), dtype=np.int32), np.array(self.tokens), np.array(self.offsets)),
+            shape=(len(self), len(self.vocabulary)))
+        counts.sum_duplicates()
+        return counts
+
+    def transform(self, vectorizer):
+        """
+        tf-idf matrix of the docs with the columns of an already fitted vectorizer, eg from a saved model trained on
+        the token corpus. Terms that aren't in the vectorizer's vocabulary are dropped
+        """
+        term_map = np.array([vectorizer.vocabulary_.get(term, -1) for term in self.vocabulary], dtype=np.int64)
+        known = np.flatnonzero(term_map >= 0)
+        # (n_terms x n_features) 0/1 matrix moving each known term's counts to its feature column
+        mapping = sp.csr_matrix((np.ones(len(known)), (known, term_map[known])),
+            shape=(len(self.vocabulary), len(vectorizer.vocabulary_)))
+        return vectorizer._tfidf.transform(self.count_matrix().astype(np.float64) * mapping)
+
+    def doc_freqs(self):
+        """Number of docs each term appears in"""
+        return np.bincount(self.count_matrix().indices, minlength=len(self.vocabulary))
+
+    def bow(self, term_map=None):
+        """
+        Re-iterable gensim-style bag of words corpus over the docs, see BowCorpus.
+
+        term_map : optional int array mapping each token id to a new term id, or -1 to drop the term
+        """
+        return BowCorpus(self, term_map)
+
+    def tfidf(self, vectorizer_settings):
+        """
+        Same as matrix_cache.DocTermCache.tfidf, from the preprocessed tokens instead of the postwise text.
+        Returns (doc_ids, X, vectorizer). Of the analyzer settings, only stop_words='english' applies:
+        the tokens are already split & cleaned by the Preprocessor.
+        """
+        keep = None
+        if vectorizer_settings.get('stop_words') == 'english':
+            keep = np.array([term not in ENGLISH_STOP_WORDS for term in self.vocabulary], dtype=bool)
+        X, vectorizer = tfidf_from_counts(self.count_matrix(), self.vocabulary, vectorizer_settings, keep=keep)
+        return list(self.doc_ids), X, vectorizer
+
+class BowCorpus(object):
+    """
+    Streams a TokenCorpus as lists of (term_id, count) pairs, one doc at a time.
+    Can be iterated over many times, eg once per LDA pass, without keeping the lists around.
+    """
+    def __init__(self, token_corpus, term_map=None):
+        self.token_corpus = token_corpus
+        self.term_map = term_map
+
+    def __repr__(self):
+        return 'BowCorpus(token_corpus={self.token_corpus})'.format(self=self)
+
+    def __len__(self):
+        return len(self.token_corpus)
+
+    def __iter__(self):
+        term_map = self.term_map
+        for token_ids in self.token_corpus:
+            if term_map is not None:
+                token_ids = term_map[token_ids]
+                token_ids = token_ids[token_ids >= 0]
+            term_ids, counts = np.unique(token_ids, return_counts=True)
+            yield zip(term_ids.tolist(), counts.tolist())
+
+if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser(description='Exports the postwise tokens of a subreddit to a compact token corpus')
+    arg_parser.add_argument('--subreddit', type=str, help='subreddit name', required=True)
+    arg_parser.add_argument('--cache_dir', type=str, help='dir to write the token corpus under', default=config.CACHE_DIR)
+    arg_parser.add_argument('--all_docs', action='store_true',
+        help='if included, export all docs. Otherwise only docs containing SEARCH_WORDS, like lda.py & nmf_topics.py')
+    args = arg_parser.parse_args()
+
+    postman = PostManager(mongoclient, args.subreddit)
+    query_mixin = {} if args.all_docs else COMPLAINT_QUERY_MIXIN
+    export_token_corpus(postman, token_corpus_path(args.subreddit, query_mixin, args.cache_dir), query_mixin)
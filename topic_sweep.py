@@ -0,0 +1,202 @@
+# Model selection sweep for nmf_topics.py: fits NMF for a grid of df settings & topic counts,
+# scores each configuration, and only keeps the best one
+import time
+import json
+import itertools
+import multiprocessing
+
+import numpy as np
+from sklearn.decomposition import NMF
+from sklearn.feature_extraction.text import CountVectorizer, ENGLISH_STOP_WORDS
+
+from nmf_topics import TopicModeler, build_nmf
+from matrix_cache import DocTermCache, TFIDF_SETTINGS, tfidf_from_counts
+from token_corpus import load_or_export_token_corpus
+from instrumentation import metrics, VECTORIZE, NMF_FIT
+
+def umass_coherence(components, X, n_top_words=10):
+    """
+    Mean UMass coherence of the topics (Mimno et al. 2011), higher (closer to 0) is better.
+    For each topic's top words w_1..w_n, sums log((D(w_i, w_j) + 1) / D(w_j)) over j < i,
+    where D counts the docs (rows of X) containing all the given words.
+    Returns (mean coherence, list of per-topic coherence)
+    """
+    X = X.tocsc()
+    topic_scores = []
+    for topic in components:
+        top_words = np.argsort(topic)[::-1][:n_top_words]
+        present = X[:, top_words]
+        present.data = np.ones_like(present.data)
+        co_doc_counts = (present.T * present).toarray()
+        doc_counts = np.maximum(np.diag(co_doc_counts), 1)
+
+        score = 0.0
+        for i in range(1, len(top_words)):
+            for j in range(i):
+                score += np.log((co_doc_counts[i, j] + 1.0) / doc_counts[j])
+        topic_scores.append(score)
+    return float(np.mean(topic_scores)), topic_scores
+
+def sweep_counts(postman, find_query_mixin, vectorizer_settings, source='mongo', cache_dir=None,
+    refresh_token_corpus=False, rebuild_cache=False):
+    """
+    The term counts the sweep vectorizes each df setting from, fetched & tokenized once.
+    Returns (doc_ids, counts, terms, keep), see matrix_cache.tfidf_from_counts for keep.
+
+    source : "mongo" to fetch & tokenize the postwise text, "cache" for the matrix_cache.DocTermCache,
+        "token_corpus" for the preprocessed tokens in the token_corpus.TokenCorpus
+    """
+    if source == 'cache':
+        cache = DocTermCache(postman, find_query_mixin, vectorizer_settings, cache_dir=cache_dir).update(
+            rebuild=rebuild_cache)
+        terms = sorted(cache.vocabulary, key=cache.vocabulary.get)
+        return list(cache.doc_ids), cache.counts, terms, None
+    elif source == 'token_corpus':
+        token_corpus = load_or_export_token_corpus(postman, find_query_mixin, cache_dir=cache_dir,
+            refresh=refresh_token_corpus)
+        keep = None
+        if vectorizer_settings.get('stop_words') == 'english':
+            keep = np.array([term not in ENGLISH_STOP_WORDS for term in token_corpus.vocabulary], dtype=bool)
+        return list(token_corpus.doc_ids), token_corpus.count_matrix(), token_corpus.vocabulary, keep
+    elif source == 'mongo':
+        doc_ids, text_docs = [], []
+        for doc_id, text_body in postman.fetch_doc_text_body('postwise', find_query_mixin):
+            doc_ids.append(doc_id)
+            text_docs.append(text_body)
+        analyzer_settings = {key:val for key, val in vectorizer_settings.items() if key not in TFIDF_SETTINGS}
+        count_vectorizer = CountVectorizer(**analyzer_settings)
+        with metrics.timer(VECTORIZE, len(text_docs)):
+            counts = count_vectorizer.fit_transform(text_docs)
+        return doc_ids, counts.tocsr(), count_vectorizer.get_feature_names(), None
+    raise ValueError('source not understood: %r' % source)
+
+# The tf-idf matrix being swept, set before the pool forks, so the workers share its arrays
+# copy-on-write instead of each getting a pickled copy. Nothing writes to the arrays.
+_sweep_X = None
+_sweep_n_top_words = None
+
+def _fit_sweep_model(n_topics):
+    """Fit NMF on _sweep_X and score it. Returns the result dict, with the components"""
+    X = _sweep_X
+    start = time.time()
+    nmf = NMF(n_components=n_topics).fit(X)
+    fit_seconds = time.time() - start
+    coherence, topic_coherences = umass_coherence(nmf.components_, X, _sweep_n_top_words)
+    return {
+        'n_topics': n_topics,
+        'reconstruction_err': float(nmf.reconstruction_err_),
+        'coherence': coherence,
+        'topic_coherences': topic_coherences,
+        'fit_seconds': fit_seconds,
+        'n_iter': int(nmf.n_iter_),
+        'components': nmf.components_,
+    }
+
+class TopicSweep(object):
+    """
+    Fits an NMF model for each combination of min_df, max_df and n_topics on the same docs,
+    reporting reconstruction error, UMass coherence and fit time for each.
+    The counts are fetched once, tf-idf is computed once per (min_df, max_df),
+    and the topic counts of a df setting are fit in parallel in a pool of workers.
+    The configuration with the best coherence is chosen: reconstruction error always drops with more topics
+    and isn't comparable across df settings, since they change the matrix.
+
+    vectorizer_settings : TfidfVectorizer settings shared by every configuration. min_df & max_df are overridden
+
+    workers : number of processes to fit NMF with
+
+    source : "tokens" if the counts are of postwise.tokens, see nmf_topics.MODEL_SOURCES
+    """
+    def __init__(self, doc_ids, counts, terms, vectorizer_settings, keep=None, workers=1, n_top_words=10, source='text'):
+        self.doc_ids = doc_ids
+        self.counts = counts
+        self.terms = terms
+        self.keep = keep
+        self.vectorizer_settings = vectorizer_settings
+        self.workers = workers
+        self.n_top_words = n_top_words
+        self.source = source
+
+        self.results = []
+        self.best = None # (result, X, vectorizer, components) of the chosen configuration
+
+    def __repr__(self):
+        return 'TopicSweep(n_docs={0}, n_terms={1}, workers={self.workers})'.format(len(self.doc_ids), len(self.terms), self=self)
+
+    def fit_n_topics(self, X, n_topics_grid):
+        """Yields the result of each topic count, fit on X, as they finish"""
+        global _sweep_X, _sweep_n_top_words
+        _sweep_X = X
+        _sweep_n_top_words = self.n_top_words
+        try:
+            if self.workers > 1:
+                pool = multiprocessing.Pool(min(self.workers, len(n_topics_grid)))
+                try:
+                    for result in pool.imap_unordered(_fit_sweep_model, n_topics_grid):
+                        yield result
+                    pool.close()
+                except:
+                    pool.terminate()
+                    raise
+                finally:
+                    pool.join()
+            else:
+                for n_topics in n_topics_grid:
+                    yield _fit_sweep_model(n_topics)
+        finally:
+            _sweep_X = None
+
+    def run(self, n_topics_grid, min_df_grid, max_df_grid):
+        for min_df, max_df in itertools.product(min_df_grid, max_df_grid):
+            settings = dict(self.vectorizer_settings, min_df=min_df, max_df=max_df)
+            try:
+                with metrics.timer(VECTORIZE, len(self.doc_ids)):
+                    X, vectorizer = tfidf_from_counts(self.counts, self.terms, settings, keep=self.keep)
+            except ValueError as e:
+                print 'skipping min_df=%r max_df=%r: %s' % (min_df, max_df, e)
+                continue
+            print 'min_df=%r max_df=%r: %i docs x %i terms, fitting %i topic counts' % (
+                min_df, max_df, X.shape[0], X.shape[1], len(n_topics_grid))
+
+            for result in self.fit_n_topics(X, n_topics_grid):
+                metrics.add(NMF_FIT, result['fit_seconds'], X.shape[0])
+                components = result.pop('components')
+                result.update(min_df=min_df, max_df=max_df, n_terms=X.shape[1])
+                self.results.append(result)
+                print '  n_topics=%3i  reconstruction_err=%10.4f  coherence=%8.3f  fit %.1f sec, %i iterations' % (
+                    result['n_topics'], result['reconstruction_err'], result['coherence'],
+                    result['fit_seconds'], result['n_iter'])
+
+                # only the best model's components & matrix are kept
+                if self.best is None or result['coherence'] > self.best[0]['coherence']:
+                    self.best = (result, X, vectorizer, components)
+        return self
+
+    def report(self):
+        """Print every configuration, best coherence first. Returns the results as a list of dicts"""
+        results = sorted(self.results, key=lambda result: -result['coherence'])
+        print '\n%8s %8s %8s %8s %16s %10s %10s' % ('min_df', 'max_df', 'n_terms', 'n_topics', 'reconstruct_err', 'coherence', 'fit_sec')
+        for result in results:
+            print '%8r %8r %8i %8i %16.4f %10.3f %10.1f' % (result['min_df'], result['max_df'], result['n_terms'],
+                result['n_topics'], result['reconstruction_err'], result['coherence'], result['fit_seconds'])
+        return results
+
+    def save_report(self, path):
+        with open(path, 'w') as report_file:
+            json.dump({'vectorizer_settings': self.vectorizer_settings, 'n_docs': len(self.doc_ids),
+                'results': self.report()}, report_file, indent=2, sort_keys=True)
+        print 'saved sweep report to %s' % path
+
+    def best_topic_modeler(self, postman):
+        """TopicModeler with the chosen configuration's vectorizer & NMF, plus (doc_ids, X) to classify"""
+        if self.best is None:
+            raise ValueError('no configuration was fit, check the df settings')
+        result, X, vectorizer, components = self.best
+        topic_modeler = TopicModeler(postman)
+        topic_modeler.vectorizer_settings = dict(self.vectorizer_settings, min_df=result['min_df'], max_df=result['max_df'])
+        topic_modeler.vectorizer = vectorizer
+        topic_modeler.nmf = build_nmf(components)
+        topic_modeler.source = self.source
+        print '\nchose min_df=%r max_df=%r n_topics=%i, coherence %.3f' % (
+            result['min_df'], result['max_df'], result['n_topics'], result['coherence'])
+        return topic_modeler, self.doc_ids, X
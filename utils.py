@@ -0,0 +1,12 @@
+# Small helpers shared by the scrapers and the text processing modules,
+# kept here so importing them doesn't pull in NLTK or sklearn
+import itertools
+
+def chunked(iterable, chunk_size):
+    """Yields lists of up to chunk_size consecutive items from iterable"""
+    iterator = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(iterator, chunk_size))
+        if not chunk:
+            return
+        yield chunk